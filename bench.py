@@ -0,0 +1,389 @@
+#! /usr/bin/python -t
+
+""" Benchmarks for the hot paths in CAShe, results are printed as JSON. """
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, '.')
+import cashe
+
+def _timeit(func, *args, **kwargs):
+    beg = time.time()
+    ret = func(*args, **kwargs)
+    return time.time() - beg, ret
+
+def _evict_sort(objs, size, cutoff):
+    """ The old cleanup() selection, full sort and then pop. """
+    objs.sort(key=lambda x: x[0], reverse=True)
+    ret = 0
+    while size > cutoff:
+        item = objs.pop()
+        size -= item[1]
+        ret += 1
+    return ret
+
+def _evict_heap(objs, size, cutoff):
+    ret = 0
+    for item in cashe._evict_select(objs, size, cutoff):
+        ret += 1
+    return ret
+
+def _evict_snapshot(snap, size, cutoff, np):
+    """ What cleanup() does, CASheSnapshot.select() with or without numpy. """
+    onp = cashe._numpy_mod
+    if not np:
+        cashe._numpy_mod = None
+    try:
+        return len(list(snap.select(range(len(snap)), size, cutoff, 'atime')))
+    finally:
+        cashe._numpy_mod = onp
+
+def bench_evict(num, frac):
+    """ Select the oldest frac of num objects: by sorting them all, by using a
+        heap and by the snapshot selection that cleanup() uses (with numpy, if
+        it's installed). """
+    now = time.time()
+    objs = []
+    snap = cashe.CASheSnapshot()
+    size = 0
+    for seq in xrange(num):
+        osize = random.randint(1, 1024 * 1024)
+        atime = now - random.random() * 60 * 60 * 24 * 30
+        objs.append((atime, osize, -seq))
+        snap.append('sha256', "%064x" % seq,
+                    cashe._index_stat(osize, 1, atime, atime, atime, seq, 1))
+        size += osize
+    cutoff = size - int(size * frac)
+
+    ret = {}
+    for name, func in (("sort", _evict_sort), ("heap", _evict_heap)):
+        tm, evicted = _timeit(func, objs[:], size, cutoff)
+        ret[name] = {'secs' : tm, 'evicted' : evicted}
+    tm, evicted = _timeit(_evict_snapshot, snap, size, cutoff, False)
+    ret['snapshot'] = {'secs' : tm, 'evicted' : evicted}
+    if cashe._numpy() is not None:
+        tm, evicted = _timeit(_evict_snapshot, snap, size, cutoff, True)
+        ret['snapshot-numpy'] = {'secs' : tm, 'evicted' : evicted}
+    return ret
+
+def _rate(tm, num, size):
+    tm = max(tm, 0.000001)
+    return {'secs' : tm, 'objs' : num, 'bytes' : size,
+            'objs/s' : num / tm, 'MB/s' : size / tm / (1000 * 1000)}
+
+def _gen_sizes(num, dist, min_size, max_size):
+    """ Sizes for num objects, dist is one of: fixed, uniform or log (which
+        is like a real cache, lots of small objects and a few big ones). """
+    import math
+    for seq in xrange(num):
+        if dist == 'fixed':
+            yield max_size
+        elif dist == 'uniform':
+            yield random.randint(min_size, max_size)
+        else:
+            lmin = math.log(max(min_size, 1))
+            lmax = math.log(max_size)
+            yield int(math.exp(random.uniform(lmin, lmax)))
+
+def _gen_files(tdir, sizes):
+    """ Create the files to save in the stores, returns a list of
+        (filename, digest, size). """
+    os.makedirs(tdir)
+    ret = []
+    for seq, size in enumerate(sizes):
+        # Prefix with the seq, so everything is unique.
+        data = str(seq) + ":" + os.urandom(max(size - len(str(seq)) - 1, 0))
+        filename = "%s/%u" % (tdir, seq)
+        fo = open(filename, "wb")
+        fo.write(data)
+        fo.close()
+        sums = cashe.Checksums(['sha256'])
+        sums.update(data)
+        ret.append((filename, sums.hexdigest('sha256'), len(data)))
+    return ret
+
+def _hash_old(checksums, filename):
+    """ The old way of checksumming files, 8K reads into new strings. """
+    data = cashe.Checksums(checksums)
+    fo = open(filename)
+    while data.read(fo, 1024 * 8):
+        pass
+    fo.close()
+    return data
+
+def _hash_new(checksums, filename):
+    data = cashe.Checksums(checksums)
+    data.read_file(filename)
+    return data
+
+def bench_hashing(size):
+    """ MB/s of checksumming a file of size bytes, for each checksum type
+        and all of them at once, the old way and with Checksums.read_file(). """
+    fd, fname = tempfile.mkstemp(prefix="cashe-bench-")
+    try:
+        left = size
+        while left > 0:
+            left -= os.write(fd, os.urandom(min(left, 1024 * 1024)))
+        os.close(fd)
+
+        ret = {}
+        types = sorted(cashe._get_available_checksums())
+        for name, checksums in [(T, [T]) for T in types] + [("all", types)]:
+            ret[name] = {}
+            for how, func in (("old", _hash_old), ("new", _hash_new)):
+                tm, data = _timeit(func, checksums, fname)
+                ret[name][how] = _rate(tm, 1, size)['MB/s']
+        return ret
+    finally:
+        os.unlink(fname)
+
+def bench_hash(files):
+    """ Time _file2hexdigest() of all the files. """
+    beg = time.time()
+    for filename, D, size in files:
+        cashe._file2hexdigest('sha256', filename)
+    return _rate(time.time() - beg, len(files), sum([x[2] for x in files]))
+
+def bench_save(path, files, checksum):
+    """ Time saving all the files into a new store, they are copied so the
+        objects aren't linked to anything else. """
+    x = cashe.CAShe(path)
+    beg = time.time()
+    for filename, D, size in files:
+        x.get('sha256', D).save(filename, checksum=checksum, link=False)
+    return _rate(time.time() - beg, len(files), sum([x[2] for x in files]))
+
+def bench_load(path, files, tdir, link):
+    """ Time loading all the objects, as cache hits, by link or copy. """
+    x = cashe.CAShe(path)
+    os.makedirs(tdir)
+    beg = time.time()
+    for seq, (filename, D, size) in enumerate(files):
+        x.get('sha256', D).load("%s/%u" % (tdir, seq), link=link)
+    tm = time.time() - beg
+    shutil.rmtree(tdir)
+    return _rate(tm, len(files), sum([x[2] for x in files]))
+
+def bench_ls(path, files, index):
+    """ Time listing all the objects, with their stat data. """
+    x = cashe.CAShe(path)
+    beg = time.time()
+    num = 0
+    for obj in x.ls(index=index):
+        obj.size
+        num += 1
+    return _rate(time.time() - beg, num, sum([x[2] for x in files]))
+
+def bench_summary(path, files, index):
+    """ Time the data for the summary command. """
+    x = cashe.CAShe(path)
+    (lo, hi, age, sort_by) = x._get_config()
+    beg = time.time()
+    snap = x.scan(index=index)
+    snap.summary(sort_by, age, time.time())
+    return _rate(time.time() - beg, len(snap), sum([x[2] for x in files]))
+
+def bench_cleanup(path, files, tdir, frac, index):
+    """ Time cleanup on a copy of the store, with the watermarks at frac of
+        the size of all the objects. """
+    shutil.copytree(path, tdir)
+    mark = int(sum([x[2] for x in files]) * frac)
+    fo = open(tdir + "/config", "a")
+    fo.write("lo = %u\nhi = %u\n" % (mark, mark))
+    fo.close()
+    x = cashe.CAShe(tdir)
+    if index:
+        x.reindex()
+    beg = time.time()
+    num, size = x.cleanup(index=index)
+    tm = time.time() - beg
+    shutil.rmtree(tdir)
+    return _rate(tm, num, size)
+
+def bench_merge(files, tdir, jobs):
+    """ Time merging a copy of the files, and a hardlink to each, into a new
+        store. """
+    fdir = tdir + "/merge-files"
+    os.makedirs(fdir)
+    for seq, (filename, D, size) in enumerate(files):
+        shutil.copy(filename, "%s/%u" % (fdir, seq))
+        os.link("%s/%u" % (fdir, seq), "%s/%u.link" % (fdir, seq))
+    x = cashe.CAShe(tdir + "/merge-store")
+    beg = time.time()
+    num = len(list(x.merge([fdir], 'sha256', jobs=jobs)))
+    tm = time.time() - beg
+    shutil.rmtree(fdir)
+    shutil.rmtree(x.path)
+    return _rate(tm, num, sum([x[2] for x in files]))
+
+def bench_merge_link_only(store, files, tdir):
+    """ Time a link only merge of a copy of the files, and as many files of
+        other sizes, against the store. """
+    fdir = tdir + "/merge-files"
+    os.makedirs(fdir)
+    size = 0
+    for seq, (filename, D, fsize) in enumerate(files):
+        shutil.copy(filename, "%s/%u" % (fdir, seq))
+        fo = open("%s/%u.other" % (fdir, seq), "wb")
+        fo.write(os.urandom(fsize + 1))
+        fo.close()
+        size += fsize * 2 + 1
+    x = cashe.CAShe(store)
+    beg = time.time()
+    num = len(list(x.merge([fdir], 'sha256', link_only=True)))
+    tm = time.time() - beg
+    shutil.rmtree(fdir)
+    return _rate(tm, num, size)
+
+def bench_store(num, dist, min_size, max_size, marks, fanout=None, pack=None):
+    """ Create a synthetic store, of num objects with sizes from dist, and
+        time the operations on it. If fanout is given the store uses that
+        layout of bucket directories, and if pack is given objects smaller
+        than that are saved into packs. """
+    tdir = tempfile.mkdtemp(prefix="cashe-bench-")
+    try:
+        files = _gen_files(tdir + "/files", _gen_sizes(num, dist,
+                                                       min_size, max_size))
+        store = tdir + "/store"
+        if fanout is not None:
+            cashe.CAShe(store).reshard(fanout)
+            cashe.CAShe(tdir + "/store2").reshard(fanout)
+        if pack is not None:
+            for path in (store, tdir + "/store2"):
+                cashe.CAShe(path).pack(pack)
+                fo = open(path + "/config", "w")
+                fo.write("pack = %u\n" % pack)
+                fo.close()
+        ret = {'size' : sum([x[2] for x in files])}
+        ret['hash']            = bench_hash(files)
+        ret['save']            = bench_save(store, files, False)
+        ret['save-checksum']   = bench_save(tdir + "/store2", files, True)
+        shutil.rmtree(tdir + "/store2")
+        ret['merge']           = bench_merge(files, tdir, None)
+        ret['merge-1job']      = bench_merge(files, tdir, 1)
+        ret['merge-link-only'] = bench_merge_link_only(store, files, tdir)
+        ret['load-link']       = bench_load(store, files, tdir + "/out", True)
+        ret['load-copy']       = bench_load(store, files, tdir + "/out", False)
+        ret['ls']              = bench_ls(store, files, False)
+        ret['summary']         = bench_summary(store, files, False)
+        cashe.CAShe(store).reindex()
+        ret['ls-index']        = bench_ls(store, files, True)
+        ret['summary-index']   = bench_summary(store, files, True)
+        for frac in marks:
+            for index in (False, True):
+                name = "cleanup-%g" % frac
+                if index:
+                    name += "-index"
+                ret[name] = bench_cleanup(store, files, tdir + "/clean",
+                                          frac, index)
+        return ret
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+def bench_startup(num):
+    """ Time starting python and importing cashe, and running the save-fast,
+        load and unlink commands (which are run from hooks lots of times). """
+    import subprocess
+    tdir = tempfile.mkdtemp(prefix="cashe-bench-")
+    try:
+        fname = tdir + "/file"
+        fo = open(fname, "w")
+        fo.write("data")
+        fo.close()
+        D = cashe._file2hexdigest('sha256', fname)
+        store = tdir + "/store"
+        os.makedirs(store)
+        cmds = {'python' : [sys.executable, "-c", "pass"],
+                'import' : [sys.executable, "-c",
+                            "import sys; sys.path.insert(0, '.'); import cashe"],
+                'save-fast' : [sys.executable, "cashe-bin.py", "--path", store,
+                               "save-fast", "sha256", D, fname],
+                'load' : [sys.executable, "cashe-bin.py", "--path", store,
+                          "load", "sha256", D, tdir + "/out"],
+                'unlink' : [sys.executable, "cashe-bin.py", "--path", store,
+                            "unlink", "sha256", D]}
+        ret = {}
+        for name in ('python', 'import', 'save-fast', 'load', 'unlink'):
+            tm = 0
+            for seq in xrange(num):
+                if name == 'load': # Make it a hit, every time.
+                    subprocess.check_call(cmds['save-fast'])
+                    if os.path.exists(tdir + "/out"):
+                        os.unlink(tdir + "/out")
+                beg = time.time()
+                subprocess.check_call(cmds[name])
+                tm += time.time() - beg
+            ret[name] = {'secs' : tm / num}
+        return ret
+    finally:
+        shutil.rmtree(tdir, ignore_errors=True)
+
+def _main():
+    import optparse
+    import json
+
+    argp = optparse.OptionParser(
+            description='Benchmark the CAShe hot paths')
+    argp.add_option('--objs', default=1000 * 1000, type='int',
+            help='number of objects to benchmark with')
+    argp.add_option('--evict', default=0.01, type='float',
+            help='fraction of the objects to evict in cleanup')
+    argp.add_option('--store-objs', default=1000, type='int',
+            help='number of objects in the synthetic store, 0 to skip it')
+    argp.add_option('--dist', default='log',
+            choices=('fixed', 'uniform', 'log'),
+            help='distribution of object sizes: fixed, uniform or log')
+    argp.add_option('--min-size', default=64, type='int',
+            help='smallest object size in the synthetic store')
+    argp.add_option('--max-size', default=256 * 1024, type='int',
+            help='biggest object size in the synthetic store')
+    argp.add_option('--watermarks', default="0.9,0.5,0.1",
+            help='cleanup watermarks, as fractions of the store size')
+    argp.add_option('--fanout', default=None,
+            help='DEPTH:WIDTH layout of the synthetic store, Eg. 2:2')
+    argp.add_option('--pack', default=None,
+            help='save objects smaller than this into packs, Eg. 4k')
+    argp.add_option('--seed', default=None, type='int',
+            help='random seed, for repeatable object sizes')
+    argp.add_option('--hash-size', default=256 * 1024 * 1024, type='int',
+            help='size of the file to checksum, 0 to skip it')
+    argp.add_option('--startup', default=20, type='int',
+            help='number of times to run each command, 0 to skip them')
+    (opts, args) = argp.parse_args()
+
+    random.seed(opts.seed)
+    marks = [float(x) for x in opts.watermarks.split(',') if x]
+    res = {'version' : cashe.__version__,
+           'objs' : opts.objs,
+           'evict' : bench_evict(opts.objs, opts.evict)}
+    if opts.hash_size:
+        res['hashing'] = bench_hashing(opts.hash_size)
+    if opts.startup:
+        res['startup'] = bench_startup(opts.startup)
+    if opts.store_objs:
+        fanout = None
+        if opts.fanout:
+            fanout = cashe._parse_layout(opts.fanout)
+            if fanout is None:
+                argp.error("bad --fanout: " + opts.fanout)
+        pack = None
+        if opts.pack:
+            pack = cashe._parse_size(opts.pack)
+            if pack is None:
+                argp.error("bad --pack: " + opts.pack)
+        res['store'] = bench_store(opts.store_objs, opts.dist,
+                                   opts.min_size, opts.max_size, marks, fanout,
+                                   pack)
+        res['store']['objs'] = opts.store_objs
+        res['store']['dist'] = opts.dist
+        res['store']['fanout'] = "%u:%u" % (fanout or cashe._def_layout)
+        res['store']['pack'] = pack
+    print json.dumps(res, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    _main()
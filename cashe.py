@@ -7,9 +7,17 @@ import sys # Only needed for stderr and exit()
 
 import os
 import os.path
-import shutil
-import tempfile
 import errno
+import re
+import time
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try: # Python-2.x backport
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 _checksum_aliases = {'sha'    : 'sha1',
                      'sha2'   : 'sha256'}
@@ -37,20 +45,26 @@ except ImportError:
                 return sha.new()
             raise ValueError, "Bad checksum type"
 
-# some checksum types might be disabled
-for ctype in list(_available_checksums):
-    try:
-        hashlib.new(ctype)
-    except:
-        print >> sys.stderr, 'Checksum type %s disabled' % repr(ctype)
-        _available_checksums.remove(ctype)
-for ctype in 'sha256', 'sha1':
-    if ctype in _available_checksums:
-        _default_checksums = [ctype]
-        break
-else:
+# some checksum types might be disabled, but probing them all is slow so it's
+# done the first time they are needed.
+_probed_checksums = False
+def _get_available_checksums():
+    global _probed_checksums
+    if not _probed_checksums:
+        for ctype in list(_available_checksums):
+            try:
+                hashlib.new(ctype)
+            except:
+                print >> sys.stderr, 'Checksum type %s disabled' % repr(ctype)
+                _available_checksums.remove(ctype)
+        _probed_checksums = True
+    return _available_checksums
+
+def _get_default_checksums():
+    for ctype in 'sha256', 'sha1':
+        if ctype in _get_available_checksums():
+            return [ctype]
     raise ImportError, 'broken hashlib'
-del ctype
 
 def _listdir(D):
     try:
@@ -71,6 +85,14 @@ def _unlink_f(filename):
             raise
     return False
 
+def _makedirs_f(dirname):
+    """ Call os.makedirs, but don't die if something else created it. """
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
 def _try_rmdir(dirname):
     """ Call os.rmdir, but don't die if the dir. isn't empty. """
     try:
@@ -92,11 +114,54 @@ def _stat_f(filename, ignore_EACCES=False):
             return None
         raise
 
+def _lock_f(filename, shared=False):
+    """ Take a flock on filename (creating it), returns the fd (closing it
+        unlocks) or None if it can't be opened. """
+    import fcntl
+    try:
+        fd = os.open(filename, os.O_RDONLY | os.O_CREAT, 0644)
+    except OSError, e:
+        if e.errno in (errno.ENOENT, errno.EACCES, errno.EROFS):
+            return None
+        raise
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def _append_log(filename, data):
+    """ Append data to a log file with a single write() of O_APPEND, holding
+        a shared lock on filename.lock so appends don't wait for each other
+        but a compaction (holding it exclusively) can't lose them. Returns
+        False if the file doesn't exist or can't be written. """
+    while True:
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_APPEND)
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.EACCES, errno.EROFS):
+                return False
+            raise
+        lock = _lock_f(filename + ".lock", shared=True)
+        try:
+            st = _stat_f(filename)
+            if lock is None or (st is not None and
+                                st.st_ino == os.fstat(fd).st_ino):
+                os.write(fd, data)
+                return True
+        finally:
+            os.close(fd)
+            if lock is not None:
+                os.close(lock)
+        # It was replaced by a compaction, so append to the new one.
+
 def _link_xdev(src, dst):
     try:
         os.link(src, dst)
     except OSError, e:
         if e.errno == errno.EEXIST:
+            import tempfile
             dname = os.path.dirname(dst)
             out = tempfile.NamedTemporaryFile(dir=dname)
             _unlink_f(out.name)
@@ -118,30 +183,285 @@ def _link_xdev(src, dst):
         raise
     return True
 
+_FICLONE    = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+_SEEK_DATA  = getattr(os, 'SEEK_DATA', 3)
+_SEEK_HOLE  = getattr(os, 'SEEK_HOLE', 4)
+# Errors meaning a copy method doesn't work for these files, so try the next.
+_copy_nosup = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                   getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+def _data_ranges(fd, size, sparse):
+    """ Yield (offset, end) for the data in a file, skipping any holes. """
+    if not sparse:
+        yield 0, size
+        return
+
+    off = 0
+    while off < size:
+        try:
+            off = os.lseek(fd, off, _SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO: # Just a hole to the end
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            yield off, size
+            return
+        end = min(os.lseek(fd, off, _SEEK_HOLE), size)
+        yield off, end
+        off = end
+
+_libc = None
+def _libc_func(name, restype, *argtypes):
+    """ A function from libc, via ctypes, or None if it isn't there. Used for
+        the syscalls only os has on Python-3. """
+    global _libc
+    if _libc is None:
+        try:
+            import ctypes
+            _libc = ctypes.CDLL(None, use_errno=True)
+        except (ImportError, OSError):
+            _libc = False
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.restype = restype
+        func.argtypes = argtypes
+    return func
+
+def _libc_call(func, *args):
+    import ctypes
+    ret = func(*args)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+# The struct stat, from fstatat() via libc, on the machines we know it for.
+_stat_structs = {
+    'x86_64'  : ('=QQQIIIiQqqqqqqqqq24x',
+                 'dev ino nlink mode uid gid _ rdev size blksize blocks '
+                 'atime atime_ns mtime mtime_ns ctime ctime_ns'),
+    'aarch64' : ('=QQIIIIQQqiiqqqqqqq8x',
+                 'dev ino mode nlink uid gid rdev _ size blksize _ blocks '
+                 'atime atime_ns mtime mtime_ns ctime ctime_ns'),
+}
+_AT_FDCWD = -100
+
+_at_funcs = None
+def _at_calls():
+    """ The (fstatat, linkat, struct, names) to make calls relative to a
+        directory fd, or None if libc/the machine doesn't have them. """
+    global _at_funcs
+    if _at_funcs is None:
+        _at_funcs = False
+        if os.uname()[4] in _stat_structs:
+            import ctypes
+            fstatat = _libc_func('fstatat64', ctypes.c_int,
+                                 ctypes.c_int, ctypes.c_char_p,
+                                 ctypes.c_char_p, ctypes.c_int)
+            linkat = _libc_func('linkat', ctypes.c_int,
+                                ctypes.c_int, ctypes.c_char_p,
+                                ctypes.c_int, ctypes.c_char_p, ctypes.c_int)
+            if fstatat is not None and linkat is not None:
+                fmt, names = _stat_structs[os.uname()[4]]
+                _at_funcs = (fstatat, linkat, fmt, names.split())
+    return _at_funcs or None
+
+def _fstatat(dfd, name):
+    """ Stat name in the directory dfd, like os.stat(name, dir_fd=dfd) on
+        Python-3. Returns None if it doesn't exist. """
+    import ctypes
+    import struct
+    fstatat, linkat, fmt, names = _at_calls()
+    buf = ctypes.create_string_buffer(struct.calcsize(fmt))
+    try:
+        _libc_call(fstatat, dfd, name, buf, 0)
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+    st = dict(zip(names, struct.unpack(fmt, buf.raw)))
+    def _tm(name):
+        return st[name] + st[name + '_ns'] * 1e-9
+    return os.stat_result((st['mode'], st['ino'], st['dev'], st['nlink'],
+                           st['uid'], st['gid'], st['size'],
+                           st['atime'], st['mtime'], st['ctime'],
+                           _tm('atime'), _tm('mtime'), _tm('ctime'),
+                           st['blksize'], st['blocks'], st['rdev']))
+
+def _linkat(sdfd, sname, ddfd, dname):
+    """ Hardlink sname in the directory sdfd to dname in ddfd, like
+        os.link(..., src_dir_fd=sdfd, dst_dir_fd=ddfd) on Python-3. """
+    _libc_call(_at_calls()[1], sdfd, sname, ddfd, dname, 0)
+
+def _copy_file_range(sfd, dfd, num, off):
+    """ Copy num bytes at off, in the kernel, to the same offset. """
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(sfd, dfd, num, off, off)
+    import ctypes
+    func = _libc_func('copy_file_range', ctypes.c_ssize_t,
+                      ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                      ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                      ctypes.c_size_t, ctypes.c_uint)
+    if func is None:
+        raise OSError(errno.ENOSYS, "No copy_file_range")
+    soff = ctypes.c_int64(off)
+    doff = ctypes.c_int64(off)
+    return _libc_call(func, sfd, ctypes.byref(soff), dfd, ctypes.byref(doff),
+                      num, 0)
+
+def _sendfile(dfd, sfd, off, num):
+    """ Copy num bytes from off, in the kernel, to the offset of dfd. """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(dfd, sfd, off, num)
+    import ctypes
+    func = _libc_func('sendfile64', ctypes.c_ssize_t,
+                      ctypes.c_int, ctypes.c_int,
+                      ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    if func is None:
+        raise OSError(errno.ENOSYS, "No sendfile")
+    soff = ctypes.c_int64(off)
+    return _libc_call(func, dfd, sfd, ctypes.byref(soff), num)
+
+def _copy_range_cfr(sfd, dfd, pos, end, sparse):
+    while pos[0] < end:
+        num = _copy_file_range(sfd, dfd, min(end - pos[0], 2**30), pos[0])
+        if not num:
+            break
+        pos[0] += num
+
+def _copy_range_sendfile(sfd, dfd, pos, end, sparse):
+    os.lseek(dfd, pos[0], os.SEEK_SET)
+    while pos[0] < end:
+        num = _sendfile(dfd, sfd, pos[0], min(end - pos[0], 2**30))
+        if not num:
+            break
+        pos[0] += num
+
+def _copy_range_read(sfd, dfd, pos, end, sparse, chunk=1024 * 1024):
+    os.lseek(sfd, pos[0], os.SEEK_SET)
+    while pos[0] < end:
+        data = os.read(sfd, min(end - pos[0], chunk))
+        if not data:
+            break
+        if not sparse or data.count('\0') != len(data):
+            os.lseek(dfd, pos[0], os.SEEK_SET)
+            while data:
+                num = os.write(dfd, data)
+                data = data[num:]
+                pos[0] += num
+        else: # Leave a hole
+            pos[0] += len(data)
+
+_copy_methods = [('copy_file_range', _copy_range_cfr),
+                 ('sendfile', _copy_range_sendfile),
+                 ('read', _copy_range_read)]
+
+def _copy_data(sfd, dfd):
+    """ Copy all the data from one fd to another (empty) one, using a reflink
+        if the filesystem can do that, or else copying in the kernel, and only
+        then a read/write copy. Holes in the source are kept. Returns the name
+        of the method used. """
+    try:
+        import fcntl
+        fcntl.ioctl(dfd, _FICLONE, sfd)
+        return "reflink"
+    except (ImportError, IOError, OSError):
+        pass
+
+    st = os.fstat(sfd)
+    sparse = getattr(st, 'st_blocks', st.st_size) * 512 < st.st_size
+    methods = list(_copy_methods) # Missing syscalls fail with ENOSYS
+    for off, end in _data_ranges(sfd, st.st_size, sparse):
+        pos = [off]
+        while True:
+            try:
+                methods[0][1](sfd, dfd, pos, end, sparse)
+                break
+            except OSError, e:
+                if e.errno not in _copy_nosup or len(methods) == 1:
+                    raise
+                methods.pop(0) # Continue from pos with the next method
+    os.ftruncate(dfd, st.st_size)
+    return methods[0][0]
+
 def _copy_atomic(src, dst):
+    import tempfile
     dname = os.path.dirname(dst)
     try:
         out = tempfile.NamedTemporaryFile(dir=dname)
     except OSError, e:
         if e.errno == errno.ENOENT:
-            os.makedirs(dname)
+            _makedirs_f(dname)
             return _copy_atomic(src, dst)
         raise
-    shutil.copy(src, out.name)
+    fd = os.open(src, os.O_RDONLY)
+    try:
+        ret = _copy_data(fd, out.fileno())
+        os.fchmod(out.fileno(), os.fstat(fd).st_mode & 07777)
+    finally:
+        os.close(fd)
     os.rename(out.name, dst)
     out.delete = False
-
+    out.close()
+    return ret
+
+
+_hash_local = None
+def _hash_buffer(size):
+    """ A buffer to read data to checksum into, reused by each thread. """
+    global _hash_local
+    if _hash_local is None:
+        import threading
+        _hash_local = threading.local()
+    buf = getattr(_hash_local, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _hash_local.buf = bytearray(size)
+    return buf
+
+_hash_nogil = None
+def _hash_threads_ok():
+    """ Does hashlib drop the GIL while hashing, it does when it's using
+        OpenSSL (and always on Python-3). """
+    global _hash_nogil
+    if _hash_nogil is None:
+        try:
+            import _hashlib
+            _hash_nogil = True
+        except ImportError:
+            _hash_nogil = sys.version_info[0] >= 3
+    return _hash_nogil
+
+def _hash_worker(sumalgo, queue, done):
+    """ Thread for one checksum of a Checksums, updating it with each piece
+        of data from the queue (until None), and putting to done after each. """
+    while True:
+        data = queue.get()
+        if data is None:
+            return
+        try:
+            sumalgo.update(data)
+        finally:
+            done.put(None)
 
 class Checksums:
     """ Generate checksum(s), on given pieces of data. Producing the
         Length and the result(s) when complete. """
 
+    # Updates of at least this much data, with more than one checksum, are
+    # done with a thread per checksum (hashlib drops the GIL while hashing),
+    # the threads are started the first time and kept until we are freed.
+    THREADS_MIN = 256 * 1024
+    # Otherwise big updates, with more than one checksum, are done in slices.
+    SLICE = 64 * 1024
+
     def __init__(self, checksums=None, ignore_missing=False, ignore_none=False):
         if checksums is None:
-            checksums = _default_checksums
+            checksums = _get_default_checksums()
         self._sumalgos = []
         self._sumtypes = []
         self._len = 0
+        self._queues = None
 
         done = set()
         for sumtype in checksums:
@@ -150,7 +470,7 @@ class Checksums:
             if sumtype in done:
                 continue
 
-            if sumtype in _available_checksums:
+            if sumtype in _get_available_checksums():
                 sumalgo = hashlib.new(sumtype)
             elif ignore_missing:
                 continue
@@ -162,6 +482,10 @@ class Checksums:
         if not done and not ignore_none:
             raise MiscError, 'Error Checksumming, no valid checksum type'
 
+    def __del__(self):
+        for queue in self._queues or []:
+            queue.put(None)
+
     def __len__(self):
         return self._len
 
@@ -170,14 +494,71 @@ class Checksums:
 
     def update(self, data):
         self._len += len(data)
+        if (len(self._sumalgos) > 1 and len(data) >= self.THREADS_MIN and
+            _hash_threads_ok()):
+            queues = self._threads()
+            for queue in queues:
+                queue.put(data)
+            self._sumalgos[0].update(data)
+            for queue in queues:
+                self._done.get()
+            return
+        if len(self._sumalgos) > 1 and len(data) > self.SLICE:
+            # Do each slice with all the checksums, while it's in the cache.
+            if not isinstance(data, memoryview):
+                data = memoryview(data)
+            for off in xrange(0, len(data), self.SLICE):
+                piece = data[off:off + self.SLICE]
+                for sumalgo in self._sumalgos:
+                    sumalgo.update(piece)
+            return
         for sumalgo in self._sumalgos:
             sumalgo.update(data)
 
+    def _threads(self):
+        """ The queues of the threads for all the checksums but the first,
+            which is done by the caller. """
+        if self._queues is None:
+            import threading
+            import Queue
+            self._done = Queue.Queue()
+            self._queues = []
+            for sumalgo in self._sumalgos[1:]:
+                queue = Queue.Queue()
+                thread = threading.Thread(target=_hash_worker,
+                                          args=(sumalgo, queue, self._done))
+                thread.daemon = True
+                thread.start()
+                self._queues.append(queue)
+        return self._queues
+
     def read(self, fo, size=2**16):
         data = fo.read(size)
         self.update(data)
         return data
 
+    def read_file(self, filename, datasize=None, chunk=1024 * 1024):
+        """ Checksum the data in a file, read into a reused buffer (and
+            telling the kernel we are reading it sequentially). Stops after
+            more than datasize bytes, if given. Returns the length read. """
+        import io
+        view = memoryview(_hash_buffer(chunk))[:chunk]
+        fo = io.open(filename, 'rb', buffering=0)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fo.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                num = fo.readinto(view)
+                if not num:
+                    break
+                self.update(view[:num])
+                if datasize is not None and self._len > datasize:
+                    break
+        finally:
+            fo.close()
+        return self._len
+
     def hexdigests(self):
         ret = {}
         for sumtype, sumdata in zip(self._sumtypes, self._sumalgos):
@@ -223,15 +604,11 @@ class AutoFileChecksums:
     def read(self, size=-1):
         return self.checksums.read(self._fo, size)
 
-def _file2hexdigest(checksum_type, filename, datasize=None, utime=None):
+def _file2hexdigest(checksum_type, filename, datasize=None, utime=None,
+                    chunk=1024 * 1024):
     data = Checksums([checksum_type])
-    CHUNK = 1024 * 8
     try:
-        fo = open(filename)
-        while data.read(fo, CHUNK):
-            if datasize is not None and data.length > datasize:
-                break
-        fo.close()
+        data.read_file(filename, datasize, chunk)
         if utime is not None:
             try:
                 os.utime(filename, utime)
@@ -242,12 +619,265 @@ def _file2hexdigest(checksum_type, filename, datasize=None, utime=None):
         return None
     return data.hexdigest(checksum_type)
 
+_valid_checksum_re = re.compile("[0-9a-f]*\Z")
 def _valid_checksum_data(checksum_data):
-    for i in checksum_data:
-        if i in "0123456789abcdef":
+    return _valid_checksum_re.match(checksum_data) is not None
+
+# The fan-out of the bucket directories, as (depth, width), so the default is
+# root/type/abcd/abcd... and (2, 2) would be root/type/ab/cd/abcd...
+_def_layout = (1, 4)
+
+def _parse_layout(val):
+    """ Parse a "DEPTH:WIDTH" fan-out, returns None if it isn't valid. """
+    try:
+        depth, width = [int(x) for x in val.split(':')]
+    except ValueError:
+        return None
+    if depth < 1 or depth > 3 or width < 1 or width > 4:
+        return None
+    return (depth, width)
+
+def _layout_dirname(root, checksum_type, checksum_data, layout):
+    """ Path to the bucket directory of an object, in a layout. """
+    depth, width = layout
+    return "/".join([root, checksum_type] +
+                    [checksum_data[num * width:(num + 1) * width]
+                     for num in xrange(depth)])
+
+def _read_layouts(path):
+    """ Read the layouts of the objects from the "layout" file, the first is
+        the one objects are saved in and any others are from before a reshard
+        that hasn't finished (so objects can still be in them). """
+    try:
+        data = open(path + "/layout").read().split()
+    except EnvironmentError:
+        return (_def_layout,)
+    ret = []
+    for val in data:
+        layout = _parse_layout(val)
+        if layout is not None and layout not in ret:
+            ret.append(layout)
+    if not ret:
+        return (_def_layout,)
+    return tuple(ret)
+
+def _try_rmdirs(dirname, num):
+    """ Remove an empty bucket directory, and up to num-1 of its parents
+        while they are empty too. """
+    while num > 0 and _try_rmdir(dirname):
+        dirname = os.path.dirname(dirname)
+        num -= 1
+
+def _scan_bucket(dirname, prefix, dlen, level=1, layouts=(_def_layout,)):
+    """ Look at all the entries in a bucket directory, returning a list of
+        (digest, stat) for the objects and a list of paths for everything else.
+        The stat is None if we aren't allowed to stat() the object. The bucket
+        is level directories down, and subdirectories are scanned for any of
+        the layouts which are deeper. """
+    objs = []
+    extras = []
+    if _scandir is None:
+        entries = [(name, None) for name in _listdir(dirname)]
+    else:
+        try:
+            entries = [(ent.name, ent) for ent in _scandir(dirname)]
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                raise
+            entries = []
+
+    leaf = [L for L in layouts if L[0] == level]
+    for name, ent in entries:
+        if (not leaf or len(name) != dlen or not name.startswith(prefix) or
+            not _valid_checksum_data(name)):
+            sub = [L for L in layouts if L[0] > level and L[1] == len(name)]
+            if not sub or not _valid_checksum_data(name):
+                extras.append("%s/%s" % (dirname, name))
+                continue
+            sobjs, sextras = _scan_bucket("%s/%s" % (dirname, name),
+                                          prefix + name, dlen, level + 1, sub)
+            objs.extend(sobjs)
+            extras.extend(sextras)
             continue
-        return False
-    return True
+        try:
+            if ent is None:
+                st = os.stat("%s/%s" % (dirname, name))
+            else:
+                st = ent.stat()
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                continue # Removed under us.
+            if e.errno != errno.EACCES:
+                raise
+            st = None
+        objs.append((name, st))
+    return objs, extras
+
+def _walk_type(path, checksum_type, threads=1, layouts=(_def_layout,)):
+    """ Walk all the bucket directories for a checksum type, yielding a batch
+        of (objs, extras) for each, see _scan_bucket(). The buckets are
+        scanned in parallel using threads, so the order isn't stable. Objects
+        in any of the layouts are found (there is more than one during a
+        reshard). """
+    subdirname = "%s/%s" % (path, checksum_type)
+    dlen = _checksum_d_len[checksum_type]
+    widths = set([L[1] for L in layouts])
+
+    buckets = []
+    extras = []
+    for subfilename in _listdir(subdirname):
+        if (len(subfilename) not in widths or
+            not _valid_checksum_data(subfilename)):
+            extras.append("%s/%s" % (subdirname, subfilename))
+            continue
+        buckets.append(subfilename)
+    if extras:
+        yield [], extras
+
+    def _scan(subfilename):
+        return _scan_bucket("%s/%s" % (subdirname, subfilename),
+                            subfilename, dlen, 1,
+                            [L for L in layouts if L[1] == len(subfilename)])
+
+    pool = None
+    if threads > 1 and len(buckets) > 1:
+        try:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(threads, len(buckets)))
+        except ImportError:
+            pass
+    if pool is None:
+        for subfilename in buckets:
+            yield _scan(subfilename)
+        return
+
+    try:
+        for batch in pool.imap_unordered(_scan, buckets, 16):
+            yield batch
+    finally:
+        pool.terminate()
+
+def _read_prefix(filename, size):
+    """ Return a hash of the first size bytes of a file, or None if it can't
+        be read. """
+    try:
+        fo = open(filename, "rb")
+        try:
+            return hash(fo.read(size))
+        finally:
+            fo.close()
+    except IOError:
+        return None
+
+def _walk_files(paths):
+    """ Yield (path, stat) for the regular files in paths, and everything
+        under the directories in them (but not symlinks to directories). The
+        directories are listed with scandir when possible. """
+    import stat
+    for path in paths:
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            if stat.S_ISREG(st.st_mode):
+                yield path, st
+            continue
+
+        dirs = [path]
+        while dirs:
+            dirname = dirs.pop()
+            if _scandir is None:
+                entries = [(name, None) for name in _listdir(dirname)]
+            else:
+                try:
+                    entries = [(ent.name, ent) for ent in _scandir(dirname)]
+                except OSError, e:
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR,
+                                       errno.EACCES):
+                        raise
+                    entries = []
+
+            subdirs = []
+            for name, ent in sorted(entries):
+                fname = "%s/%s" % (dirname, name)
+                try:
+                    if ent is None:
+                        st = os.lstat(fname)
+                        if stat.S_ISLNK(st.st_mode):
+                            st = os.stat(fname)
+                        elif stat.S_ISDIR(st.st_mode):
+                            subdirs.append(fname)
+                            continue
+                    elif ent.is_dir(follow_symlinks=False):
+                        subdirs.append(fname)
+                        continue
+                    else:
+                        st = ent.stat()
+                except OSError, e:
+                    if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.ELOOP):
+                        continue # Removed under us, or a bad symlink.
+                    raise
+                if stat.S_ISREG(st.st_mode):
+                    yield fname, st
+            dirs.extend(reversed(subdirs))
+
+def _parse_age(val):
+    """ Parse an age, of seconds/minutes/hours/days/weeks Eg. "8d". Returns
+        the number of seconds, or None if it isn't valid. """
+    mul = 1
+    if val.endswith('w'):
+        mul = 60*60*24*7
+        val = val[:-1]
+    elif val.endswith('d'):
+        mul = 60*60*24
+        val = val[:-1]
+    elif val.endswith('h'):
+        mul = 60*60
+        val = val[:-1]
+    elif val.endswith('m'):
+        mul = 60
+        val = val[:-1]
+
+    try:
+        val = float(val)
+    except ValueError:
+        return None
+    return int(val * mul)
+
+def _parse_size(val):
+    """ Parse a size, of bytes with an optional k/m/g/t/p suffix Eg. "4k".
+        Returns the number of bytes, or None if it isn't valid. """
+    mul = 1
+    if val.endswith('k') or val.endswith('K'):
+        mul = 1000
+        val = val[:-1]
+    elif val.endswith('m') or val.endswith('M'):
+        mul = 1000*1000
+        val = val[:-1]
+    elif val.endswith('g') or val.endswith('G'):
+        mul = 1000*1000*1000
+        val = val[:-1]
+    elif val.endswith('t') or val.endswith('T'):
+        mul = 1000*1000*1000*1000
+        val = val[:-1]
+    elif val.endswith('p') or val.endswith('P'): # lol
+        mul = 1000*1000*1000*1000*1000
+        val = val[:-1]
+
+    try:
+        val = float(val)
+    except ValueError:
+        return None
+    return int(val * mul)
+
+def _evict_select(items, size, cutoff):
+    """ Yield the oldest items until the total size is at/under the cutoff.
+        Items are (time, size, ...) tuples, and the list is heapified in place
+        so this is O(n + k log n) for k items instead of a full sort. """
+    import heapq
+    heapq.heapify(items)
+    while size > cutoff and items:
+        item = heapq.heappop(items)
+        size -= item[1]
+        yield item
 
 class CASheObj(object):
     __slots__ = ['checksum_type', 'checksum_data']
@@ -289,12 +919,15 @@ class CASheObj(object):
 
 
 class CASheFileObj(CASheObj):
-    __slots__ = ['_exists', '_filename', '_stat', 'link', 'root']
+    __slots__ = ['_exists', '_filename', '_stat', '_store', 'layouts', 'link',
+                 'root']
 
     def __init__(self, root, checksum_type, checksum_data, *args, **kwargs):
         CASheObj.__init__(self, checksum_type, checksum_data, *args, **kwargs)
         self.root = root
         self.link = True
+        self.layouts = (_def_layout,)
+        self._store = None
 
     def __len__(self):
         " Same as .size "
@@ -304,32 +937,106 @@ class CASheFileObj(CASheObj):
         """ Always True, even if the len() is unknown (and thus 0). """
         return True
 
+    def _layoutFilename(self, layout):
+        return "%s/%s" % (_layout_dirname(self.root, self.checksum_type,
+                                          self.checksum_data, layout),
+                          self.checksum_data)
     def _getFilename(self):
         if getattr(self, "_filename", None) is None:
-            self._filename = "%s/%s/%s/%s" % (self.root, self.checksum_type,
-                                              self.checksum_data[:4],
-                                              self.checksum_data)
+            self._filename = self._layoutFilename(self.layouts[0])
+            if len(self.layouts) > 1 and not os.path.lexists(self._filename):
+                # Reshard in progress, so it might not have been moved yet.
+                for layout in self.layouts[1:]:
+                    fname = self._layoutFilename(layout)
+                    if os.path.lexists(fname):
+                        self._filename = fname
+                        break
         return self._filename
     filename = property(fget=lambda self: self._getFilename(),
                         doc="Full path to filename for the cached object")
     def _getDirname(self):
-        return "%s/%s/%s" % (self.root, self.checksum_type,
-                             self.checksum_data[:4])
+        return os.path.dirname(self.filename)
     dirname = property(fget=lambda self: self._getDirname(),
                        doc="Full path to dirname for the cached object")
 
-    def _getCheckedFilename(self):
+    def _moved(self):
+        """ True if the object was moved by a reshard, since we looked for it
+            (so the caller should try again). A reshard by another process is
+            seen by re-reading the layouts. """
+        if self._store is not None:
+            self._store._reread_layouts()
+            if self.layouts != self._store._layouts:
+                self.layouts = self._store._layouts
+                self._filename = None
+                return True
+        if len(self.layouts) == 1:
+            return False
+        fname = self.filename
+        self._filename = None
+        return self.filename != fname
+
+    def _file_stat(self):
+        """ Stat the file of the object, never using the bloom filter or the
+            daemon (which don't know about an object until it's saved). """
+        st = _stat_f(self.filename)
+        if st is None and self._moved():
+            st = _stat_f(self.filename)
+        self._stat = st
+        return st
+
+    def _getCheckedFilename(self, chunk=1024 * 1024, force=False):
+        st = self._file_stat()
+        if st is None:
+            if self._store is not None and self._store._pack_stat(self):
+                return self._checked_pack()
+            self.exists = False
+            return None
+        if not force and self._store is not None:
+            if self._store._verified.verified(self, st):
+                self.exists = True
+                self._count('checksum-skips')
+                return self.filename
+
+        beg = time.time()
         checksum_data = _file2hexdigest(self.checksum_type, self.filename,
-                                        utime=(self.atime, self.mtime))
+                                        utime=(st.st_atime, st.st_mtime),
+                                        chunk=chunk)
+        self._count('checksum-secs', time.time() - beg)
+        self._count('checksum-objs')
+        self._count('checksum-bytes', st.st_size)
         if checksum_data is None or checksum_data != self.checksum_data:
+            self._count('checksum-failures')
             self.unlink()
             return None
 
+        if self._store is not None: # Stat again, as the utime changes ctime
+            self._stat = _stat_f(self.filename)
+            self._store._verified.add(self, self._stat)
         self.exists = True
         return self.filename
     checked_filename = property(fget=lambda self: self._getCheckedFilename(),
                                 doc="Full path to filename for the cached object, checked")
 
+    def _checked_pack(self):
+        """ Checksum the data of the object in its pack, see .packed. Returns
+            the filename of the pack, or None. """
+        packs = self._store._pack(self.checksum_type)
+        beg = time.time()
+        data = packs.read(self.checksum_data)
+        if data is None:
+            self.exists = False
+            return None
+        sums = Checksums([self.checksum_type])
+        sums.update(data)
+        self._count('checksum-secs', time.time() - beg)
+        self._count('checksum-objs')
+        self._count('checksum-bytes', len(data))
+        if sums.hexdigest(self.checksum_type) != self.checksum_data:
+            self._count('checksum-failures')
+            self.unlink()
+            return None
+        return packs.filename(self.checksum_data)
+
 
     def _getExists(self):
         if getattr(self, "_exists", None) is None:
@@ -348,11 +1055,29 @@ class CASheFileObj(CASheObj):
                       fdel=lambda self: self._setExists(None),
                       doc="Does the checksummed object exist in the cache (cached)")
 
+    def _count(self, name, num=1):
+        """ Add to one of the CAShe's counters, see CAShe.stats(). """
+        if self._store is not None:
+            self._store._stats.add(name, num)
+    def _count_io(self, how, beg, size):
+        self._count(how + '-objs')
+        self._count(how + '-bytes', size)
+        self._count(how + '-secs', time.time() - beg)
+
     def _delStatVal(self):
         self._stat = None
     def _getStatVal(self, mem, zero=0):
         if getattr(self, "_stat", None) is None:
-            self._stat = _stat_f(self.filename)
+            st = False
+            if self._store is not None:
+                st = self._store._cached_stat(self)
+            if st is False:
+                st = _stat_f(self.filename)
+                if st is None and self._moved():
+                    st = _stat_f(self.filename)
+                if st is None and self._store is not None:
+                    st = self._store._pack_stat(self)
+            self._stat = st
             if self._stat is None:
                 return zero
             self.exists = True
@@ -392,9 +1117,126 @@ class CASheFileObj(CASheObj):
     st_dev = property(fget=lambda self: self._getDev(),
                       fdel=lambda self: self._delStatVal(),
                       doc="Device of underlying checksummed object in the cache (cached)")
+    def _getPacked(self):
+        return self._getStatVal("st_ino", None) == 0
+    packed = property(fget=lambda self: self._getPacked(),
+                      doc="Is the checksummed object in a pack, not a file (cached)")
+
+    def open(self):
+        """ Open the data of the object for reading, from its file or its
+            pack. The stat data is updated from what was opened. Raises
+            IOError ENOENT if the object doesn't exist. """
+        try:
+            fo = open(self.filename, "rb")
+        except IOError, e:
+            if e.errno != errno.ENOENT or self._store is None:
+                raise
+            packs = self._store._pack(self.checksum_type)
+            if packs is None:
+                raise
+            st = packs.stat(self.checksum_data)
+            data = packs.read(self.checksum_data)
+            if st is None or data is None:
+                raise
+            import cStringIO
+            self._stat = st
+            self.exists = True
+            return cStringIO.StringIO(data)
+        self._stat = os.fstat(fo.fileno())
+        self.exists = True
+        return fo
+
+    def utime(self, times):
+        """ Set the (atime, mtime) of the object, like os.utime(). """
+        try:
+            os.utime(self.filename, times)
+        except OSError, e:
+            if e.errno != errno.ENOENT or self._store is None:
+                raise
+            packs = self._store._pack(self.checksum_type)
+            if packs is None or not packs.touch(self.checksum_data, *times):
+                raise
+        self._delStatVal()
+
+    def _pack_data(self, data, how, beg):
+        """ Save data, that matches the checksum, into the packs (see
+            CAShePacks). Returns the filename of the pack, or None if the
+            packs can't be written to (so it should be saved as a file). """
+        packs = self._store._pack(self.checksum_type)
+        old = self._store._old_stat(self)
+        try:
+            ret = packs.add(self.checksum_data, data)
+        except EnvironmentError, e:
+            if e.errno not in (errno.EACCES, errno.EROFS, errno.EPERM):
+                raise
+            return None
+        del self.exists
+        self._stat = packs.stat(self.checksum_data)
+        self.exists = True
+        self._count('save-objs')
+        self._count_io(how, beg, len(data))
+        self._store._saved(self, old)
+        return ret
+
+    def _save_pack(self, filename, checksum):
+        """ Save a small file into the packs, see .save(). Returns False if
+            it should be saved as a file. """
+        beg = time.time()
+        try:
+            fo = open(filename, "rb")
+        except IOError, e:
+            return False # Let the normal save deal with it.
+        try:
+            if os.fstat(fo.fileno()).st_size >= self._store._pack_size:
+                return False
+            data = fo.read()
+        finally:
+            fo.close()
+        if os.path.lexists(self.filename): # Already saved as a file.
+            return False
+
+        if checksum:
+            sums = Checksums([self.checksum_type])
+            sums.update(data)
+            if sums.hexdigest(self.checksum_type) != self.checksum_data:
+                self._count('checksum-failures')
+                return None
+        ret = self._pack_data(data, 'pack', beg)
+        if ret is None:
+            return False
+        return ret
+
+    def _load_pack(self, filename, beg):
+        """ Load the object from the packs, by writing its data to filename.
+            Returns None if it isn't in them. """
+        if self._store is None:
+            return None
+        packs = self._store._pack(self.checksum_type)
+        if packs is None:
+            return None
+        data = packs.read(self.checksum_data)
+        if data is None:
+            return None
+
+        import tempfile
+        out = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename))
+        out.write(data)
+        out.flush()
+        os.chmod(out.name, 0644)
+        os.rename(out.name, filename)
+        out.delete = False
+        out.close()
+
+        packs.touch(self.checksum_data)
+        self._delStatVal()
+        self.exists = True
+        self._count('load-hits')
+        self._count_io('pack', beg, len(data))
+        return filename
 
     def save(self, filename, checksum=True, link=None):
-        """ Save the file, as an object, into the CAShe storage.
+        """ Save the file, as an object, into the CAShe storage. Files smaller
+            than the "pack" config are saved into the packs, if they exist.
 
         :param filename: a string specifying the path to link/read from
         :param checksum: a boolean specifying if we should perform a
@@ -405,6 +1247,14 @@ class CASheFileObj(CASheObj):
             print "JDBG:", "save:", filename, checksum, link, self.link
         if link is None:
             link = self.link
+        if self._store is not None and self._store._pack_size:
+            ret = self._save_pack(filename, checksum)
+            if ret is not False:
+                return ret
+        old = None
+        if self._store is not None:
+            old = self._store._old_stat(self)
+        beg = time.time()
         try:
             if not link:
                 tst = False
@@ -412,20 +1262,117 @@ class CASheFileObj(CASheObj):
                 tst = _link_xdev(filename, self.filename)
         except OSError, e:
             if e.errno == errno.ENOENT:
-                os.makedirs(os.path.dirname(self.filename))
-                return self.save(filename, checksum=checksum)
+                if not self._moved():
+                    _makedirs_f(os.path.dirname(self.filename))
+                return self.save(filename, checksum=checksum, link=link)
             raise
 
-        if not tst:
+        if tst:
+            self._count_io('link', beg, getattr(self._file_stat(), 'st_size', 0))
+        else:
+            if link:
+                self._count('link-fallbacks')
             _copy_atomic(filename, self.filename)
+            self._count_io('copy', beg, getattr(self._file_stat(), 'st_size', 0))
+        self._count('save-objs')
         if checksum:
-            return self.checked_filename # Sets exists internally
+            ret = self.checked_filename # Sets exists internally
+        else:
+            self.exists = True
+            ret = self.filename
+
+        if ret is not None and self._store is not None:
+            self._store._saved(self, old)
+        return ret
+
+    def save_stream(self, data, chunk=1024 * 1024):
+        """ Save data, as the object, into the CAShe storage. The data is
+            checksummed as it is written to a temporary file next to the
+            object, and that is only renamed into place if it matches (or it
+            is saved into the packs, if it's small enough). Returns the
+            filename, or None if the checksum didn't match.
+
+        :param data: a file object to read the data from, or an iterable of
+                     strings of data (Eg. from a network download).
+        :param chunk: size of the reads from a file object
+        """
+        import tempfile
+        def _tmp():
+            try:
+                return tempfile.NamedTemporaryFile(dir=self.dirname)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                _makedirs_f(self.dirname)
+                return tempfile.NamedTemporaryFile(dir=self.dirname)
+
+        if hasattr(data, 'read'):
+            def _y_chunks(fo):
+                while True:
+                    buf = fo.read(chunk)
+                    if not buf:
+                        break
+                    yield buf
+            data = _y_chunks(data)
+
+        # Small objects are kept in memory, until they are too big to pack.
+        pack_size = 0
+        if self._store is not None:
+            pack_size = self._store._pack_size
+        bufs = []
+        size = 0
+        out = None
+
+        beg = time.time()
+        sums = Checksums([self.checksum_type])
+        for buf in data:
+            sums.update(buf)
+            size += len(buf)
+            if out is None and size < pack_size:
+                bufs.append(buf)
+                continue
+            if out is None:
+                out = _tmp()
+                for obuf in bufs:
+                    out.write(obuf)
+                bufs = None
+            out.write(buf)
+        if sums.hexdigest(self.checksum_type) != self.checksum_data:
+            self._count('checksum-failures')
+            if out is not None:
+                out.close() # Deletes it
+            return None
 
+        if out is None:
+            data = "".join(bufs)
+            if pack_size and not os.path.lexists(self.filename):
+                ret = self._pack_data(data, 'stream', beg)
+                if ret is not None:
+                    return ret
+            out = _tmp()
+            out.write(data)
+
+        out.flush()
+        os.chmod(out.name, 0644) # Same as a copy, with a normal umask.
+        old = None
+        if self._store is not None:
+            old = self._store._old_stat(self)
+        os.rename(out.name, self.filename)
+        out.delete = False
+        out.close()
+
+        del self.exists
+        self._file_stat()
         self.exists = True
+        self._count('save-objs')
+        self._count_io('stream', beg, size)
+        if self._store is not None:
+            self._store._saved(self, old)
         return self.filename
 
     def load(self, filename, checksum=False, link=None):
-        """ Load the object, from the CAShe storage, to a file.
+        """ Load the object, from the CAShe storage, to a file. Objects in a
+            pack are always copied out.
 
         :param filename: a string specifying the path to link/write to
         :param checksum: a boolean specifying if we should perform a
@@ -434,6 +1381,9 @@ class CASheFileObj(CASheObj):
         """
         if False:
             print "JDBG:", "load:", filename, checksum, link, self.link
+        if self._store is not None and self._store._absent(self):
+            self._count('load-misses')
+            return None
         if checksum: # FIXME: This can load it twice ... meh.
             if self.checked_filename is None:
                 return None
@@ -441,16 +1391,38 @@ class CASheFileObj(CASheObj):
         if link is None:
             link = self.link
         src = self.filename
+        beg = time.time()
         try:
             if link and _link_xdev(src, filename):
+                self._count('load-hits')
+                self._count_io('link', beg, self.size)
                 return src
         except OSError, e:
             if e.errno == errno.ENOENT:
-                return None
+                if self._moved():
+                    return self.load(filename, checksum=checksum, link=link)
+                ret = self._load_pack(filename, beg)
+                if ret is None:
+                    self._count('load-misses')
+                return ret
             raise
 
-        _copy_atomic(src, filename)
+        if link:
+            self._count('link-fallbacks')
+        try:
+            _copy_atomic(src, filename)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                if self._moved():
+                    return self.load(filename, checksum=checksum, link=link)
+                ret = self._load_pack(filename, beg)
+                if ret is not None:
+                    return ret
+                self._count('load-misses')
+            raise
         self.exists = True
+        self._count('load-hits')
+        self._count_io('copy', beg, self.size)
         return filename
 
     def get(self, *args, **kwargs):
@@ -463,89 +1435,2559 @@ class CASheFileObj(CASheObj):
 
     def unlink(self):
         """ Remove the checksummed object from the cache. """
-        if _unlink_f(self.filename):
-            _try_rmdir(self.dirname)
+        old = None
+        if self._store is not None:
+            old = self._store._old_stat(self)
+        done = False
+        for layout in self.layouts: # During a reshard, it could be in any.
+            fname = self._layoutFilename(layout)
+            if _unlink_f(fname):
+                _try_rmdirs(os.path.dirname(fname), layout[0])
+                done = True
+        if self._store is not None:
+            packs = self._store._pack(self.checksum_type)
+            if packs is not None and packs.remove(self.checksum_data):
+                done = True
+        if done and self._store is not None:
+            self._store._unlinked(self, old)
+        self._filename = None
         self.exists = False
 
-class CAShe(object):
-    # __slots__ = ['_objs', 'path', 'link']
+def _index_stat(size, nlink, atime, mtime, ctime, ino, dev):
+    """ Create a stat result, from the data in an index entry. """
+    return os.stat_result((0, ino, dev, nlink, 0, 0, size, atime, mtime, ctime))
 
-    def __init__(self, path="."):
-        self.path = path
-        if not os.path.exists(path):
-            os.makedirs(path)
+def _same_stat(st1, st2):
+    """ Is the stat data we keep in the index the same, the times are only
+        compared to the second as the index has them as text. """
+    return ((st1.st_size, st1.st_nlink, st1.st_ino, int(st1.st_atime),
+             int(st1.st_mtime)) ==
+            (st2.st_size, st2.st_nlink, st2.st_ino, int(st2.st_atime),
+             int(st2.st_mtime)))
 
-        self._objs = {}
-        for T in _checksum_d_len:
-            self._objs[T] = {}
+class CASheIndex(object):
+    """ On disk index of the stat data for the objects in the CAShe, so
+        cleanup/summary don't need to stat() every object. The file is a log
+        of lines, appended to by save/unlink. Each line is either:
 
-        self.link = True
+            type digest size nlink atime mtime ctime ino dev
+            type digest -
 
-    def __contains__(self, other):
-        T = other.checksum_type
-        if T not in self._objs:
+        ...the later being a removal, and later lines override earlier ones.
+        It is never authoritative, anything read from it should be re-stat'd
+        before acting on it. When reading it finds the log is mostly old
+        lines, it's rewritten with just the current entries. """
+
+    COMPACT = 4096 # Rewrite the log, when reading it, after this many lines
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _append(self, line):
+        return _append_log(self.filename, line)
+
+    @staticmethod
+    def _fmt(T, D, st):
+        return "%s %s %u %u %.9f %.9f %.9f %u %u\n" % (T, D, st.st_size,
+                                                       st.st_nlink,
+                                                       st.st_atime,
+                                                       st.st_mtime,
+                                                       st.st_ctime,
+                                                       st.st_ino, st.st_dev)
+
+    def add(self, obj, st=False):
+        """ Add (or update) the entry for an object. """
+        if st is False:
+            st = _stat_f(obj.filename)
+        if st is None:
+            return self.remove(obj)
+        return self._append(self._fmt(obj.checksum_type, obj.checksum_data, st))
+
+    def remove(self, obj):
+        """ Add a removal entry for an object. """
+        return self._append("%s %s -\n" % (obj.checksum_type,
+                                           obj.checksum_data))
+
+    def read(self, compact=True):
+        """ Return a dict of (type, digest) => stat result. """
+        ret = {}
+        try:
+            fo = open(self.filename)
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EACCES):
+                return ret
+            raise
+        lines = 0
+        for line in fo:
+            lines += 1
+            vals = line.split()
+            if len(vals) == 3 and vals[2] == '-':
+                ret.pop((vals[0], vals[1]), None)
+                continue
+            if len(vals) != 9:
+                continue # Partial write, ignore it.
+            try:
+                st = _index_stat(int(vals[2]), int(vals[3]), float(vals[4]),
+                                 float(vals[5]), float(vals[6]),
+                                 int(vals[7]), int(vals[8]))
+            except ValueError:
+                continue
+            ret[(vals[0], vals[1])] = st
+        fo.close()
+        if compact and lines > self.COMPACT and lines > 2 * len(ret):
+            try:
+                self._compact()
+            except EnvironmentError, e:
+                if e.errno not in (errno.EACCES, errno.EROFS, errno.ENOSPC):
+                    raise
+        return ret
+
+    def _compact(self):
+        """ Rewrite the log with just the current entries, holding the lock
+            so no appends are lost. """
+        lock = _lock_f(self.filename + ".lock")
+        if lock is None:
+            return
+        try:
+            entries = self.read(compact=False)
+            self._write(self._fmt(T, D, st)
+                        for (T, D), st in sorted(entries.iteritems()))
+        finally:
+            os.close(lock)
+
+    def _write(self, lines):
+        import tempfile
+        dname = os.path.dirname(self.filename)
+        if not os.path.exists(dname):
+            os.makedirs(dname)
+        out = tempfile.NamedTemporaryFile(dir=dname)
+        num = 0
+        for line in lines:
+            out.write(line)
+            num += 1
+        out.flush()
+        os.chmod(out.name, 0644)
+        os.rename(out.name, self.filename)
+        out.delete = False
+        out.close()
+        return num
+
+    def write(self, objs):
+        """ Atomically replace the index with the stat data from objs. """
+        def _lines():
+            for obj in objs:
+                if obj._stat is not None:
+                    yield self._fmt(obj.checksum_type, obj.checksum_data,
+                                    obj._stat)
+        _makedirs_f(os.path.dirname(self.filename))
+        lock = _lock_f(self.filename + ".lock")
+        try:
+            return self._write(_lines())
+        finally:
+            if lock is not None:
+                os.close(lock)
+
+class CASheUsage(object):
+    """ Journal of the number and size of the objects of each checksum type,
+        in meta/usage, so summary doesn't need to look at every object. Each
+        line is:
+
+            type objs size
+
+        ...and they are all added together, so save/unlink just append a line
+        with the change. The type "." is all the objects, with aliases only
+        counted once. The totals can drift (Eg. objects saved/removed by
+        something that doesn't update the journal), so anything that looks at
+        all the objects rewrites it with the real totals. """
+
+    COMPACT = 4096 # Rewrite the journal, when reading it, after this many lines
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def add(self, checksum_type, objs, size, alias=False):
+        """ Add to the totals for a checksum type (None for just the total of
+            all objects), and to the total of all objects unless alias. """
+        lines = []
+        if checksum_type is not None:
+            lines.append("%s %d %d\n" % (checksum_type, objs, size))
+        if not alias:
+            lines.append(". %d %d\n" % (objs, size))
+        if not lines or (not objs and not size):
+            return True
+        return _append_log(self.filename, "".join(lines))
+
+    @staticmethod
+    def _sum(totals, data):
+        lines = 0
+        for line in data.split("\n"):
+            vals = line.split()
+            if len(vals) != 3:
+                continue # Partial write, ignore it.
+            try:
+                objs, size = int(vals[1]), int(vals[2])
+            except ValueError:
+                continue
+            lines += 1
+            old = totals.get(vals[0], (0, 0))
+            totals[vals[0]] = (old[0] + objs, old[1] + size)
+        return lines
+
+    def _read(self):
+        """ Returns (totals, lines), totals is None if there is no journal. """
+        try:
+            fo = open(self.filename)
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EACCES):
+                return None, 0
+            raise
+        data = fo.read()
+        fo.close()
+        totals = {}
+        return totals, self._sum(totals, data)
+
+    def read(self):
+        """ Return a dict of checksum type => (objs, size), or None if there
+            is no journal. """
+        totals, lines = self._read()
+        if lines > self.COMPACT:
+            try:
+                self._compact()
+            except EnvironmentError, e:
+                if e.errno not in (errno.EACCES, errno.EROFS, errno.ENOSPC):
+                    raise
+        return totals
+
+    def _compact(self):
+        """ Rewrite the journal with just the totals, holding the lock so no
+            appends are lost. """
+        lock = _lock_f(self.filename + ".lock")
+        if lock is None:
+            return
+        try:
+            totals, lines = self._read()
+            if totals is not None:
+                self._write(totals)
+        finally:
+            os.close(lock)
+
+    def _write(self, totals):
+        import tempfile
+        dname = os.path.dirname(self.filename)
+        if not os.path.exists(dname):
+            os.makedirs(dname)
+        out = tempfile.NamedTemporaryFile(dir=dname)
+        for T in sorted(totals):
+            out.write("%s %d %d\n" % (T, totals[T][0], totals[T][1]))
+        out.flush()
+        os.chmod(out.name, 0644)
+        os.rename(out.name, self.filename)
+        out.delete = False
+        out.close()
+
+    def write(self, totals):
+        """ Atomically replace the journal with the totals. """
+        _makedirs_f(os.path.dirname(self.filename))
+        lock = _lock_f(self.filename + ".lock")
+        try:
+            self._write(totals)
+        finally:
+            if lock is not None:
+                os.close(lock)
+
+class CASheVerified(object):
+    """ Stamps of the stat data of objects when they were last checksummed,
+        in meta/verified/<type>/<bucket> files (so looking up an object only
+        reads a tiny file). Each file is a log of lines:
+
+            digest size ino dev mtime
+
+        ...later lines override earlier ones. If an object's stat data still
+        matches its stamp then nothing has changed it since it was checked, so
+        it doesn't need to be checksummed again. The ctime isn't used, as
+        loading an object by hardlinking it changes that. Lines are appended
+        like the usage journal, and a file that's mostly old lines is
+        rewritten holding its lock (see _append_log). """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def _filename(self, obj):
+        return "%s/%s/%s" % (self.dirname, obj.checksum_type,
+                             obj.checksum_data[:4])
+
+    @staticmethod
+    def _fmt(st):
+        return "%u %u %u %.9f" % (st.st_size, st.st_ino, st.st_dev,
+                                  st.st_mtime)
+
+    @staticmethod
+    def _read(filename):
+        """ Return a dict of digest => stamp, and the number of lines. """
+        ret = {}
+        num = 0
+        try:
+            fo = open(filename)
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EACCES):
+                return ret, num
+            raise
+        for line in fo:
+            num += 1
+            vals = line.rstrip("\n").split(" ", 1)
+            if len(vals) == 2:
+                ret[vals[0]] = vals[1]
+        fo.close()
+        return ret, num
+
+    def verified(self, obj, st):
+        """ Does the stat data of the object match its stamp. """
+        if st is None:
             return False
+        stamps, num = self._read(self._filename(obj))
+        return stamps.get(obj.checksum_data) == self._fmt(st)
 
-        D = other.checksum_data
-        if D not in self._objs[T]:
+    def add(self, obj, st):
+        """ Stamp the object as verified, with its current stat data. """
+        if st is None:
             return False
+        fname = self._filename(obj)
+        stamp = self._fmt(st)
+        try:
+            stamps, num = self._read(fname)
+            if num > len(stamps) * 2 + 8: # Mostly old lines, so rewrite it.
+                return self._compact(fname, obj.checksum_data, stamp)
+            if not num:
+                _makedirs_f(os.path.dirname(fname))
+                os.close(os.open(fname, os.O_WRONLY | os.O_CREAT, 0644))
+            return _append_log(fname, "%s %s\n" % (obj.checksum_data, stamp))
+        except EnvironmentError, e:
+            if e.errno in (errno.EACCES, errno.EROFS, errno.ENOSPC):
+                return False
+            raise
 
+    def _compact(self, fname, checksum_data, stamp):
+        """ Rewrite a file with just the latest stamps, and the new one,
+            holding the lock so no appends are lost. """
+        lock = _lock_f(fname + ".lock")
+        if lock is None:
+            return False
+        try:
+            stamps, num = self._read(fname)
+            stamps[checksum_data] = stamp
+            import tempfile
+            out = tempfile.NamedTemporaryFile(dir=os.path.dirname(fname))
+            for D in sorted(stamps):
+                out.write("%s %s\n" % (D, stamps[D]))
+            out.flush()
+            os.chmod(out.name, 0644)
+            os.rename(out.name, fname)
+            out.delete = False
+            out.close()
+        finally:
+            os.close(lock)
         return True
 
-    def get(self, checksum_type, checksum_data):
-        """ Get an object for the specified checksum.
+def _stat_ns(st, name):
+    """ A time from the stat data in nanoseconds, Eg. st_mtime_ns. """
+    ret = getattr(st, name + "_ns", None)
+    if ret is None:
+        ret = int(getattr(st, name) * 1000 * 1000 * 1000)
+    return ret
+
+class CASheHashes(object):
+    """ A cache of the checksums of files outside the CAShe (Eg. for merge
+        and save), so files which haven't changed aren't read again. Files
+        are keyed by their stat data (device, inode, size, mtime and ctime),
+        and the least recently used are evicted when there are more than
+        maxsize. The meta/hashes file is read when it's first needed, and
+        rewritten when the process exits (merged with what other processes
+        have written meanwhile, holding hashes.lock). Each line is:
+
+        dev ino size mtime_ns ctime_ns type:hexdigest [type:hexdigest ...]
+    """
+
+    def __init__(self, filename, maxsize=200 * 1000):
+        import threading
+        self.filename = filename
+        self.maxsize = maxsize
+        self._data = None
+        self._used = None # What we've looked up/added, in LRU order.
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._registered = False
 
-        :param checksum_type: a string specifying the type of checksum,
-                              Eg. md5, sha256
-        :param checksum_data: a string specifying the hexdigest of the checksum.
+    @staticmethod
+    def _key(st):
+        return (st.st_dev, st.st_ino, st.st_size,
+                _stat_ns(st, 'st_mtime'), _stat_ns(st, 'st_ctime'))
+
+    @staticmethod
+    def _read(filename):
+        """ Return an OrderedDict of key => {type : hexdigest}, oldest first.
         """
-        T = _checksum_aliases.get(checksum_type, checksum_type)
-        if T not in self._objs:
-            raise TypeError, "Not a valid Checksum Type: %s" % T
+        from collections import OrderedDict
+        ret = OrderedDict()
+        try:
+            fo = open(filename)
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EACCES):
+                return ret
+            raise
+        for line in fo:
+            vals = line.split()
+            if len(vals) < 6:
+                continue
+            try:
+                key = tuple([int(x) for x in vals[:5]])
+            except ValueError:
+                continue
+            sums = {}
+            for val in vals[5:]:
+                T, D = val.partition(':')[::2]
+                if len(D) == _checksum_d_len.get(T) and _valid_checksum_data(D):
+                    sums[T] = D
+            if sums:
+                ret.pop(key, None)
+                ret[key] = sums
+        return ret
 
-        if checksum_data not in self._objs[T]:
-            obj = CASheFileObj(self.path, checksum_type, checksum_data)
+    def _load(self):
+        if self._data is None:
+            from collections import OrderedDict
+            self._data = self._read(self.filename)
+            self._used = OrderedDict()
+
+    def _use(self, key, sums):
+        self._used.pop(key, None)
+        self._used[key] = sums
+        if not self._registered:
+            import atexit
+            self._registered = True
+            atexit.register(self.flush)
+
+    def get(self, st, checksum_type):
+        """ Return the hexdigest of the file with the stat data, or None. """
+        key = self._key(st)
+        self._lock.acquire()
+        try:
+            self._load()
+            sums = self._data.get(key)
+            if sums is None or checksum_type not in sums:
+                return None
+            self._use(key, sums)
+            return sums[checksum_type]
+        finally:
+            self._lock.release()
+
+    def add(self, st, checksum_type, checksum_data):
+        """ Save the hexdigest of the file with the stat data. """
+        key = self._key(st)
+        self._lock.acquire()
+        try:
+            self._load()
+            sums = self._data.get(key, {})
+            sums[checksum_type] = checksum_data
+            self._data[key] = sums
+            self._use(key, sums)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """ Merge what we've used into the file, evicting the least recently
+            used entries. Forked children don't save anything. """
+        if not self._used or os.getpid() != self._pid:
+            return False
+        # Other processes can't flush between our read and rename.
+        flock = _lock_f(self.filename + ".lock")
+        try:
+            return self._flush()
+        finally:
+            if flock is not None:
+                os.close(flock)
+
+    def _flush(self):
+        import tempfile
+        self._lock.acquire()
+        try:
+            data = self._read(self.filename)
+            for key, sums in self._used.iteritems():
+                old = data.pop(key, {})
+                old.update(sums)
+                data[key] = old
+            while len(data) > self.maxsize:
+                data.popitem(last=False)
+            self._used.clear()
+        finally:
+            self._lock.release()
+
+        try:
+            out = tempfile.NamedTemporaryFile(dir=os.path.dirname(self.filename))
+            for key, sums in data.iteritems():
+                vals = ["%s:%s" % (T, sums[T]) for T in sorted(sums)]
+                out.write("%u %u %u %u %u " % key + " ".join(vals) + "\n")
+            out.flush()
+            os.chmod(out.name, 0644)
+            os.rename(out.name, self.filename)
+            out.delete = False
+            out.close()
+        except EnvironmentError, e:
+            if e.errno in (errno.EACCES, errno.EROFS, errno.ENOSPC):
+                return False
+            raise
+        return True
+
+class CASheBloom(object):
+    """ Bloom filter of the digests of all the objects of a checksum type,
+        in meta/bloom-<type>. It's mmap'd, so it is shared by all the
+        processes using the CAShe, and a miss means the object definitely
+        isn't in the CAShe (without a stat()). Each bit is a byte, so
+        processes adding to the filter at the same time can't lose each
+        other's updates. Objects saved by anything that doesn't add to the
+        filter (Eg. rsync) will be missed until it's rebuilt by reindex, or
+        any full scan(). """
+
+    K       = 7  # Number of probes, for each digest
+    BITS    = 20 # Bytes per object, when sizing a new filter
+    RECHECK = 10 # Seconds between checking if the file has been replaced
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mm = None
+        self._ident = None
+        self._writable = False
+        self._checked = 0
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = None
+        self._ident = None
+
+    def _open(self, force=False):
+        """ mmap the file, again if it's been replaced. Returns False if there
+            isn't a filter. """
+        import mmap
+        now = time.time()
+        if not force and (now - self._checked) < self.RECHECK:
+            return self._mm is not None
+        self._checked = now
+
+        st = _stat_f(self.filename)
+        if st is None or not st.st_size:
+            self.close()
+            return False
+        if self._mm is not None and self._ident == (st.st_dev, st.st_ino):
+            return True
+
+        self.close()
+        try:
+            fd = os.open(self.filename, os.O_RDWR)
+            prot = mmap.PROT_READ | mmap.PROT_WRITE
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            if e.errno not in (errno.EACCES, errno.EROFS):
+                raise
+            fd = os.open(self.filename, os.O_RDONLY)
+            prot = mmap.PROT_READ
+        try:
+            st = os.fstat(fd)
+            if not st.st_size:
+                return False
+            self._mm = mmap.mmap(fd, st.st_size, mmap.MAP_SHARED, prot)
+        finally:
+            os.close(fd)
+        self._ident = (st.st_dev, st.st_ino)
+        self._writable = bool(prot & mmap.PROT_WRITE)
+        return True
+
+    def _probes(self, checksum_data, size):
+        # The digests are already random, so just use them as the hashes.
+        h1 = int(checksum_data[:8], 16)
+        h2 = int(checksum_data[8:16], 16) | 1
+        return [(h1 + num * h2) % size for num in xrange(self.K)]
+
+    def __contains__(self, checksum_data):
+        """ False if the object definitely isn't in the CAShe, True if it
+            might be (or there is no filter). """
+        if not self._open():
+            return True
+        mm = self._mm
+        for idx in self._probes(checksum_data, len(mm)):
+            if mm[idx] == "\0":
+                return False
+        return True
+
+    def add(self, checksum_data):
+        """ Add a digest to the filter, if there is one. If we can't write to
+            it then it's removed, as everyone would think the object isn't
+            there (until it's rebuilt). """
+        if not self._open(force=True):
+            return False
+        if not self._writable:
+            self.close()
+            _unlink_f(self.filename)
+            return False
+        mm = self._mm
+        for idx in self._probes(checksum_data, len(mm)):
+            mm[idx] = "\1"
+        return True
+
+    def bits(self):
+        """ Return a copy of the filter, or None if there isn't one. """
+        if not self._open(force=True):
+            return None
+        return self._mm[:]
+
+    def _merge(self, data, before):
+        """ Set the bits in data that have been added to the filter since
+            before (from .bits()), if they are the same size. """
+        if not self._open(force=True) or len(self._mm) != len(before):
+            return
+        mm = self._mm
+        chunk = 64 * 1024
+        for off in xrange(0, len(before), chunk):
+            buf = mm[off:off + chunk]
+            if buf == before[off:off + chunk]:
+                continue
+            for idx in xrange(len(buf)):
+                if buf[idx] != before[off + idx]:
+                    data[off + idx] = 1
+
+    def write(self, digests, num, before=None):
+        """ Atomically replace the filter, with one sized for num digests.
+            If before is the .bits() of the filter from before the digests
+            were read, then anything added to it since is kept (if the size
+            doesn't have to change). """
+        size = max(num * self.BITS, 64 * 1024)
+        if before is not None and size <= len(before) <= size * 4:
+            size = len(before)
+        data = bytearray(size)
+        for checksum_data in digests:
+            for idx in self._probes(checksum_data, size):
+                data[idx] = 1
+
+        import tempfile
+        dname = os.path.dirname(self.filename)
+        if not os.path.exists(dname):
+            os.makedirs(dname)
+        # Everything that can save objects has to be able to add to it.
+        mode = 0644 | (os.stat(os.path.dirname(dname)).st_mode & 0020)
+        out = tempfile.NamedTemporaryFile(dir=dname)
+        if before is not None: # As late as we can, anything after is lost.
+            self._merge(data, before)
+        out.write(data)
+        out.flush()
+        os.chmod(out.name, mode)
+        os.rename(out.name, self.filename)
+        out.delete = False
+        out.close()
+        self._checked = 0
+
+_def_pack = 4 * 1000 # Objects smaller than this are packed, by default
+_pack_max = 256 * 1000 * 1000 # Start a new pack when one gets this big
+
+class _CAShePack(object):
+    """ One pack of a CAShePacks, the data file and its mmap'd index. All
+        the calls are made holding the CAShePacks lock. """
+
+    def __init__(self, prefix, rec, logged):
+        self.prefix = prefix
+        self.logged = logged # Index is a log, in the order added
+        self.num = 0         # Records in the index
+        self._rec = rec
+        self._dlen = rec.size - 32
+        self._mm = None
+        self._ifd = None
+        self._dfd = None
+        self._writable = False
+        self._digests = {}   # Digest => record, for a log
+
+    def _index_name(self):
+        if self.logged:
+            return self.prefix + ".log"
+        return self.prefix + ".idx"
+    index_name = property(fget=lambda self: self._index_name(),
+                          doc="Full path to the index of the pack")
+
+    def open(self):
+        try:
+            self._ifd = os.open(self.index_name, os.O_RDWR)
+            self._writable = True
+        except OSError, e:
+            if e.errno not in (errno.EACCES, errno.EROFS):
+                raise
+            self._ifd = os.open(self.index_name, os.O_RDONLY)
+        self._dfd = os.open(self.prefix + ".pack", os.O_RDONLY)
+        self.update()
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        for fd in (self._ifd, self._dfd):
+            if fd is not None:
+                os.close(fd)
+        self._mm = self._ifd = self._dfd = None
+
+    def update(self):
+        """ mmap any records appended to the index (only logs grow). """
+        import mmap
+        if not self.logged and self._mm is not None:
+            return False
+        num = os.fstat(self._ifd).st_size / self._rec.size
+        if num <= self.num:
+            return False
+        prot = mmap.PROT_READ
+        if self._writable:
+            prot |= mmap.PROT_WRITE
+        mm = mmap.mmap(self._ifd, num * self._rec.size, mmap.MAP_SHARED, prot)
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = mm
+        if self.logged:
+            for recnum in xrange(self.num, num):
+                pos = recnum * self._rec.size
+                self._digests[mm[pos:pos + self._dlen]] = recnum
+        self.num = num
+        return True
+
+    def entry(self, recnum):
+        """ Return the (digest, offset, size, atime, mtime) of a record. """
+        return self._rec.unpack_from(self._mm, recnum * self._rec.size)
+
+    def set(self, recnum, size=None, atime=None, mtime=None):
+        """ Change a record in place, returns False if we can't write it. """
+        if not self._writable:
+            return False
+        digest, off, osize, oatime, omtime = self.entry(recnum)
+        if size is None:
+            size = osize
+        if atime is None:
+            atime = oatime
+        if mtime is None:
+            mtime = omtime
+        pos = recnum * self._rec.size
+        self._mm[pos:pos + self._rec.size] = self._rec.pack(digest, off, size,
+                                                            atime, mtime)
+        return True
+
+    def find(self, digest):
+        """ Return the record for a digest, or None if it isn't in the pack
+            (or was removed). """
+        if self.logged:
+            recnum = self._digests.get(digest)
+        else: # Binary search the sorted records.
+            rsize = self._rec.size
+            beg, end = 0, self.num
+            while beg < end:
+                mid = (beg + end) / 2
+                pos = mid * rsize
+                if self._mm[pos:pos + self._dlen] < digest:
+                    beg = mid + 1
+                else:
+                    end = mid
+            recnum = beg
+            pos = recnum * rsize
+            if recnum >= self.num or self._mm[pos:pos + self._dlen] != digest:
+                recnum = None
+        if recnum is None or self.entry(recnum)[2] == CAShePacks.DEAD:
+            return None
+        return recnum
+
+    def read(self, off, size):
+        """ Read data from the pack. """
+        os.lseek(self._dfd, off, os.SEEK_SET)
+        ret = []
+        while size > 0:
+            buf = os.read(self._dfd, size)
+            if not buf:
+                raise IOError(errno.EIO, "Short read in pack: " + self.prefix)
+            ret.append(buf)
+            size -= len(buf)
+        return "".join(ret)
+
+    def size(self):
+        """ Size of the data file. """
+        return os.fstat(self._dfd).st_size
+
+    def live(self):
+        """ Yield the (recnum, entry) of each object in the pack. """
+        for recnum in xrange(self.num):
+            entry = self.entry(recnum)
+            if entry[2] == CAShePacks.DEAD:
+                continue
+            if self.logged and self._digests[entry[0]] != recnum:
+                continue # Added again later, after being removed.
+            yield recnum, entry
+
+class CAShePacks(object):
+    """ Objects of a checksum type which are too small to be worth a file
+        each (see the "pack" key in the config file), stored in packs in
+        packs/<type>/. Each pack is N.pack, the data of the objects one after
+        another, and an index of fixed size records:
+
+            digest offset size atime mtime
+
+        ...with the digest as binary, and then big-endian 64bit numbers and
+        doubles. New objects are appended to the newest pack, and its index is
+        N.log (in the order they were added). Compaction rewrites those, and
+        packs with lots of removed objects, into packs whose index is N.idx
+        sorted by digest (which is mmap'd and binary searched). Removing an
+        object, or updating its atime, is done in place in its record (a
+        removed object has a size of DEAD). Appending and compacting are done
+        holding a lock on packs/<type>/lock. """
+
+    DEAD    = 2**64 - 1
+    RECHECK = 10 # Seconds between checking for new/compacted packs
+
+    def __init__(self, dirname, checksum_type):
+        import struct
+        import threading
+        self.dirname = dirname
+        self.checksum_type = checksum_type
+        self._rec = struct.Struct(">%usQQdd" %
+                                  (_checksum_d_len[checksum_type] / 2))
+        self._lock = threading.Lock()
+        self._packs = [] # Oldest first
+        self._ident = None
+        self._checked = 0
+
+    def close(self):
+        for pack in self._packs:
+            pack.close()
+        self._packs = []
+        self._ident = None
+        self._checked = 0
+
+    def _names(self):
+        """ Return a dict of (num, logged) => filename, for the indexes. """
+        ret = {}
+        for name in _listdir(self.dirname):
+            num, dot, ext = name.partition(".")
+            if num.isdigit() and ext in ("idx", "log"):
+                ret[(int(num), ext == "log")] = name
+        return ret
+
+    def _refresh(self, force=False):
+        """ Look for new/compacted packs (every RECHECK seconds, unless force),
+            and for records appended to the logs. """
+        now = time.time()
+        if not force and (now - self._checked) < self.RECHECK:
+            return
+        self._checked = now
+
+        st = _stat_f(self.dirname)
+        ident = None
+        if st is not None:
+            ident = (st.st_ino, st.st_mtime)
+        if ident == self._ident: # No packs added/removed, so just the logs.
+            for pack in self._packs:
+                pack.update()
+            return
+        self._ident = ident
+
+        old = dict([((pack.prefix, pack.logged), pack)
+                    for pack in self._packs])
+        packs = []
+        for num, logged in sorted(self._names()):
+            prefix = "%s/%u" % (self.dirname, num)
+            pack = old.pop((prefix, logged), None)
+            if pack is not None:
+                pack.update()
+                packs.append(pack)
+                continue
+            pack = _CAShePack(prefix, self._rec, logged)
+            try:
+                pack.open()
+            except OSError, e:
+                pack.close()
+                if e.errno != errno.ENOENT:
+                    raise
+                continue # Compacted, since the listdir.
+            packs.append(pack)
+        for pack in old.itervalues():
+            pack.close()
+        self._packs = packs
+
+    def _find(self, digest):
+        """ Return the (pack, recnum) for a digest, or None. """
+        for pack in reversed(self._packs):
+            recnum = pack.find(digest)
+            if recnum is not None:
+                return pack, recnum
+        return None
+
+    def _lookup(self, checksum_data):
+        """ Find an object, looking for new packs/records if we don't. """
+        import binascii
+        digest = binascii.unhexlify(checksum_data)
+        self._refresh()
+        ret = self._find(digest)
+        if ret is None:
+            self._refresh(force=True)
+            ret = self._find(digest)
+        return ret
+
+    def _lock_packs(self):
+        """ Take the lock for appending/compacting, returns the fd (closing
+            it unlocks). """
+        import fcntl
+        _makedirs_f(self.dirname)
+        fd = os.open(self.dirname + "/lock", os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def _stat(entry):
+        """ Create a stat result from a record, there is no inode. """
+        digest, off, size, atime, mtime = entry
+        return _index_stat(size, 1, atime, mtime, mtime, 0, 0)
+
+    def stat(self, checksum_data):
+        """ Return the stat result for an object, or None. """
+        self._lock.acquire()
+        try:
+            found = self._lookup(checksum_data)
+            if found is None:
+                return None
+            return self._stat(found[0].entry(found[1]))
+        finally:
+            self._lock.release()
+
+    def filename(self, checksum_data):
+        """ Return the filename of the pack of an object, or None. """
+        self._lock.acquire()
+        try:
+            found = self._lookup(checksum_data)
+            if found is None:
+                return None
+            return found[0].prefix + ".pack"
+        finally:
+            self._lock.release()
+
+    def read(self, checksum_data):
+        """ Return the data of an object, or None. """
+        self._lock.acquire()
+        try:
+            found = self._lookup(checksum_data)
+            if found is None:
+                return None
+            pack, recnum = found
+            digest, off, size, atime, mtime = pack.entry(recnum)
+            return pack.read(off, size)
+        finally:
+            self._lock.release()
+
+    def touch(self, checksum_data, atime=None, mtime=None):
+        """ Set the atime (default now), and mtime, of an object. Returns
+            False if it isn't in a pack. """
+        if atime is None:
+            atime = time.time()
+        self._lock.acquire()
+        try:
+            found = self._lookup(checksum_data)
+            if found is None:
+                return False
+            return found[0].set(found[1], atime=atime, mtime=mtime)
+        finally:
+            self._lock.release()
+
+    def add(self, checksum_data, data):
+        """ Append an object to the newest pack, if it isn't already in one.
+            Returns the filename of the pack. """
+        import binascii
+        digest = binascii.unhexlify(checksum_data)
+        lock = self._lock_packs()
+        self._lock.acquire()
+        try:
+            self._refresh(force=True)
+            found = self._find(digest)
+            if found is not None:
+                return found[0].prefix + ".pack"
+
+            if (not self._packs or not self._packs[-1].logged or
+                self._packs[-1].size() >= _pack_max):
+                self._new_pack()
+            pack = self._packs[-1]
+
+            fd = os.open(pack.prefix + ".pack", os.O_WRONLY | os.O_APPEND)
+            try:
+                off = os.fstat(fd).st_size
+                buf = data
+                while buf:
+                    buf = buf[os.write(fd, buf):]
+            finally:
+                os.close(fd)
+
+            now = time.time()
+            fd = os.open(pack.index_name, os.O_WRONLY | os.O_APPEND)
+            try:
+                size = os.fstat(fd).st_size
+                if size % self._rec.size: # Partial write, from a crash.
+                    os.ftruncate(fd, size - (size % self._rec.size))
+                os.write(fd, self._rec.pack(digest, off, len(data), now, now))
+            finally:
+                os.close(fd)
+            pack.update()
+            return pack.prefix + ".pack"
+        finally:
+            self._lock.release()
+            os.close(lock) # Unlocks
+
+    def _new_pack(self):
+        """ Create an empty pack, with a log, to append to. """
+        nums = [int(name.partition(".")[0])
+                for name in _listdir(self.dirname)
+                if name.partition(".")[0].isdigit()]
+        num = max(nums or [0]) + 1
+        for ext in ("pack", "log"):
+            fd = os.open("%s/%u.%s" % (self.dirname, num, ext),
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            os.close(fd)
+        self._refresh(force=True)
+        return num
+
+    def remove(self, checksum_data):
+        """ Mark an object as removed, returns its stat result or None if it
+            wasn't in a pack. The space is reclaimed by .compact(). """
+        if self.stat(checksum_data) is None: # Don't lock for non-objects.
+            return None
+        lock = self._lock_packs()
+        self._lock.acquire()
+        try:
+            self._refresh(force=True)
+            found = self._lookup(checksum_data)
+            if found is None:
+                return None
+            pack, recnum = found
+            ret = self._stat(pack.entry(recnum))
+            if not pack.set(recnum, size=self.DEAD):
+                return None
+            return ret
+        finally:
+            self._lock.release()
+            os.close(lock) # Unlocks
+
+    def ls(self):
+        """ Return a list of (checksum_data, stat result) for all the objects
+            in the packs. """
+        import binascii
+        self._lock.acquire()
+        try:
+            self._refresh(force=True)
+            ret = []
+            for pack in self._packs:
+                for recnum, entry in pack.live():
+                    ret.append((binascii.hexlify(entry[0]), self._stat(entry)))
+            return ret
+        finally:
+            self._lock.release()
+
+    def compact(self):
+        """ Rewrite the packs being appended to, packs where at least a
+            quarter of the data has been removed and (if there is more than
+            one) small packs, into packs with sorted indexes. Returns the
+            number of bytes freed. """
+        import tempfile
+        if not os.path.isdir(self.dirname):
+            return 0
+        lock = self._lock_packs()
+        self._lock.acquire()
+        try:
+            self._refresh(force=True)
+            # Data files without an index are from an interrupted compaction.
+            names = self._names()
+            for name in _listdir(self.dirname):
+                num, dot, ext = name.partition(".")
+                if (num.isdigit() and ext == "pack" and
+                    (int(num), False) not in names and
+                    (int(num), True) not in names):
+                    _unlink_f("%s/%s" % (self.dirname, name))
+
+            small = [pack for pack in self._packs
+                     if not pack.logged and pack.size() < _pack_max / 16]
+            old = []
+            entries = {}
+            for pack in reversed(self._packs): # Newest wins, for duplicates.
+                live = list(pack.live())
+                used = sum([entry[2] for recnum, entry in live])
+                if not (pack.logged or (len(small) > 1 and pack in small) or
+                        (pack.size() - used) * 4 >= pack.size() > 0):
+                    continue
+                old.append(pack)
+                for recnum, entry in live:
+                    if entry[0] not in entries:
+                        entries[entry[0]] = (entry, pack)
+            if not old:
+                return 0
+
+            freed = sum([pack.size() + os.fstat(pack._ifd).st_size
+                         for pack in old])
+            num = max([int(name.partition(".")[0])
+                       for name in _listdir(self.dirname)
+                       if name.partition(".")[0].isdigit()] or [0])
+            digests = sorted(entries)
+            pos = 0
+            while pos < len(digests):
+                num += 1
+                dout = tempfile.NamedTemporaryFile(dir=self.dirname)
+                iout = tempfile.NamedTemporaryFile(dir=self.dirname)
+                off = 0
+                while pos < len(digests) and off < _pack_max:
+                    entry, pack = entries[digests[pos]]
+                    pos += 1
+                    digest, ooff, size, atime, mtime = entry
+                    dout.write(pack.read(ooff, size))
+                    iout.write(self._rec.pack(digest, off, size, atime, mtime))
+                    off += size
+                for out, ext in ((dout, "pack"), (iout, "idx")):
+                    out.flush()
+                    os.chmod(out.name, 0644)
+                    os.rename(out.name, "%s/%u.%s" % (self.dirname, num, ext))
+                    out.delete = False
+                    out.close()
+                freed -= off + os.path.getsize("%s/%u.idx" % (self.dirname,
+                                                              num))
+
+            for pack in old:
+                _unlink_f(pack.index_name)
+                _unlink_f(pack.prefix + ".pack")
+            self._refresh(force=True)
+            return freed
+        finally:
+            self._lock.release()
+            os.close(lock) # Unlocks
+
+_numpy_mod = False
+def _numpy():
+    """ Return the numpy module, or None if it isn't installed. """
+    global _numpy_mod
+    if _numpy_mod is False:
+        try:
+            import numpy as _numpy_mod
+        except ImportError:
+            _numpy_mod = None
+    return _numpy_mod
+
+class CASheSnapshot(object):
+    """ Stat data for the objects in the CAShe, stored in compact arrays (one
+        per column) instead of an object and stat result for each object. Each
+        object is a row, and the digests are stored packed. If numpy is
+        installed it's used to work on the columns. """
+
+    USED = 0
+    NEW  = 1
+    OLD  = 2
+    DUP  = 4 # Flag for an alias, of an earlier row
+
+    def __init__(self):
+        from array import array
+        # Want 64bit, and Python-2 doesn't have 'Q'.
+        u64 = 'L'
+        if array(u64).itemsize < 8:
+            u64 = 'd'
+
+        self.types   = sorted(_checksum_d_len)
+        self._tnum   = dict([(T, num) for num, T in enumerate(self.types)])
+        self.type    = array('B')
+        self.doff    = array(u64) # Offset of the digest in .digests
+        self.digests = bytearray()
+        self.size    = array(u64)
+        self.nlink   = array(u64)
+        self.atime   = array('d')
+        self.mtime   = array('d')
+        self.ctime   = array('d')
+        self.ino     = array(u64)
+        self.dev     = array(u64)
+
+    def __len__(self):
+        return len(self.type)
+
+    def append(self, checksum_type, checksum_data, st):
+        """ Add a row for an object. """
+        import binascii
+        self.type.append(self._tnum[checksum_type])
+        self.doff.append(len(self.digests))
+        self.digests.extend(binascii.unhexlify(checksum_data))
+        self.size.append(st.st_size)
+        self.nlink.append(st.st_nlink)
+        self.atime.append(st.st_atime)
+        self.mtime.append(st.st_mtime)
+        self.ctime.append(st.st_ctime)
+        self.ino.append(st.st_ino)
+        self.dev.append(st.st_dev)
+
+    def set(self, row, st):
+        """ Update the stat data for a row, a removed object (st is None) is
+            left as an empty row. """
+        if st is None:
+            st = _index_stat(0, 1, 0, 0, 0, 0, 0)
+        self.size[row]  = st.st_size
+        self.nlink[row] = st.st_nlink
+        self.atime[row] = st.st_atime
+        self.mtime[row] = st.st_mtime
+        self.ctime[row] = st.st_ctime
+        self.ino[row]   = st.st_ino
+        self.dev[row]   = st.st_dev
+
+    def digest(self, row):
+        """ Return the (checksum_type, digest) for a row, the digest is the
+            binary data (not hex). """
+        T = self.types[self.type[row]]
+        off = int(self.doff[row])
+        end = off + _checksum_d_len[T] / 2
+        return T, str(self.digests[off:end])
+
+    def checksum(self, row):
+        """ Return the (checksum_type, checksum_data) for a row. """
+        import binascii
+        T, digest = self.digest(row)
+        return T, binascii.hexlify(digest)
+
+    def stat(self, row):
+        """ Return a stat result for a row. """
+        return _index_stat(int(self.size[row]), int(self.nlink[row]),
+                           self.atime[row], self.mtime[row], self.ctime[row],
+                           int(self.ino[row]), int(self.dev[row]))
+
+    def obj(self, cashe, row):
+        """ Return an object for a row, from the CAShe, with the stat data. """
+        T, D = self.checksum(row)
+        obj = cashe._get(T, D, cache=False)
+        obj._stat = self.stat(row)
+        return obj
+
+    def _col(self, name):
+        """ Return the column as a numpy array (no copy). """
+        col = getattr(self, name)
+        return _numpy().frombuffer(col, dtype=col.typecode)
+
+    def alias_groups(self):
+        """ Return a dict of row => rows in the group, for all the objects that
+            share an inode (aliases). Only objects with more than one link can
+            be aliases, so only they are looked at. """
+        np = _numpy()
+        if np is not None:
+            rows = np.nonzero(self._col('nlink') > 1)[0].tolist()
+        else:
+            rows = [row for row in xrange(len(self)) if self.nlink[row] > 1]
+
+        groups = {}
+        for row in rows:
+            key = (self.dev[row], self.ino[row])
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(row)
+
+        ret = {}
+        for rows in groups.itervalues():
+            if len(rows) < 2:
+                continue
+            for row in rows:
+                ret[row] = rows
+        return ret
+
+    def states(self, sort_by, age, now, groups=None):
+        """ Return the state (.USED/.NEW/.OLD, and .DUP) of each row, as an
+            array. Links from aliases don't count as used. """
+        if groups is None:
+            groups = self.alias_groups()
+
+        old = now - age
+        np = _numpy()
+        if np is not None:
+            naliases = np.ones(len(self))
+            for row, rows in groups.iteritems():
+                naliases[row] = len(rows)
+            used = self._col('nlink') > naliases
+            state = np.where(self._col(sort_by) < old, self.OLD, self.NEW)
+            state[used] = self.USED
+            state = state.astype(np.uint8)
+        else:
+            from array import array
+            state = array('B', [self.NEW]) * len(self)
+            times = getattr(self, sort_by)
+            for row in xrange(len(self)):
+                nlink = self.nlink[row]
+                if nlink > 1 and nlink > len(groups.get(row, (row,))):
+                    state[row] = self.USED
+                elif times[row] < old:
+                    state[row] = self.OLD
+
+        for row, rows in groups.iteritems():
+            if row != rows[0]:
+                state[row] |= self.DUP
+        return state
+
+    def summary(self, sort_by, age, now, checksum_type=None, prefix=None):
+        """ Return a dict of checksum type => dict of the number and size of
+            the used, free and free-old objects. The type "." is the totals
+            for all types, where aliases are only counted once. """
+        groups = self.alias_groups()
+        state = self.states(sort_by, age, now, groups)
+        keys = ((self.USED, 'used-objs', 'used-size'),
+                (self.NEW,  'free-objs', 'free-size'),
+                (self.OLD,  'free-objs-old', 'free-size-old'))
+
+        ret = {}
+        def _data(T):
+            if T not in ret:
+                ret[T] = {}
+                for val, okey, skey in keys:
+                    ret[T][okey] = 0
+                    ret[T][skey] = 0
+            return ret[T]
+        _data('.')
+
+        tnum = None
+        if checksum_type is not None:
+            tnum = self._tnum.get(checksum_type, -1)
+        def _want(row):
+            if tnum is not None and self.type[row] != tnum:
+                return False
+            if prefix is not None:
+                return self.checksum(row)[1].startswith(prefix)
+            return True
+
+        rows = None
+        if prefix is not None:
+            rows = [row for row in xrange(len(self)) if _want(row)]
+
+        # Only the first alias that we want counts in the totals.
+        dups = set()
+        for row, grows in groups.iteritems():
+            if row != grows[0]:
+                continue
+            grows = [grow for grow in grows if _want(grow)]
+            dups.update(grows[1:])
+
+        np = _numpy()
+        if np is not None:
+            tcol = self._col('type')
+            mask = np.ones(len(self), dtype=bool)
+            if rows is not None:
+                mask[:] = False
+                mask[rows] = True
+            if tnum is not None:
+                mask &= tcol == tnum
+            dmask = np.ones(len(self), dtype=bool)
+            dmask[list(dups)] = False
+            size = self._col('size')
+            state = state & 3
+            for num, T in enumerate(self.types):
+                tmask = mask & (tcol == num)
+                if not tmask.any():
+                    continue
+                for val, okey, skey in keys:
+                    smask = tmask & (state == val)
+                    _data(T)[okey] += int(np.count_nonzero(smask))
+                    _data(T)[skey] += int(size[smask].sum())
+                    smask &= dmask
+                    _data('.')[okey] += int(np.count_nonzero(smask))
+                    _data('.')[skey] += int(size[smask].sum())
+            return ret
+
+        if rows is None:
+            rows = [row for row in xrange(len(self)) if _want(row)]
+        for row in rows:
+            T = self.types[self.type[row]]
+            val, okey, skey = keys[state[row] & 3]
+            _data(T)[okey] += 1
+            _data(T)[skey] += int(self.size[row])
+            if row not in dups:
+                _data('.')[okey] += 1
+                _data('.')[skey] += int(self.size[row])
+        return ret
+
+    def select(self, rows, size, cutoff, sort_by):
+        """ Yield the rows, oldest first, until their total size is at/under
+            the cutoff. """
+        if size <= cutoff or not len(rows):
+            return
+
+        np = _numpy()
+        if np is not None:
+            rows = np.asarray(rows)
+            order = np.argsort(self._col(sort_by)[rows], kind='mergesort')
+            csum = np.cumsum(self._col('size')[rows][order])
+            num = int(np.searchsorted(csum, size - cutoff)) + 1
+            for row in rows[order[:num]].tolist():
+                yield row
+            return
+
+        times = getattr(self, sort_by)
+        items = [(times[row], self.size[row], num, row)
+                 for num, row in enumerate(rows)]
+        for item in _evict_select(items, size, cutoff):
+            yield item[3]
+
+class _ObjTable(object):
+    """ Table of checksum data => objects, which only keeps the most recently
+        used objects (so it's memory usage is bounded). """
+
+    def __init__(self, maxsize):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        obj = self._data.pop(key, None)
+        if obj is not None:
+            self._data[key] = obj
+        return obj
+
+    def add(self, key, obj):
+        self._data[key] = obj
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+class CASheStats(object):
+    """ Counters for what the CAShe is doing, Eg. hits/misses for load and
+        bytes linked vs. copied. Each process saves its counters into a shard
+        file under meta/stats/ (if that directory exists) when it exits, and
+        reading the stats merges all the shards. Shards from processes that
+        have exited are merged into the "total" file, under a lock. """
+
+    def __init__(self, dirname):
+        import threading
+        self.dirname = dirname
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._shard = None
+        self._registered = False
+
+    def add(self, name, num=1):
+        """ Add num to the named counter. """
+        self._lock.acquire()
+        self.counts[name] = self.counts.get(name, 0) + num
+        self._lock.release()
+        if not self._registered:
+            import atexit
+            self._registered = True
+            atexit.register(self.flush)
+
+    def _shard_name(self):
+        if self._shard is None:
+            import socket
+            self._shard = "%s-%u-%u" % (socket.gethostname(), self._pid,
+                                        int(time.time() * 1000))
+        return self._shard
+
+    @staticmethod
+    def _read(filename):
+        import json
+        try:
+            return json.load(open(filename))
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EACCES):
+                return {}
+            raise
+        except ValueError:
+            return {}
+
+    @staticmethod
+    def _merge(counts, data):
+        for name, num in data.iteritems():
+            counts[str(name)] = counts.get(str(name), 0) + num
+
+    def _write(self, filename, counts):
+        import json
+        import tempfile
+        out = tempfile.NamedTemporaryFile(dir=self.dirname)
+        json.dump(counts, out, sort_keys=True)
+        out.flush()
+        os.chmod(out.name, 0644)
+        os.rename(out.name, filename)
+        out.delete = False
+        out.close()
+
+    def flush(self):
+        """ Save our counters into our shard file. Forked children don't save
+            anything, as they have a copy of the parent's counters. """
+        if not self.counts or os.getpid() != self._pid:
+            return False
+        if not os.path.isdir(self.dirname):
+            return False
+        self._lock.acquire()
+        counts = self.counts.copy()
+        self._lock.release()
+        try:
+            self._write("%s/%s" % (self.dirname, self._shard_name()), counts)
+        except EnvironmentError, e:
+            if e.errno in (errno.EACCES, errno.EROFS, errno.ENOSPC):
+                return False
+            raise
+        return True
+
+    def _dead(self, shard):
+        """ Is the shard from a process, on this host, that has exited. """
+        import socket
+        vals = shard.rsplit('-', 2)
+        if len(vals) != 3 or vals[0] != socket.gethostname():
+            return False
+        try:
+            os.kill(int(vals[1]), 0)
+        except ValueError:
+            return False
+        except OSError, e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def read(self):
+        """ Return a dict of all the counters, from all the processes. """
+        import fcntl
+        counts = self.counts.copy()
+        if not os.path.isdir(self.dirname):
+            return counts
+
+        ours = self._shard
+        try:
+            lock = open("%s/lock" % self.dirname, "a")
+        except IOError, e:
+            if e.errno not in (errno.EACCES, errno.EROFS):
+                raise
+            lock = None
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            total = self._read("%s/total" % self.dirname)
+            dead = []
+            for shard in _listdir(self.dirname):
+                if shard in ("lock", "total", ours) or shard.startswith("tmp"):
+                    continue
+                data = self._read("%s/%s" % (self.dirname, shard))
+                if lock is not None and self._dead(shard):
+                    self._merge(total, data)
+                    dead.append(shard)
+                else:
+                    self._merge(counts, data)
+            if dead:
+                self._write("%s/total" % self.dirname, total)
+                for shard in dead:
+                    _unlink_f("%s/%s" % (self.dirname, shard))
+        finally:
+            if lock is not None:
+                lock.close() # Unlocks
+        self._merge(counts, total)
+        return counts
+
+    def reset(self):
+        """ Remove all the saved counters, and ours. """
+        self._lock.acquire()
+        self.counts = {}
+        self._lock.release()
+        for shard in _listdir(self.dirname):
+            if shard != "lock":
+                _unlink_f("%s/%s" % (self.dirname, shard))
+
+class CAShe(object):
+    # __slots__ = ['_objs', 'path', 'link']
+
+    def __init__(self, path=".", max_objs=10000):
+        """ Access the CAShe storage at path.
+
+        :param path: a string specifying the path to the storage
+        :param max_objs: the number of objects to keep, from .get(), so they
+                         can be returned again (and with their stat data).
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self._objs = {}
+        for T in _checksum_d_len:
+            self._objs[T] = _ObjTable(max_objs)
+
+        self.link = True
+        self.threads = 8
+        self._layouts_ident = self._layouts_stat()
+        self._layouts = _read_layouts(path)
+
+        self._pack_size = 0 # Save objects smaller than this into packs
+        self._packs = None
+        if os.path.exists(path + "/packs"):
+            self._pack_size = self._get_config_pack()
+            self._packs = {}
+
+        self._index = None
+        if os.path.exists(self._meta_path("index")):
+            self._index = CASheIndex(self._meta_path("index"))
+
+        self._stats = CASheStats(self._meta_path("stats"))
+        self._blooms = {}
+        self._verified = CASheVerified(self._meta_path("verified"))
+
+        self._hashes = None # Only looked for when needed, see checksum_file
+
+        self._usage = None
+        if os.path.exists(self._meta_path("usage")):
+            self._usage = CASheUsage(self._meta_path("usage"))
+
+        self._daemon = None
+        if os.path.exists(self._meta_path("sock")):
+            self._daemon = CASheClient(self._meta_path("sock"))
+
+    def _meta_path(self, name):
+        """ Path to a file of metadata about the objects, this is all just a
+            cache and can be deleted at any time. """
+        return "%s/meta/%s" % (self.path, name)
+
+    def _bloom(self, checksum_type):
+        """ The CASheBloom for a checksum type, it might not exist. """
+        if checksum_type not in self._blooms:
+            fname = self._meta_path("bloom-" + checksum_type)
+            self._blooms[checksum_type] = CASheBloom(fname)
+        return self._blooms[checksum_type]
+
+    def _absent(self, obj):
+        """ True if the object definitely isn't in the cache. """
+        bloom = self._bloom(obj.checksum_type)
+        return obj.checksum_data not in bloom
+
+    def _write_blooms(self, snap, checksum_type=None, create=False,
+                      befores=None):
+        """ Rebuild the bloom filters that exist from a full snapshot, or
+            create those that don't exist if create is True. Returns the
+            number written.
+
+        :param befores: dict of type => .bits() of the filter, from before the
+                        snapshot was taken (see CASheBloom.write)
+        """
+        if befores is None:
+            befores = {}
+        num = 0
+        for T in sorted(self._objs):
+            if checksum_type is not None and checksum_type != T:
+                continue
+            bloom = self._bloom(T)
+            if create == os.path.exists(bloom.filename):
+                continue
+            tnum = snap._tnum[T]
+            rows = [row for row in xrange(len(snap)) if snap.type[row] == tnum]
+            try:
+                bloom.write((snap.checksum(row)[1] for row in rows), len(rows),
+                            befores.get(T))
+            except EnvironmentError, e:
+                if create or e.errno not in (errno.EACCES, errno.EROFS):
+                    raise
+                continue
+            num += 1
+        return num
+
+    def _pack(self, checksum_type):
+        """ The CAShePacks for a checksum type, or None if there are no packs
+            (packs/ doesn't exist). """
+        if self._packs is None:
+            return None
+        if checksum_type not in self._packs:
+            dname = "%s/packs/%s" % (self.path, checksum_type)
+            self._packs.setdefault(checksum_type,
+                                   CAShePacks(dname, checksum_type))
+        return self._packs[checksum_type]
+
+    def _pack_stat(self, obj):
+        """ The stat data of an object in a pack, or None. """
+        packs = self._pack(obj.checksum_type)
+        if packs is None:
+            return None
+        return packs.stat(obj.checksum_data)
+
+    def _stat(self, obj, ignore_EACCES=False):
+        """ The stat data of an object, from its file or its pack, or None. """
+        st = _stat_f(obj.filename, ignore_EACCES=ignore_EACCES)
+        if st is None:
+            st = self._pack_stat(obj)
+        return st
+
+    def _old_stat(self, obj):
+        """ Called before an object is saved/removed, returns the stat data
+            of what is there now (only if the usage journal needs it). """
+        if self._usage is None:
+            return None
+        return self._stat(obj)
+
+    def _saved(self, obj, old=None, alias=False):
+        """ Called after an object has been saved into the cache. """
+        self._bloom(obj.checksum_type).add(obj.checksum_data)
+        if self._index is not None or self._usage is not None:
+            obj._stat = self._stat(obj)
+        if self._index is not None:
+            self._index.add(obj, obj._stat)
+        if self._usage is not None and obj._stat is not None:
+            if old is None:
+                self._usage.add(obj.checksum_type, 1, obj._stat.st_size, alias)
+            elif old.st_ino != obj._stat.st_ino:
+                self._usage.add(obj.checksum_type, 0,
+                                obj._stat.st_size - old.st_size, alias)
+        self._daemon_call('update', obj.checksum_type, obj.checksum_data)
+
+    def _unlinked(self, obj, old=None):
+        """ Called after an object has been removed from the cache. """
+        if self._index is not None:
+            self._index.remove(obj)
+        if self._usage is not None and old is not None:
+            self._usage.add(obj.checksum_type, -1, -old.st_size)
+        self._daemon_call('update', obj.checksum_type, obj.checksum_data)
+
+    def _write_usage(self, snap, create=False):
+        """ Rewrite the usage journal from a snapshot of all the objects, if
+            it exists unless create is True. Returns the totals. """
+        Ts = snap.summary('atime', 0, 0)
+        totals = {}
+        for T in Ts:
+            totals[T] = (Ts[T]['used-objs'] + Ts[T]['free-objs'],
+                         Ts[T]['used-size'] + Ts[T]['free-size'])
+        if not create and self._usage is None:
+            return totals
+        usage = CASheUsage(self._meta_path("usage"))
+        try:
+            usage.write(totals)
+        except EnvironmentError, e:
+            if e.errno not in (errno.EACCES, errno.EROFS, errno.ENOSPC):
+                raise
+            return totals
+        self._usage = usage
+        return totals
+
+    def usage(self, exact=False):
+        """ Return a dict of checksum type => (objs, size), for all the objects
+            in the cache ("." is all the objects, with aliases counted once).
+            This is read from the usage journal, unless exact is True or there
+            isn't one, in which case all the objects are looked at (and the
+            journal is rewritten/created).
+
+        :param exact: a boolean specifying if we should look at all the objects
+        """
+        if not exact and self._usage is not None:
+            totals = self._usage.read()
+            if totals is not None:
+                return totals
+        return self._write_usage(self.scan(), create=True)
+
+    def stats(self):
+        """ Return a dict of counters, for what all the users of the CAShe
+            have done (if meta/stats/ exists, otherwise just this process).
+            The counters are:
+
+            load-hits/load-misses: calls to load() which did/didn't find the
+                                   object.
+            save-objs: objects saved.
+            link-objs/link-bytes/link-secs: data loaded/saved by linking.
+            copy-objs/copy-bytes/copy-secs: data loaded/saved by copying.
+            stream-objs/stream-bytes/stream-secs: data saved by save_stream().
+            pack-objs/pack-bytes/pack-secs: data loaded/saved from/to packs.
+            link-fallbacks: links that failed (EXDEV/EMLINK), so copied.
+            checksum-objs/checksum-bytes/checksum-secs: checksums of objects.
+            checksum-failures: objects that didn't match their checksum.
+            checksum-skips: checksums skipped, as the object hadn't changed
+                            since it was last checksummed.
+            hash-cache-hits/hash-cache-misses: files outside the cache that
+                                               were/weren't in the hash cache.
+        """
+        return self._stats.read()
+
+    def _daemon_call(self, name, *args):
+        """ Call a method on the daemon (if there is one), returns a tuple of
+            (True, result) or (False, None) if the daemon isn't running. """
+        if self._daemon is None:
+            return False, None
+        try:
+            return True, getattr(self._daemon, name)(*args)
+        except EnvironmentError, e: # Not running, or went away.
+            if e.errno != errno.EPERM: # Not allowed, but it's still there.
+                self._daemon = None
+            return False, None
+
+    def _cached_stat(self, obj):
+        """ Lookup the stat data for an object from the bloom filter or the
+            daemon, None if it doesn't exist or False if they don't know. """
+        if self._absent(obj):
+            return None
+        ok, st = self._daemon_call('lookup', obj.checksum_type,
+                                   obj.checksum_data)
+        if not ok:
+            return False
+        return st
+
+    def __contains__(self, other):
+        T = other.checksum_type
+        if T not in self._objs:
+            return False
+
+        D = other.checksum_data
+        if D not in self._objs[T]:
+            return False
+
+        return True
+
+    def get(self, checksum_type, checksum_data):
+        """ Get an object for the specified checksum.
+
+        :param checksum_type: a string specifying the type of checksum,
+                              Eg. md5, sha256
+        :param checksum_data: a string specifying the hexdigest of the checksum.
+        """
+        return self._get(checksum_type, checksum_data)
+
+    def _get(self, checksum_type, checksum_data, cache=True):
+        """ Get an object, but only add it to the table of objects if cache
+            is True. """
+        T = _checksum_aliases.get(checksum_type, checksum_type)
+        if T not in self._objs:
+            raise TypeError, "Not a valid Checksum Type: %s" % T
+
+        obj = self._objs[T].get(checksum_data.lower())
+        if obj is None:
+            obj = CASheFileObj(self.path, T, checksum_data)
             obj.link = self.link
-            self._objs[T][obj.checksum_data] = obj
-        return self._objs[T][checksum_data]
+            obj.layouts = self._layouts
+            obj._store = self
+            if cache:
+                self._objs[T].add(obj.checksum_data, obj)
+        return obj
+
+    def _y_buckets(self, items, create=False):
+        """ Group (num, obj, arg) items by their bucket directory, yielding
+            (fd, exists, items) for each bucket. So a bucket is only looked at
+            once, not for every object in it, and when fd isn't None the
+            objects in it can be looked at by name with the *at() calls (see
+            _fstatat). exists is False only if the bucket isn't there, after
+            re-reading the layouts (like CASheFileObj._moved). Missing buckets
+            are created if create is True. """
+        use_at = len(self._layouts) == 1 and _at_calls() is not None
+        buckets = {}
+        dirnames = []
+        for item in items:
+            dirname = item[1].dirname
+            if dirname not in buckets:
+                buckets[dirname] = []
+                dirnames.append(dirname)
+            buckets[dirname].append(item)
+
+        for dirname in dirnames:
+            items = buckets[dirname]
+            fd = None
+            exists = True
+            try:
+                if create:
+                    _makedirs_f(dirname)
+                if use_at:
+                    fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+                elif not create:
+                    os.stat(dirname)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    raise
+                if e.errno != errno.EACCES:
+                    self._reread_layouts()
+                    exists = len(self._layouts) > 1
+                    for num, obj, arg in items:
+                        if obj.layouts != self._layouts: # Reshard
+                            exists = True
+            try:
+                yield fd, exists, items
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def get_many(self, checksums):
+        """ Get objects for many checksums, and look them all up in the
+            cache (so .exists, .size etc. don't need to). This is done a bucket
+            directory at a time, see _y_buckets. Returns a list of the
+            objects, in the same order.
+
+        :param checksums: an iterable of (checksum_type, checksum_data)
+        """
+        ret = [self.get(T, D) for T, D in checksums]
+        items = [(num, obj, None) for num, obj in enumerate(ret)]
+        for fd, exists, items in self._y_buckets(items):
+            for num, obj, arg in items:
+                st = None
+                if fd is not None:
+                    st = _fstatat(fd, obj.checksum_data)
+                    if st is None and obj._moved():
+                        st = obj._file_stat()
+                elif exists:
+                    st = obj._file_stat()
+                if st is None:
+                    st = self._pack_stat(obj)
+                obj._stat = st
+                obj.exists = st is not None
+        return ret
+
+    def load_many(self, items, checksum=False, link=None):
+        """ Load many objects, see CASheFileObj.load(). This is done a bucket
+            directory at a time, see _y_buckets, objects are hardlinked from
+            the bucket by name (anything else is done by .load()). Returns a
+            list of the results from each load, in the same order.
+
+        :param items: an iterable of (obj, filename)
+        :param checksum: a boolean specifying if we should perform a
+                         checksum of the data (default False)
+        :param link: should we try using link to retrieve the data
+        """
+        items = [(num, obj, fname) for num, (obj, fname) in enumerate(items)]
+        ret = [None] * len(items)
+        for fd, exists, items in self._y_buckets(items):
+            for num, obj, filename in items:
+                if not exists and self._packs is None:
+                    obj._count('load-misses')
+                    continue
+                olink = obj.link if link is None else link
+                if (fd is not None and olink and not checksum and
+                    not self._absent(obj)):
+                    beg = time.time()
+                    st = _fstatat(fd, obj.checksum_data)
+                    try:
+                        if st is not None:
+                            _linkat(fd, obj.checksum_data, _AT_FDCWD, filename)
+                    except OSError, e: # Let .load() deal with EEXIST etc.
+                        st = None
+                    if st is not None:
+                        obj._stat = st
+                        obj.exists = True
+                        obj._count('load-hits')
+                        obj._count_io('link', beg, st.st_size)
+                        ret[num] = obj.filename
+                        continue
+                ret[num] = obj.load(filename, checksum=checksum, link=link)
+        return ret
+
+    def save_many(self, items, checksum=True, link=None):
+        """ Save many objects, see CASheFileObj.save(). This is done a bucket
+            directory at a time, see _y_buckets, without a checksum files are
+            hardlinked into the bucket by name (anything else is done by
+            .save()). Returns a list of the results from each save, in the same
+            order.
+
+        :param items: an iterable of (obj, filename)
+        :param checksum: a boolean specifying if we should perform a
+                         checksum of the data (default True)
+        :param link: should we try using link to store the data
+        """
+        items = [(num, obj, fname) for num, (obj, fname) in enumerate(items)]
+        ret = [None] * len(items)
+        fast = not checksum and not self._pack_size
+        for fd, exists, items in self._y_buckets(items, create=fast):
+            for num, obj, filename in items:
+                olink = obj.link if link is None else link
+                if fd is not None and fast and olink:
+                    beg = time.time()
+                    st = None
+                    try:
+                        _linkat(_AT_FDCWD, filename, fd, obj.checksum_data)
+                        st = _fstatat(fd, obj.checksum_data)
+                    except OSError, e: # Let .save() deal with EEXIST etc.
+                        pass
+                    if st is not None:
+                        obj._stat = st
+                        obj.exists = True
+                        obj._count_io('link', beg, st.st_size)
+                        obj._count('save-objs')
+                        # It wasn't there (or it'd be EEXIST), nor in packs.
+                        self._saved(obj)
+                        ret[num] = obj.filename
+                        continue
+                ret[num] = obj.save(filename, checksum=checksum, link=link)
+        return ret
 
     def rm(self, obj):
         """ Remove an object from the cache.
 
-        :param obj: an object returned by .get()
+        :param obj: an object returned by .get()
+        """
+        obj.unlink()
+        self._objs[obj.checksum_type].pop(obj.checksum_data, None)
+
+    def _ls_index(self, checksum_type=None):
+        """ Yield all objects in the index, with their stat data from it. """
+        for (T, D), st in sorted(self._index.read().iteritems()):
+            if T not in self._objs:
+                continue
+            if checksum_type is not None and checksum_type != T:
+                continue
+            try:
+                obj = self._get(T, D, cache=False)
+            except TypeError:
+                continue
+            obj._stat = st
+            yield obj
+
+    def ls(self, checksum_type=None, index=False):
+        """ Yield all objects stored in the cache. New objects aren't kept
+            after they are yielded, so memory usage doesn't grow.
+
+        :param checksum_type: a string specifying the type of checksum, or None
+                              for all checksums. Eg. md5, sha256.
+        :param index: a boolean specifying if we should use the index (if it
+                      exists), instead of looking at the filesystem. The stat
+                      data of the objects will be from the index.
+        """
+        checksum_type = _checksum_aliases.get(checksum_type, checksum_type)
+
+        if index and self._index is not None:
+            for obj in self._ls_index(checksum_type):
+                yield obj
+            return
+
+        for T in sorted(self._objs):
+            if checksum_type is not None and checksum_type != T:
+                continue
+
+            for batch, extras in _walk_type(self.path, T, self.threads,
+                                            self._layouts):
+                for D, st in batch:
+                    obj = self._get(T, D, cache=False)
+                    if st is not None:
+                        obj._stat = st
+                    yield obj
+            packs = self._pack(T)
+            if packs is not None:
+                for D, st in packs.ls():
+                    obj = self._get(T, D, cache=False)
+                    obj._stat = st
+                    yield obj
+
+    def ls_extra(self):
+        """ Yield the paths to all the files/directories in the cache that
+            aren't objects. """
+        for T in sorted(self._objs):
+            for batch, extras in _walk_type(self.path, T, self.threads,
+                                            self._layouts):
+                for path in extras:
+                    yield path
+
+    def save_aliases(self, filename, checksums=None, link=None):
+        """ Save the file into the CAShe storage, as an object for each of
+            the checksum types. The data is read once, to calculate all the
+            checksums, and then the objects are hardlinks of each other.
+            Returns a dict of checksum type => object, or None on failure.
+
+        :param filename: a string specifying the path to link/read from
+        :param checksums: a list of the checksum types, defaults to the
+                          "aliases" in the config.
+        :param link: should we try using link to store the data
+        """
+        if checksums is None:
+            checksums = self._get_config_aliases()
+        data = Checksums(checksums)
+        try:
+            data.read_file(filename)
+        except IOError, e:
+            return None
+
+        ret = {}
+        primary = None
+        for T in data._sumtypes:
+            obj = self.get(T, data.hexdigest(T))
+            ret[obj.checksum_type] = obj
+            if primary is None:
+                primary = obj
+                if primary.save(filename, checksum=False, link=link) is None:
+                    return None
+                continue
+            if primary.packed: # No file to link to, so pack each of them.
+                if obj.save(filename, checksum=False, link=link) is None:
+                    return None
+                continue
+
+            old = self._old_stat(obj)
+            try:
+                tst = _link_xdev(primary.filename, obj.filename)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                _makedirs_f(obj.dirname)
+                tst = _link_xdev(primary.filename, obj.filename)
+            if not tst: # Too many links, so just store a copy.
+                _copy_atomic(primary.filename, obj.filename)
+            obj.exists = True
+            self._saved(obj, old, alias=tst)
+        return ret
+
+    def checksum_file(self, checksum_type, filename, st=None):
+        """ Return the hexdigest of a file outside the cache (Eg. to save it),
+            or None if it can't be read. If the hash cache (meta/hashes)
+            exists the file is only read if it has changed since it was last
+            checksummed.
+
+        :param checksum_type: a string specifying the type of checksum,
+                              Eg. md5, sha256
+        :param filename: a string specifying the path to the file
+        :param st: the stat data of the file, if the caller has it
+        """
+        T = _checksum_aliases.get(checksum_type, checksum_type)
+        if self._hashes is None:
+            self._hashes = False
+            if os.path.exists(self._meta_path("hashes")):
+                self._hashes = CASheHashes(self._meta_path("hashes"),
+                                           self._get_config_hashes())
+        if not self._hashes:
+            return _file2hexdigest(T, filename)
+
+        if st is None:
+            st = _stat_f(filename)
+            if st is None:
+                return None
+        ret = self._hashes.get(st, T)
+        if ret is not None:
+            self._stats.add('hash-cache-hits')
+            return ret
+        self._stats.add('hash-cache-misses')
+        ret = _file2hexdigest(T, filename)
+        nst = _stat_f(filename)
+        if ret is not None and nst is not None:
+            if CASheHashes._key(st) == CASheHashes._key(nst): # Not changed
+                self._hashes.add(st, T, ret)
+        return ret
+
+    def _hashed(self, filename, checksum_type, checksum_data):
+        """ Add a file to the hash cache (if it's being used), Eg. after it
+            was saved by linking it (which changes its ctime). """
+        if self._hashes:
+            st = _stat_f(filename)
+            if st is not None:
+                self._hashes.add(st, checksum_type, checksum_data)
+
+    def merge(self, paths, checksum_type, link=None, jobs=None, index=True,
+              link_only=False, prefix=0):
+        """ Merge files into the cache, saving those that aren't objects and
+            replacing those that are with links to the object. Files are found
+            and checksummed in parallel, and grouped by inode so hardlinks are
+            only checksummed once (and those which are already objects aren't
+            checksummed at all). Yields (filename, obj, how) as each file is
+            done, where how is "save", "load" or None if nothing was done.
+
+        :param paths: files and directories (merged recursively)
+        :param checksum_type: a string specifying the type of checksum,
+                              Eg. md5, sha256
+        :param link: should we link files into the cache, None means only
+                     files owned by the owner of the cache (so users don't
+                     own objects). If False files aren't replaced by links.
+        :param jobs: number of files to checksum in parallel, defaults to
+                     .threads (or 1 if checksumming holds the GIL)
+        :param index: a boolean specifying if we should use the index (if it
+                      exists) to find the objects, instead of looking at the
+                      filesystem.
+        :param link_only: a boolean specifying if we should only replace files
+                          with links to objects, and not save any. Then only
+                          files the same size as an object are checksummed.
+        :param prefix: with link_only, if not 0 then files are only
+                       checksummed if their first prefix bytes are the same as
+                       an object of the same size.
+        """
+        import threading
+        T = _checksum_aliases.get(checksum_type, checksum_type)
+        if T not in self._objs:
+            raise TypeError, "Not a valid Checksum Type: %s" % T
+        if jobs is None:
+            jobs = 1
+            if _hash_threads_ok():
+                jobs = self.threads
+        uid = os.stat(self.path).st_uid
+
+        # Files which are already objects are skipped, without a checksum.
+        snap = self.scan(T, index=index)
+        known = set(zip(snap.dev, snap.ino))
+        sizes = None # size => objects, when only linking to existing objects
+        if link_only:
+            sizes = {}
+            for row in xrange(len(snap)):
+                if not snap.ino[row]:
+                    continue # Packed, so can't be linked to.
+                size = int(snap.size[row])
+                if size not in sizes:
+                    sizes[size] = []
+                sizes[size].append(snap.checksum(row)[1])
+        del snap
+
+        lock = threading.Lock()
+        inodes = {} # (dev, ino) => [paths, stat, checksum, num done]
+        errors = []
+        prefixes = {} # size => hashes of the start of the objects
+
+        def _candidate(path, st):
+            """ Could the file be one of the objects, for link_only. """
+            if st.st_size not in sizes:
+                return False
+            if not prefix or st.st_size <= prefix:
+                return True
+            lock.acquire()
+            try:
+                if st.st_size not in prefixes:
+                    prefixes[st.st_size] = set([_read_prefix(
+                        self._get(T, D, cache=False).filename, prefix)
+                                                for D in sizes[st.st_size]])
+            finally:
+                lock.release()
+            return _read_prefix(path, prefix) in prefixes[st.st_size]
+
+        def _y_files(): # Runs in the pool's thread, as it wants more work.
+            try:
+                for path, st in _walk_files(paths):
+                    key = (st.st_dev, st.st_ino)
+                    lock.acquire()
+                    try:
+                        if key in inodes:
+                            inodes[key][0].append(path)
+                            continue
+                        inodes[key] = [[path], st, None, 0]
+                    finally:
+                        lock.release()
+                    yield key
+            except Exception: # The pool would hang, so raise it later.
+                errors.append(sys.exc_info())
+
+        def _checksum(key):
+            if key in known:
+                return key, None
+            paths, st = inodes[key][:2]
+            if sizes is not None and not _candidate(paths[0], st):
+                return key, None
+            return key, self.checksum_file(T, paths[0], st)
+
+        def _commit(key):
+            lock.acquire()
+            paths, st, D, done = inodes[key]
+            paths = paths[done:]
+            inodes[key][3] += len(paths)
+            lock.release()
+            for path in paths:
+                if D is None:
+                    yield path, None, None
+                    continue
+                obj = self.get(T, D)
+                yield path, obj, self._merge_file(obj, path, st, link, uid,
+                                                  link_only)
+
+        pool = None
+        if jobs > 1:
+            try:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(jobs)
+            except ImportError:
+                pass
+        try:
+            if pool is None:
+                results = (_checksum(key) for key in _y_files())
+            else:
+                results = pool.imap_unordered(_checksum, _y_files(), 16)
+            for key, D in results:
+                inodes[key][2] = D
+                for ret in _commit(key):
+                    yield ret
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        # Hardlinks which were found after their inode was done.
+        for key in inodes:
+            for ret in _commit(key):
+                yield ret
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _merge_file(self, obj, filename, st, link, uid, link_only=False):
+        """ Merge a file into the cache as obj, see .merge(). """
+        cst = _stat_f(filename)
+        if cst is None or ((cst.st_ino, cst.st_size, cst.st_mtime) !=
+                           (st.st_ino, st.st_size, st.st_mtime)):
+            return None # Changed since it was checksummed.
+
+        # Stat the object directly, the daemon can be behind other processes.
+        ost = None
+        if not self._absent(obj):
+            ost = self._stat(obj)
+        if ost is not None:
+            obj._stat = ost
+            if ost.st_dev == st.st_dev and ost.st_ino == st.st_ino:
+                return None
+            if ost.st_ino == 0: # Packed, loading would copy it over itself.
+                return None
+            if link is not False and obj.load(filename):
+                return "load"
+            return None
+
+        if link_only:
+            return None
+        if link is None:
+            link = st.st_uid == uid
+        if obj.save(filename, checksum=False, link=link):
+            return "save"
+        return None
+
+    def _alias_groups(self, objs):
+        """ Group objects by inode, so aliases of the same data (saved with
+            .save_aliases()) are treated as one. Returns a list of the groups,
+            in the order they were first seen. """
+        groups = {}
+        ret = []
+        for obj in objs:
+            key = (obj.st_dev, obj.st_ino)
+            if key not in groups:
+                groups[key] = []
+                ret.append(groups[key])
+            groups[key].append(obj)
+        return ret
+
+    def check(self, objs=None, jobs=None, chunk=1024 * 1024, force=False):
+        """ Check that objects match their checksum, removing those that
+            don't (like .checked_filename). Yields (obj, ok) for each object as
+            the checks complete, which isn't the same order as objs. Objects
+            that haven't changed since they were last checked are skipped.
+
+        :param objs: objects to check, defaults to all objects in the cache
+        :param jobs: number of checks to run in parallel, defaults to
+                     .threads (the hashing doesn't hold the GIL)
+        :param chunk: size of the reads used to checksum the objects
+        :param force: checksum all the objects, even if they haven't changed
+        """
+        if objs is None:
+            objs = self.ls()
+        if jobs is None:
+            jobs = self.threads
+
+        def _check(obj):
+            return obj, obj._getCheckedFilename(chunk, force) is not None
+
+        pool = None
+        if jobs > 1:
+            try:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(jobs)
+            except ImportError:
+                pass
+        if pool is None:
+            for obj in objs:
+                yield _check(obj)
+            return
+
+        try:
+            for ret in pool.imap_unordered(_check, objs):
+                yield ret
+        finally:
+            pool.terminate()
+
+    def reindex(self):
+        """ Rebuild the index and bloom filters from the objects on the
+            filesystem, this also enables them if they didn't exist. Returns
+            the number of objects in the new index. """
+        snap = self.scan()
+        if self._write_blooms(snap, create=True):
+            # New filters missed anything saved during the scan, so do it
+            # again now that saves are adding to them.
+            snap = self.scan()
+        if self._index is None:
+            self._index = CASheIndex(self._meta_path("index"))
+        num = self._index.write(snap.obj(self, row)
+                                for row in xrange(len(snap)))
+        self._write_usage(snap, create=True)
+        return num
+
+    def _write_layouts(self, layouts):
+        """ Atomically replace the "layout" file, which tells everything using
+            the CAShe where to find the objects. """
+        import tempfile
+        out = tempfile.NamedTemporaryFile(dir=self.path)
+        out.write("".join(["%u:%u\n" % layout for layout in layouts]))
+        out.flush()
+        os.chmod(out.name, 0644)
+        os.rename(out.name, self.path + "/layout")
+        out.delete = False
+        out.close()
+        self._set_layouts(tuple(layouts))
+
+    def _layouts_stat(self):
+        st = _stat_f(self.path + "/layout")
+        if st is None:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _reread_layouts(self):
+        """ Re-read the "layout" file if it's been changed (by a reshard in
+            another process), called when an object isn't where we looked. """
+        ident = self._layouts_stat()
+        if ident == self._layouts_ident:
+            return
+        self._layouts_ident = ident
+        self._set_layouts(_read_layouts(self.path))
+
+    def _set_layouts(self, layouts):
+        """ Change where objects are looked for, Eg. after a reshard. """
+        if layouts == self._layouts:
+            return
+        self._layouts = layouts
+        for T in self._objs: # They've cached their filenames.
+            self._objs[T] = _ObjTable(self._objs[T].maxsize)
+
+    def _move(self, checksum_type, checksum_data, layout, old_layouts):
+        """ Rename an object from any of the old layouts to the layout,
+            returns True if it was moved. """
+        obj = CASheFileObj(self.path, checksum_type, checksum_data)
+        dst = obj._layoutFilename(layout)
+        for old in old_layouts:
+            src = obj._layoutFilename(old)
+            if src == dst:
+                continue
+            if os.path.lexists(dst): # Saved again, since the reshard began.
+                if not _unlink_f(src):
+                    continue
+            else:
+                try:
+                    os.rename(src, dst)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    if not os.path.lexists(src):
+                        continue # Removed/moved under us.
+                    _makedirs_f(os.path.dirname(dst))
+                    os.rename(src, dst)
+            _try_rmdirs(os.path.dirname(src), old[0])
+            return True
+        return False
+
+    def reshard(self, layout=None):
+        """ Move the objects into a different fan-out of bucket directories,
+            Eg. (2, 2) is root/type/ab/cd/abcd... Objects are renamed one at a
+            time, and everything using the CAShe looks in both layouts until
+            it is done, so this can be run while the CAShe is being used (and
+            run again, if it was interrupted). Returns the number of objects
+            moved.
+
+        :param layout: a tuple of (depth, width) or None for the "fanout" key
+                       in the config file.
+        """
+        if layout is None:
+            layout = self._get_config_fanout()
+        self._set_layouts(_read_layouts(self.path))
+        if self._layouts == (layout,):
+            return 0
+        layouts = [layout] + [L for L in self._layouts if L != layout]
+        self._write_layouts(layouts)
+
+        num = 0
+        for T in sorted(self._objs):
+            for batch, extras in _walk_type(self.path, T, self.threads,
+                                            layouts[1:]):
+                for D, st in batch:
+                    if self._move(T, D, layout, layouts[1:]):
+                        num += 1
+        self._write_layouts([layout])
+        return num
+
+    def pack(self, size=None):
+        """ Move the objects smaller than size into packs (see CAShePacks),
+            and compact them. This creates packs/, which turns on saving small
+            objects into the packs. Objects that are linked to (or aliases)
+            are left as files. Returns the number of objects moved.
+
+        :param size: the size in bytes, or None for the "pack" key in the
+                     config file.
         """
-        obj.unlink()
-        del self._objs[obj.checksum_type][obj.checksum_data]
+        if size is None:
+            size = self._get_config_pack()
+        _makedirs_f(self.path + "/packs")
+        if self._packs is None:
+            self._packs = {}
+        self._pack_size = size
+
+        num = 0
+        for T in sorted(self._objs):
+            packs = self._pack(T)
+            for batch, extras in _walk_type(self.path, T, self.threads,
+                                            self._layouts):
+                for D, st in batch:
+                    obj = self._get(T, D, cache=False)
+                    if st is None:
+                        st = _stat_f(obj.filename)
+                    if st is None or st.st_size >= size or st.st_nlink > 1:
+                        continue
+                    with open(obj.filename, "rb") as fo:
+                        data = fo.read()
+                    sums = Checksums([T])
+                    sums.update(data)
+                    if sums.hexdigest(T) != D:
+                        continue # Corrupt, leave it for check/cleanup.
+                    packs.add(D, data)
+                    packs.touch(D, st.st_atime, st.st_mtime)
+                    _unlink_f(obj.filename)
+                    _try_rmdirs(obj.dirname, self._layouts[0][0])
+                    obj._filename = None
+                    del obj.exists
+                    if self._index is not None:
+                        self._index.add(obj, self._stat(obj))
+                    self._daemon_call('update', T, D)
+                    num += 1
+            packs.compact()
+        return num
 
-    def ls(self, checksum_type=None):
-        """ Yield all objects stored in the cache.
+    def manifest(self, hot=None, index=True):
+        """ Return a dict of checksum type => set of the (binary) digests of
+            the objects in the cache, which is what a sync compares.
 
-        :param checksum_type: a string specifying the type of checksum, or None
-                              for all checksums. Eg. md5, sha256.
+        :param hot: only objects used in the last hot seconds (by the
+                    configured time, Eg. atime), or None for all objects
+        :param index: a boolean specifying if we should use the index (if it
+                      exists), instead of looking at the filesystem.
         """
-        checksum_type = _checksum_aliases.get(checksum_type, checksum_type)
-
-        for T in sorted(self._objs):
-            if checksum_type is not None and checksum_type != T:
+        snap = self.scan(index=index)
+        if hot is not None:
+            col = getattr(snap, self._get_config()[3])
+            cutoff = time.time() - hot
+        ret = {}
+        for row in xrange(len(snap)):
+            if hot is not None and col[row] < cutoff:
                 continue
+            T, digest = snap.digest(row)
+            if T not in ret:
+                ret[T] = set()
+            ret[T].add(digest)
+        return ret
 
-            subdirname = "%s/%s" % (self.path, T)
+    def sync_to(self, dst, hot=None, jobs=None, index=True, preserve=False):
+        """ Copy the objects that are in this cache, but not in dst, to it.
+            Only the digests of the objects are compared, and the copies are
+            done in parallel (each is written to a temporary file, and renamed
+            into place). Yields (checksum_type, checksum_data, size) as each
+            copy completes, the size is None if it failed.
+
+        :param dst: a CAShe, or a CASheRemote for one in another process
+        :param hot: only copy objects used in the last hot seconds
+        :param jobs: number of objects to copy in parallel, defaults to
+                     .threads
+        :param index: a boolean specifying if we should use the index (if it
+                      exists), instead of looking at the filesystem.
+        :param preserve: a boolean specifying if the copies should have the
+                         same atime/mtime
+        """
+        if jobs is None:
+            jobs = self.threads
+        return _sync(self, dst, hot, jobs, index, preserve)
 
-            for subfilename in _listdir(subdirname):
-                if len(subfilename) != 4:
-                    continue
-                if not _valid_checksum_data(subfilename):
-                    continue
+    def sync_from(self, src, hot=None, jobs=None, index=True, preserve=False):
+        """ Copy the objects that are in src, but not in this cache, from it.
+            See .sync_to().
 
-                dirname = "%s/%s" % (subdirname, subfilename)
-                for filename in _listdir(dirname):
-                    if not filename.startswith(subfilename):
-                        continue
-                    if len(filename) != _checksum_d_len[T]:
-                        continue
-                    if not _valid_checksum_data(filename):
-                        continue
-                    yield self.get(T, filename)
+        :param src: a CAShe, or a CASheRemote for one in another process
+        """
+        if jobs is None:
+            jobs = self.threads
+        return _sync(src, self, hot, jobs, index, preserve)
 
     def _get_config_def(self):
         lo = 500 * 1000 * 1000
@@ -554,48 +3996,86 @@ class CAShe(object):
         sort_by = "atime"
         return (lo, hi, age, sort_by)
 
-    def _get_config(self):
+    def _read_config(self):
+        """ Return a list of the (key, value) pairs from the config file. """
         try:
             data = open(self.path + "/config").readlines()
         except:
-            return self._get_config_def()
+            return []
 
         data = [x.lstrip() for x in data]
         data = [x for x in data if x and x[0] != '#']
-        if not data:
-            return self._get_config_def()
-
-        lo, hi, age, sort_by = self._get_config_def()
 
+        ret = []
         for line in data:
             vals = line.split('=')
             if len(vals) != 2:
                 continue # ignore errors ftw
             key,val = vals
-            key = key.strip()
-            val = val.strip()
-
-            mul = 1
+            ret.append((key.strip(), val.strip()))
+        return ret
 
-            if key == 'age':
-                if val.endswith('w'):
-                    mul = 60*60*24*7
-                    val = val[:-1]
-                elif val.endswith('d'):
-                    mul = 60*60*24
-                    val = val[:-1]
-                elif val.endswith('h'):
-                    mul = 60*60
-                    val = val[:-1]
-                elif val.endswith('m'):
-                    mul = 60
-                    val = val[:-1]
+    def _get_config_aliases(self):
+        """ Return the checksum types to save objects as, when saving with
+            aliases (the "aliases" key in the config file). """
+        ret = [T for T in ('sha256', 'sha1', 'md5', 'sha512')
+               if T in _get_available_checksums()]
+        for key, val in self._read_config():
+            if key != 'aliases':
+                continue
+            vals = []
+            for T in val.replace(',', ' ').split():
+                T = _checksum_aliases.get(T, T)
+                if T in vals or T not in _checksum_d_len:
+                    continue
+                if T in _get_available_checksums():
+                    vals.append(T)
+            if vals:
+                ret = vals
+        return ret
 
+    def _get_config_hashes(self):
+        """ Return the max. number of files in the hash cache (the "hashes"
+            key in the config file). """
+        ret = 200 * 1000
+        for key, val in self._read_config():
+            if key == 'hashes':
                 try:
-                    val = float(val)
-                except:
-                    continue
-                age = int(val * mul)
+                    ret = int(val)
+                except ValueError:
+                    pass
+        return ret
+
+    def _get_config_pack(self):
+        """ Return the size objects have to be smaller than to be saved into
+            the packs (the "pack" key in the config file), 0 is none. """
+        ret = _def_pack
+        for key, val in self._read_config():
+            if key == 'pack' and _parse_size(val) is not None:
+                ret = _parse_size(val)
+        return ret
+
+    def _get_config_fanout(self):
+        """ Return the (depth, width) layout to reshard the objects to (the
+            "fanout" key in the config file). """
+        ret = _def_layout
+        for key, val in self._read_config():
+            if key == 'fanout' and _parse_layout(val) is not None:
+                ret = _parse_layout(val)
+        return ret
+
+    def _get_config(self):
+        data = self._read_config()
+        if not data:
+            return self._get_config_def()
+
+        lo, hi, age, sort_by = self._get_config_def()
+
+        for key, val in data:
+            if key == 'age':
+                val = _parse_age(val)
+                if val is not None:
+                    age = val
                 continue
 
             if key == 'time':
@@ -604,31 +4084,14 @@ class CAShe(object):
                     sort_by = val
                 continue
 
-            if val.endswith('k') or val.endswith('K'):
-                mul = 1000
-                val = val[:-1]
-            elif val.endswith('m') or val.endswith('M'):
-                mul = 1000*1000
-                val = val[:-1]
-            elif val.endswith('g') or val.endswith('G'):
-                mul = 1000*1000*1000
-                val = val[:-1]
-            elif val.endswith('t') or val.endswith('T'):
-                mul = 1000*1000*1000*1000
-                val = val[:-1]
-            elif val.endswith('p') or val.endswith('P'): # lol
-                mul = 1000*1000*1000*1000*1000
-                val = val[:-1]
-
-            try:
-                val = float(val)
-            except:
+            val = _parse_size(val)
+            if val is None:
                 continue
 
             if key in ('older', 'lo', 'low'):
-                lo = int(val * mul)
+                lo = val
             if key in ('newer', 'hi', 'high'):
-                hi = int(val * mul)
+                hi = val
 
         if hi < lo:
             hi = lo
@@ -640,44 +4103,173 @@ class CAShe(object):
             return False
         return True
 
-    def cleanup(self):
+    def scan(self, checksum_type=None, index=False):
+        """ Return a CASheSnapshot of all the objects stored in the cache,
+            which uses a lot less memory than objects from .ls().
+
+        :param checksum_type: a string specifying the type of checksum, or None
+                              for all checksums. Eg. md5, sha256.
+        :param index: a boolean specifying if we should use the index (if it
+                      exists), instead of looking at the filesystem.
+        """
+        checksum_type = _checksum_aliases.get(checksum_type, checksum_type)
+        if index:
+            ok, snap = self._daemon_call('snapshot', checksum_type)
+            if snap is not None:
+                return snap
+        snap = CASheSnapshot()
+
+        if index and self._index is not None:
+            for (T, D), st in sorted(self._index.read().iteritems()):
+                if T not in self._objs:
+                    continue
+                if checksum_type is not None and checksum_type != T:
+                    continue
+                if len(D) != _checksum_d_len[T] or not _valid_checksum_data(D):
+                    continue
+                snap.append(T, D, st)
+            return snap
+
+        # Digests added to the filters while walking aren't in the snapshot.
+        befores = {}
+        for T in sorted(self._objs):
+            if checksum_type is None or checksum_type == T:
+                befores[T] = self._bloom(T).bits()
+
+        for T in sorted(self._objs):
+            if checksum_type is not None and checksum_type != T:
+                continue
+
+            for batch, extras in _walk_type(self.path, T, self.threads,
+                                            self._layouts):
+                for D, st in batch:
+                    if st is None:
+                        obj = self._get(T, D, cache=False)
+                        st = _stat_f(obj.filename, ignore_EACCES=True)
+                        if st is None:
+                            continue
+                    snap.append(T, D, st)
+            packs = self._pack(T)
+            if packs is not None:
+                for D, st in packs.ls():
+                    snap.append(T, D, st)
+        self._write_blooms(snap, checksum_type, befores=befores)
+        if checksum_type is None:
+            self._write_usage(snap)
+        return snap
+
+    def cleanup(self, index=True):
         """ Remove objects from the cache to being it within the configured
         limits (the "config" file at the root of the cashe).
+
+        :param index: a boolean specifying if we should use the index (if it
+                      exists), only objects that are going to be removed are
+                      then stat'd. If the daemon is running it does the
+                      cleanup.
         """
+        if index:
+            ok, ret = self._daemon_call('cleanup')
+            if ok:
+                return tuple(ret)
+        return self._cleanup(index)
+
+    def _cleanup(self, index):
+        ret = self._cleanup_objs(index)
+        if self._packs is not None:
+            for T in sorted(self._objs):
+                self._pack(T).compact()
+        return ret
+
+    def _restated(self, obj):
+        """ Update the index/daemon with the stat data of an object, after
+            finding theirs was old. """
+        if self._index is not None:
+            self._index.add(obj, obj._stat)
+        self._daemon_call('update', obj.checksum_type, obj.checksum_data)
+
+    def _restat_used(self, snap):
+        """ Re-stat the rows of a snapshot, from the index/daemon, which have
+            links. Nothing updates the nlink when the links outside the cache
+            go away, so they'd be used forever. """
+        np = _numpy()
+        if np is not None:
+            rows = np.nonzero(snap._col('nlink') > 1)[0].tolist()
+        else:
+            rows = [row for row in xrange(len(snap)) if snap.nlink[row] > 1]
+        for row in rows:
+            obj = snap.obj(self, row)
+            st = self._stat(obj, ignore_EACCES=True)
+            if st is not None and _same_stat(st, obj._stat):
+                continue
+            snap.set(row, st)
+            obj._stat = st
+            self._restated(obj)
+
+    def _cleanup_objs(self, index):
         import time
         (lo, hi, age, sort_by) = self._get_config()
+        restat = index and (self._index is not None or
+                            self._daemon is not None)
 
-        # http://www.grantjenks.com/docs/sortedcontainers/ ??
-        def _rm_objs(objs, size, cutoff):
+        snap = self.scan(index=index)
+        if restat:
+            self._restat_used(snap)
+        groups = snap.alias_groups()
+        state = snap.states(sort_by, age, time.time(), groups)
+
+        def _rm_objs(rows, size, cutoff):
             deleted_num  = 0
             deleted_size = 0
 
-            objs.sort(key=lambda x: getattr(x, sort_by), reverse=True)
-            while size > cutoff:
-                obj = objs.pop()
-                size -= obj.size
-                deleted_num  += 1
-                deleted_size += obj.size
-                # print "JDBG:", obj
-                self.rm(obj)
+            for row in snap.select(rows, size, cutoff, sort_by):
+                gobjs = [snap.obj(self, grow) for grow in groups.get(row,
+                                                                     [row])]
+                if restat: # Index data might be old, so check it now.
+                    used = max([getattr(obj._stat, 'st_' + sort_by)
+                                for obj in gobjs])
+                    for obj in gobjs:
+                        del obj.exists
+                        obj._stat = self._stat(obj)
+                        if obj._stat is None: # Gone, so forget about it.
+                            self._restated(obj)
+                    gobjs = [obj for obj in gobjs if obj._stat is not None]
+                    if not gobjs or gobjs[0].nlink > len(gobjs):
+                        continue
+                    if getattr(gobjs[0]._stat, 'st_' + sort_by) > used + 1:
+                        for obj in gobjs: # Used since, so keep it.
+                            self._restated(obj)
+                        continue
+                gsize = gobjs[0].size
+                deleted_num  += len(gobjs)
+                deleted_size += gsize
+                for obj in gobjs:
+                    # print "JDBG:", obj
+                    self.rm(obj)
+                if self._usage is not None and len(gobjs) > 1:
+                    # Aliases are one object in the total, not len(gobjs).
+                    self._usage.add(None, len(gobjs) - 1,
+                                    gsize * (len(gobjs) - 1))
             return (deleted_num, deleted_size)
 
-        objs = []
-        size = 0
-        lo_objs = []
-        lo_size = 0
-        now = time.time()
-
-        for obj in self.ls():
-            if obj.nlink > 1:
-                continue
-
-            if not self._is_new(obj, sort_by, age, now):
-                lo_objs.append(obj)
-                lo_size += obj.size
-            else:
-                objs.append(obj)
-                size += obj.size
+        # Aliases are a single object (the first row), as they share the data.
+        np = _numpy()
+        if np is not None:
+            objs    = np.nonzero(state == snap.NEW)[0]
+            lo_objs = np.nonzero(state == snap.OLD)[0]
+            size    = int(snap._col('size')[objs].sum())
+            lo_size = int(snap._col('size')[lo_objs].sum())
+        else:
+            objs = []
+            size = 0
+            lo_objs = []
+            lo_size = 0
+            for row in xrange(len(snap)):
+                if state[row] == snap.NEW:
+                    objs.append(row)
+                    size += snap.size[row]
+                elif state[row] == snap.OLD:
+                    lo_objs.append(row)
+                    lo_size += snap.size[row]
 
         if (size + lo_size) < lo: # Under lo watermark, keep everything
             return 0, 0
@@ -687,7 +4279,6 @@ class CAShe(object):
 
         # Over lo watermark with new objs, delete all old
         (deleted_num, deleted_size) = _rm_objs(lo_objs, lo_size, 0)
-        assert len(lo_objs) == 0
 
         if size < hi:
             return (deleted_num, deleted_size)
@@ -697,12 +4288,771 @@ class CAShe(object):
         return (deleted_num  + hdeleted_num,
                 deleted_size + hdeleted_size)
 
+def _asyncio():
+    """ Return the asyncio module, or the trollius backport on Python-2. """
+    try:
+        import asyncio
+    except ImportError:
+        import trollius as asyncio
+    return asyncio
+
+class AsyncCAShe(object):
+    """ asyncio front-end for a CAShe. All the methods return futures, which
+        can be awaited (or yielded from), and the blocking calls are run in a
+        bounded pool of threads so they don't stall the event loop. Concurrent
+        calls for the same thing are merged, into a single call (unless that
+        returns None, Eg. a miss or a checksum failure, then it's run again
+        for each of the merged calls). """
+
+    def __init__(self, cashe=None, workers=8, loop=None):
+        """ Wrap a CAShe, for use from asyncio.
+
+        :param cashe: the CAShe to use, defaults to the system CAShe
+        :param workers: the number of threads to run blocking calls in
+        :param loop: the asyncio event loop, defaults to the current loop
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if cashe is None:
+            cashe = CAShe("/var/cache/CAShe")
+        if loop is None:
+            loop = _asyncio().get_event_loop()
+        self.cashe = cashe
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(workers)
+        self._pending = {}
+
+    def _submit(self, key, func, *args):
+        # _pending is only used from the loop, so doesn't need a lock.
+        if key in self._pending:
+            return self._merge(self._pending[key], key, func, args)
+
+        fut = self._loop.run_in_executor(self._executor, func, *args)
+        self._pending[key] = fut
+        fut.add_done_callback(lambda x: self._pending.pop(key, None))
+        return fut
+
+    def _merge(self, pending, key, func, args):
+        """ A future for the result of the pending call, if it's None (or the
+            call was cancelled) then func is run again. """
+        fut = _asyncio().Future(loop=self._loop)
+        def _copy(src):
+            if fut.cancelled():
+                return
+            if src.exception() is not None:
+                fut.set_exception(src.exception())
+            else:
+                fut.set_result(src.result())
+        def _done(src):
+            if src.cancelled() or (src.exception() is None and
+                                   src.result() is None):
+                self._submit(key, func, *args).add_done_callback(_copy)
+            else:
+                _copy(src)
+        pending.add_done_callback(_done)
+        return fut
+
+    def close(self):
+        """ Shutdown the threads, after any running calls finish. """
+        self._executor.shutdown(wait=False)
+
+    def get(self, checksum_type, checksum_data):
+        """ Get an object, which has been looked up (so .exists/.size don't
+            block). See CAShe.get(). """
+        obj = self.cashe.get(checksum_type, checksum_data)
+        def _get():
+            del obj.exists
+            obj.exists # Do the stat
+            return obj
+        return self._submit(('get', str(obj)), _get)
+
+    def exists(self, checksum_type, checksum_data):
+        """ Does the object exist in the cache. """
+        obj = self.cashe.get(checksum_type, checksum_data)
+        def _exists():
+            del obj.exists
+            return bool(obj.exists)
+        return self._submit(('exists', str(obj)), _exists)
+
+    def load(self, checksum_type, checksum_data, filename, checksum=False,
+             link=None):
+        """ Load an object to a file. See CASheFileObj.load(). """
+        obj = self.cashe.get(checksum_type, checksum_data)
+        return self._submit(('load', str(obj), filename, checksum, link),
+                            obj.load, filename, checksum, link)
+
+    def save(self, checksum_type, checksum_data, filename, checksum=True,
+             link=None):
+        """ Save a file as an object. See CASheFileObj.save(). """
+        obj = self.cashe.get(checksum_type, checksum_data)
+        return self._submit(('save', str(obj), filename, checksum, link),
+                            obj.save, filename, checksum, link)
+
+    def save_stream(self, checksum_type, checksum_data, data):
+        """ Save data as an object. See CASheFileObj.save_stream(), only
+            calls with the same data are merged (a stream can only be read
+            once). """
+        obj = self.cashe.get(checksum_type, checksum_data)
+        return self._submit(('save_stream', str(obj), id(data)),
+                            obj.save_stream, data)
+
+    def unlink(self, checksum_type, checksum_data):
+        """ Remove an object from the cache. """
+        obj = self.cashe.get(checksum_type, checksum_data)
+        return self._submit(('unlink', str(obj)), obj.unlink)
+
+    def ls(self, checksum_type=None):
+        """ Get a list of all the objects in the cache. See CAShe.ls(). """
+        def _ls():
+            return list(self.cashe.ls(checksum_type))
+        return self._submit(('ls', checksum_type), _ls)
+
+def _stat_list(st):
+    """ The stat data we keep, for sending over the daemon socket. """
+    if st is None:
+        return None
+    return [st.st_size, st.st_nlink, st.st_atime, st.st_mtime, st.st_ctime,
+            st.st_ino, st.st_dev]
+
+# Daemon requests that change the CAShe, and the error when they aren't
+# allowed (see CASheDaemon._allowed).
+_daemon_mutating = ('cleanup', 'refresh')
+_daemon_eperm = "Not allowed"
+
+class CASheClient(object):
+    """ Client for a CASheDaemon, requests and replies are single lines of
+        JSON over the Unix socket. Calls raise an EnvironmentError if the
+        daemon isn't running. The timeout is only used for requests that
+        don't change anything, cleanup/refresh wait for as long as they take
+        (so we never fall back to doing the same thing at the same time). """
+
+    def __init__(self, sockpath, timeout=10):
+        import threading
+        self.sockpath = sockpath
+        self.timeout = timeout
+        self._sock = None
+        self._fo = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        """ Close the connection to the daemon. """
+        if self._sock is not None:
+            self._fo.close()
+            self._sock.close()
+        self._sock = None
+        self._fo = None
+
+    def _call(self, *req):
+        import socket
+        import json
+        self._lock.acquire()
+        try:
+            try:
+                if self._sock is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.settimeout(self.timeout)
+                    try:
+                        sock.connect(self.sockpath)
+                    except:
+                        sock.close()
+                        raise
+                    self._sock = sock
+                    self._fo = sock.makefile('rb')
+                if req[0] in _daemon_mutating:
+                    self._sock.settimeout(None)
+                else:
+                    self._sock.settimeout(self.timeout)
+                self._sock.sendall(json.dumps(req) + "\n")
+                line = self._fo.readline()
+            except EnvironmentError:
+                self.close()
+                raise
+            if not line:
+                self.close()
+                raise IOError(errno.ECONNRESET, "CAShe daemon went away")
+        finally:
+            self._lock.release()
+
+        ok, ret = json.loads(line)
+        if not ok:
+            if ret == _daemon_eperm:
+                raise OSError(errno.EPERM, "CAShe daemon: %s" % ret)
+            raise ValueError, "CAShe daemon: %s" % ret
+        return ret
+
+    def lookup(self, checksum_type, checksum_data):
+        """ Return the stat result for an object, or None if it doesn't
+            exist. The nlink/atime are from when the daemon last stat'd the
+            object, see CASheDaemon. """
+        ret = self._call('lookup', checksum_type, checksum_data)
+        if ret is None:
+            return None
+        return _index_stat(*ret)
+
+    def update(self, checksum_type, checksum_data):
+        """ Tell the daemon an object has been saved or removed. """
+        return self._call('update', checksum_type, checksum_data)
+
+    def snapshot(self, checksum_type=None):
+        """ Snapshots aren't sent over the socket, use summary/cleanup. """
+        return None
+
+    def summary(self, checksum_type=None, prefix=None):
+        """ Return the summary data, see CASheSnapshot.summary(). """
+        return self._call('summary', checksum_type, prefix)
+
+    def cleanup(self):
+        """ Have the daemon cleanup the CAShe, see CAShe.cleanup(). """
+        return self._call('cleanup')
+
+    def refresh(self):
+        """ Have the daemon re-read the CAShe from the filesystem. """
+        return self._call('refresh')
+
+class CASheDaemon(object):
+    """ Keeps the stat data for all the objects in a CAShe in memory, and
+        answers lookup/summary/cleanup requests from CASheClient's over a Unix
+        socket at meta/sock. So lots of processes can share a warm index
+        instead of each walking the CAShe. Saves and removals are sent to the
+        daemon by the clients, as hints to re-stat the object, and the whole
+        CAShe is re-read every refresh seconds to catch anything else (Eg.
+        the nlink/atime of an object changing, as it's linked/read outside
+        the CAShe, are only seen then). Anyone who can connect can do
+        lookups, but cleanup/refresh are only done for root, the user running
+        the daemon or (if the CAShe is group writable) its group. """
+
+    FLUSH = 60 # Seconds between saving our counters, see CAShe.stats()
+
+    def __init__(self, cashe, refresh=60 * 60):
+        """ Serve the stat data for a CAShe.
+
+        :param cashe: the CAShe to serve
+        :param refresh: seconds between re-reading the CAShe, or None
+        """
+        import threading
+        self.cashe = cashe
+        self.sockpath = cashe._meta_path("sock")
+        self.refresh_secs = refresh
+        self._lock = threading.Lock()
+        self._cleanup_lock = threading.Lock()
+        self._objs = {}
+        self._snap = None
+        self._server = None
+
+        # Our CAShe uses us, directly, for lookups and updates.
+        self.cashe._daemon = self
+
+    def refresh(self, index=False):
+        """ Re-read the stat data for all the objects. Returns the number
+            of objects.
+
+        :param index: a boolean specifying if we should use the index (if it
+                      exists), instead of looking at the filesystem.
+        """
+        self.cashe._stats.flush() # We never exit, so save them now and then.
+        self.cashe._set_layouts(_read_layouts(self.cashe.path))
+        objs = {}
+        if index and self.cashe._index is not None:
+            for (T, D), st in self.cashe._index.read().iteritems():
+                if T not in self.cashe._objs:
+                    continue
+                if len(D) != _checksum_d_len[T] or not _valid_checksum_data(D):
+                    continue
+                objs[(T, D)] = st
+        else:
+            snap = self.cashe.scan()
+            for row in xrange(len(snap)):
+                objs[snap.checksum(row)] = snap.stat(row)
+        self._lock.acquire()
+        self._objs = objs
+        self._snap = None
+        self._lock.release()
+        return len(objs)
+
+    def lookup(self, checksum_type, checksum_data):
+        """ Return the stat result for an object, or None. """
+        return self._objs.get((checksum_type, checksum_data))
+
+    def update(self, checksum_type, checksum_data):
+        """ Re-stat an object, after it was saved or removed. """
+        obj = self.cashe._get(checksum_type, checksum_data, cache=False)
+        st = self.cashe._stat(obj, ignore_EACCES=True)
+        key = (obj.checksum_type, obj.checksum_data)
+        self._lock.acquire()
+        if st is None:
+            self._objs.pop(key, None)
+        else:
+            self._objs[key] = st
+        self._snap = None
+        self._lock.release()
+        return st is not None
+
+    def snapshot(self, checksum_type=None):
+        """ Return a CASheSnapshot of the objects in memory. """
+        self._lock.acquire()
+        try:
+            if self._snap is None:
+                self._snap = CASheSnapshot()
+                for (T, D), st in sorted(self._objs.iteritems()):
+                    self._snap.append(T, D, st)
+            snap = self._snap
+        finally:
+            self._lock.release()
+
+        if checksum_type is None:
+            return snap
+        ret = CASheSnapshot()
+        for row in xrange(len(snap)):
+            T, D = snap.checksum(row)
+            if T == checksum_type:
+                ret.append(T, D, snap.stat(row))
+        return ret
+
+    def summary(self, checksum_type=None, prefix=None):
+        """ Return the summary data, see CASheSnapshot.summary(). """
+        import time
+        (lo, hi, age, sort_by) = self.cashe._get_config()
+        checksum_type = _checksum_aliases.get(checksum_type, checksum_type)
+        return self.snapshot().summary(sort_by, age, time.time(),
+                                       checksum_type, prefix)
+
+    def cleanup(self):
+        """ Cleanup the CAShe, see CAShe.cleanup(). """
+        self._cleanup_lock.acquire()
+        try:
+            return self.cashe._cleanup(True)
+        finally:
+            self._cleanup_lock.release()
+
+    def _allowed(self, cred):
+        """ Can a client, with the (pid, uid, gid) creds of the socket, change
+            the CAShe. """
+        if cred is None:
+            return False
+        pid, uid, gid = cred
+        if uid in (0, os.geteuid()):
+            return True
+        st = os.stat(self.cashe.path)
+        return bool(st.st_mode & 0020) and gid == st.st_gid
+
+    def _handle(self, req, cred=None):
+        """ Run a request from a client, returns a (ok, result) reply. """
+        if not req:
+            return False, "Bad request"
+        cmd = req[0]
+        if cmd in _daemon_mutating and not self._allowed(cred):
+            return False, _daemon_eperm
+        args = [arg if arg is None else str(arg) for arg in req[1:]]
+        try:
+            if cmd == 'lookup':
+                T, D = args
+                T = _checksum_aliases.get(T, T)
+                return True, _stat_list(self.lookup(T, D.lower()))
+            if cmd == 'update':
+                return True, self.update(*args)
+            if cmd == 'summary':
+                return True, self.summary(*args)
+            if cmd == 'cleanup':
+                return True, self.cleanup()
+            if cmd == 'refresh':
+                return True, self.refresh()
+        except (TypeError, ValueError), e:
+            return False, str(e)
+        return False, "Bad command: %s" % cmd
+
+    def _running(self):
+        """ Is there another daemon answering on the socket. """
+        try:
+            CASheClient(self.sockpath, timeout=1).lookup('sha256', '')
+        except EnvironmentError:
+            return False
+        return True
+
+    def serve_forever(self):
+        """ Read the CAShe, and then answer requests until interrupted. """
+        import threading
+        import json
+        try:
+            import socketserver
+        except ImportError: # Python-2
+            import SocketServer as socketserver
+
+        if self._running():
+            raise IOError(errno.EADDRINUSE, "CAShe daemon already running")
+        _unlink_f(self.sockpath)
+        if not os.path.exists(os.path.dirname(self.sockpath)):
+            os.makedirs(os.path.dirname(self.sockpath))
+
+        daemon = self
+        class _Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                cred = _peer_cred(self.request)
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        break
+                    try:
+                        req = json.loads(line)
+                    except ValueError:
+                        break
+                    reply = daemon._handle(req, cred)
+                    self.wfile.write(json.dumps(reply) + "\n")
+                    self.wfile.flush()
+        class _Server(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self.refresh(index=True)
+        def _refresh():
+            last = time.time()
+            while self._server is not None:
+                self._refresh_event.wait(min(self.FLUSH,
+                                             self.refresh_secs or self.FLUSH))
+                if self._server is None:
+                    break
+                if (self.refresh_secs and
+                        time.time() - last >= self.refresh_secs):
+                    self.refresh()
+                    last = time.time()
+                else:
+                    self.cashe._stats.flush()
+        self._refresh_event = threading.Event()
+
+        self._server = _Server(self.sockpath, _Handler)
+        try:
+            os.chmod(self.sockpath, 0666) # Lookups are for everyone, see _allowed
+            thread = threading.Thread(target=_refresh)
+            thread.daemon = True
+            thread.start()
+            self._server.serve_forever()
+        finally:
+            server = self._server
+            self._server = None
+            self._refresh_event.set()
+            server.server_close()
+            _unlink_f(self.sockpath)
+            self.cashe._stats.flush()
+
+    def shutdown(self):
+        """ Stop serve_forever(), from another thread. """
+        if self._server is not None:
+            self._server.shutdown()
+
+def _peer_cred(sock):
+    """ The (pid, uid, gid) of the process at the other end of a Unix socket,
+        or None if we can't tell (not Linux). """
+    import socket
+    import struct
+    # Python-2 doesn't have the constant, it's 17 on Linux.
+    SO_PEERCRED = getattr(socket, 'SO_PEERCRED', None)
+    if SO_PEERCRED is None and os.uname()[0] == 'Linux':
+        SO_PEERCRED = 17
+    if SO_PEERCRED is None:
+        return None
+    try:
+        data = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                               struct.calcsize('3i'))
+    except EnvironmentError:
+        return None
+    return struct.unpack('3i', data)
+
+def _sync_read(fo, size, chunk=1024 * 1024):
+    """ Yield size bytes of data from fo, in chunks. """
+    while size > 0:
+        buf = fo.read(min(size, chunk))
+        if not buf:
+            raise IOError(errno.EPIPE, "Short read in sync")
+        size -= len(buf)
+        yield buf
+
+def _write_manifest(fo, manifest):
+    """ Write a manifest, from CAShe.manifest(), as a "type num" line and then
+        the digests for each type. """
+    for T in sorted(manifest):
+        fo.write("%s %u\n" % (T, len(manifest[T])))
+        fo.write("".join(sorted(manifest[T])))
+    fo.write("end\n")
+
+def _read_manifest(fo):
+    ret = {}
+    while True:
+        line = fo.readline().split()
+        if line == ['end']:
+            return ret
+        if len(line) != 2 or line[0] not in _checksum_d_len:
+            raise IOError(errno.EPROTO, "Bad manifest in sync")
+        T, num = line[0], int(line[1])
+        dlen = _checksum_d_len[T] / 2
+        data = "".join(_sync_read(fo, num * dlen))
+        ret[T] = set([data[off:off + dlen]
+                      for off in xrange(0, len(data), dlen)])
+
+def _sync_server(cashe, fi, fo, chunk=1024 * 1024):
+    """ Answer the requests of a CASheSyncConn, from fi and with the replies
+        to fo, until EOF. The requests are:
+
+        manifest HOT INDEX: the manifest, see _write_manifest().
+        get TYPE DIGEST: "ok SIZE ATIME MTIME" then the data of the object,
+                         or "missing".
+        put TYPE DIGEST SIZE ATIME MTIME PRESERVE: then the data, which is
+                         saved as the object and "ok" or "bad" (didn't match).
+    """
+    while True:
+        req = fi.readline().split()
+        if not req or req == ['quit']:
+            break
+        if req[0] == 'manifest' and len(req) == 3:
+            hot = float(req[1]) or None
+            _write_manifest(fo, cashe.manifest(hot, req[2] == '1'))
+        elif req[0] == 'get' and len(req) == 3:
+            obj = cashe._get(req[1], req[2], cache=False)
+            try:
+                data = obj.open()
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                fo.write("missing\n")
+            else:
+                try:
+                    fo.write("ok %u %.9f %.9f\n" % (obj.size, obj.atime,
+                                                      obj.mtime))
+                    fo.flush()
+                    for buf in _sync_read(data, obj.size, chunk):
+                        fo.write(buf)
+                finally:
+                    data.close()
+        elif req[0] == 'put' and len(req) == 7:
+            obj = cashe._get(req[1], req[2], cache=False)
+            ret = obj.save_stream(_sync_read(fi, int(req[3]), chunk))
+            if ret is not None and req[6] == '1':
+                obj.utime((float(req[4]), float(req[5])))
+            if ret is None:
+                fo.write("bad\n")
+            else:
+                fo.write("ok\n")
+        else:
+            raise IOError(errno.EPROTO, "Bad request in sync: " + " ".join(req))
+        fo.flush()
+
+class CASheSyncConn(object):
+    """ A connection to a "cashe sync-server" process (Eg. run over ssh),
+        which answers requests on its stdin/stdout, see _sync_server(). """
+
+    def __init__(self, cmd):
+        import subprocess
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, close_fds=True)
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.write("quit\n")
+            self._proc.stdin.close()
+        except EnvironmentError:
+            pass
+        self._proc.wait()
+        self._proc = None
+
+    def _call(self, req):
+        self._proc.stdin.write(req + "\n")
+        self._proc.stdin.flush()
+
+    def _reply(self):
+        ret = self._proc.stdout.readline().split()
+        if not ret:
+            raise IOError(errno.EPIPE, "Sync server went away")
+        return ret
+
+    def manifest(self, hot=None, index=True):
+        self._call("manifest %f %u" % (hot or 0, index))
+        return _read_manifest(self._proc.stdout)
+
+    def get(self, obj, preserve=False):
+        """ Copy an object from the server, into obj. Returns the size or
+            None if it didn't exist (or didn't match). """
+        self._call("get %s %s" % (obj.checksum_type, obj.checksum_data))
+        ret = self._reply()
+        if ret[0] != 'ok':
+            return None
+        size, atime, mtime = int(ret[1]), float(ret[2]), float(ret[3])
+        ret = obj.save_stream(_sync_read(self._proc.stdout, size))
+        if ret is None:
+            return None
+        if preserve:
+            obj.utime((atime, mtime))
+        return size
+
+    def put(self, obj, preserve=False):
+        """ Copy obj to the server. Returns the size or None if it didn't
+            exist (or didn't match). """
+        try:
+            fo = obj.open()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            size = obj.size
+            self._call("put %s %s %u %.9f %.9f %u" %
+                       (obj.checksum_type, obj.checksum_data, size,
+                        obj.atime, obj.mtime, preserve))
+            for buf in _sync_read(fo, size):
+                self._proc.stdin.write(buf)
+            self._proc.stdin.flush()
+        finally:
+            fo.close()
+        if self._reply()[0] != 'ok':
+            return None
+        return size
+
+class CASheRemote(object):
+    """ A CAShe in another process, which is one end of a sync. Each thread
+        gets its own connection, so the copies are parallel streams. """
+
+    def __init__(self, cmd):
+        import threading
+        self.cmd = cmd
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = []
+
+    def close(self):
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = CASheSyncConn(self.cmd)
+            self._local.conn = conn
+            self._lock.acquire()
+            self._conns.append(conn)
+            self._lock.release()
+        return conn
+
+    def manifest(self, hot=None, index=True):
+        """ See CAShe.manifest(). """
+        return self._conn().manifest(hot, index)
+
+def _sync(src, dst, hot, jobs, index, preserve):
+    """ Copy the objects from src which aren't in dst, see CAShe.sync_to().
+        At most one of them can be a CASheRemote. """
+    import binascii
+    have = dst.manifest(index=index)
+    items = []
+    for T, digests in sorted(src.manifest(hot, index).iteritems()):
+        missing = digests - have.get(T, set())
+        items.extend([(T, binascii.hexlify(D)) for D in sorted(missing)])
+    del have
+
+    def _copy(item):
+        T, D = item
+        if isinstance(src, CASheRemote):
+            return T, D, src._conn().get(dst._get(T, D, cache=False),
+                                         preserve)
+        sobj = src._get(T, D, cache=False)
+        if isinstance(dst, CASheRemote):
+            return T, D, dst._conn().put(sobj, preserve)
+
+        dobj = dst._get(T, D, cache=False)
+        try:
+            if sobj.packed:
+                ret = dobj.save_stream(sobj.open())
+            else:
+                ret = dobj.save(sobj.filename, checksum=False, link=False)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return T, D, None # Removed, since the manifest.
+        if ret is None:
+            return T, D, None
+        if preserve:
+            dobj.utime((sobj.atime, sobj.mtime))
+        return T, D, dobj.size
+
+    pool = None
+    if jobs > 1 and len(items) > 1:
+        try:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(jobs, len(items)))
+        except ImportError:
+            pass
+    if pool is None:
+        for item in items:
+            yield _copy(item)
+        return
+
+    try:
+        for ret in pool.imap_unordered(_copy, items):
+            yield ret
+    finally:
+        pool.terminate()
+
+def _main_fast(args):
+    """ Run the load/save-fast/unlink commands, for a single object, without
+        any setup (they are run from hooks lots of times). Returns False if
+        the arguments aren't one of those, so the normal path can run it. """
+    path = "/var/cache/CAShe"
+    if args and args[0].startswith("--path="):
+        path = args[0][len("--path="):]
+        args = args[1:]
+    elif len(args) >= 2 and args[0] == "--path":
+        path = args[1]
+        args = args[2:]
+    if not args:
+        return False
+    cmd = {'rm' : 'unlink'}.get(args[0], args[0])
+    nargs = {'load' : 4, 'save-fast' : 4, 'unlink' : 3}
+    if nargs.get(cmd) != len(args):
+        return False
+    for arg in args:
+        if arg.startswith("-"):
+            return False
+
+    try:
+        objs = CAShe(path)
+        if cmd == "load":
+            _main_load(objs, args)
+        if cmd == "save-fast":
+            _main_save_fast(objs, args)
+        if cmd == "unlink":
+            _main_unlink(objs, args)
+    except Exception, e:
+        print >>sys.stderr, "Error:", str(e)
+    return True
+
+def _main_load(objs, cmds):
+    """ load <type> <data> <filename> """
+    obj = objs.get(cmds[1], cmds[2])
+    obj.load(cmds[3])
+
+def _main_save_fast(objs, cmds, link=None):
+    """ save-fast <type> <data> <filename>, files owned by someone else
+        aren't linked unless link is True. """
+    obj = objs.get(cmds[1], cmds[2])
+    if link is None:
+        if os.stat(cmds[3]).st_uid != os.stat(objs.path).st_uid:
+            obj.link = False
+    obj.save(cmds[3], checksum=False)
+
+def _main_unlink(objs, cmds):
+    """ unlink <type> <data> """
+    obj = objs.get(cmds[1], cmds[2])
+    obj.unlink()
+
 def _main():
     """ CAShe test function, setup opts. """
+    if _main_fast(sys.argv[1:]):
+        return
+
     import optparse
     global prog
 
-    remap_cmds = {'rsync2' : 'rsync-to',
+    remap_cmds = {'rsync2' : 'sync-to',
+                  'rsync-to' : 'sync-to',
+                  'rsync-from' : 'sync-from',
                   'usage' : 'help',
                   'ls' : 'list',
                   'rm' : 'unlink',
@@ -713,7 +5063,8 @@ def _main():
     all_cmds = ("summary", "list", "info", "check",
                 "load", "save", "save-fast", "merge", "unlink",
                 "cleanup", "ls-extra", "rm-extra", "list-files", "recent",
-                "rsync-from", "rsync-to",
+                "pack", "reindex", "reshard", "serve", "stats", "sync-from",
+                "sync-to", "sync-server",
                 "config", "help")
 
     argp = optparse.OptionParser(
@@ -729,7 +5080,7 @@ def _main():
             help='path to the CAShe storage, defaults to the system cache')
     argp.add_option('-p',
             '--preserve', default=False, action='store_true',
-            help='preserve filetimes when using rsync')
+            help='preserve filetimes when syncing')
     argp.add_option(
             '--sort-by', default="filename",
             help='what to sort list/info command by')
@@ -737,6 +5088,33 @@ def _main():
             help='try to link in load/save operations (default)')
     argp.add_option('--copy-only', dest='link', action='store_false',
             help='try to link in load/save operations')
+    argp.add_option(
+            '--aliases', default=False, action='store_true',
+            help='save objects as all the configured checksum types')
+    argp.add_option('-j',
+            '--jobs', default=None, type='int',
+            help='number of objects to check/sync in parallel')
+    argp.add_option(
+            '--link-only', default=False, action='store_true',
+            help='merge only links files to objects, without saving any')
+    argp.add_option(
+            '--prefix-check', default=0, type='int',
+            help='with --link-only, compare the first KB before checksumming')
+    argp.add_option(
+            '--hash-cache', default=False, action='store_true',
+            help='keep the checksums of files merged/saved, for next time')
+    argp.add_option(
+            '--hot', default=None,
+            help='only sync objects used within this age, Eg. 2d')
+    argp.add_option(
+            '--rsh', default="ssh",
+            help='command to run cashe on a remote host, when syncing')
+    argp.add_option(
+            '--exact', default=False, action='store_true',
+            help='look at all the objects, instead of the journal/index')
+    argp.add_option(
+            '--force', default=False, action='store_true',
+            help='check objects, even if they are unchanged since last checked')
     (opts, cmds) = argp.parse_args()
 
     if argp.prog is not None:
@@ -772,20 +5150,24 @@ def _main_cmds(opts, cmds, cmd):
     """ CAShe test function, run commands. """
     import time
     import stat
-    try:
-        import xattr
-        if not hasattr(xattr, 'get'):
-            xattr = None # This is a "newer" API.
-    except ImportError:
-        xattr = None
+    xattr = None
+    if cmd in ("list", "info", "recent"): # Only needed to show origin URLs
+        try:
+            import xattr
+            if not hasattr(xattr, 'get'):
+                xattr = None # This is a "newer" API.
+        except ImportError:
+            xattr = None
 
     def _ui_origin_url(filename):
         # See: http://www.freedesktop.org/wiki/CommonExtendedAttributes
+        if xattr is None:
+            return ''
         try:
             return xattr.get(filename, 'user.xdg.origin.url')
         except IOError, e:
             ok = False
-            if e.errno in (errno.ENODATA,
+            if e.errno in (errno.ENODATA, errno.ENOENT, # Packed objects.
                            errno.EOPNOTSUPP, errno.E2BIG, errno.ERANGE):
                 ok = True
             for me in ("ENOATTR", "ENOTSUPP"):
@@ -857,14 +5239,26 @@ def _main_cmds(opts, cmds, cmd):
         if len(cmds) >= 2:
             D = cmds[1]
         return T, D
-    def _get_objs(objs, opts, T, D, osort_by=None):
+    naliases = {}
+    def _get_objs(objs, opts, T, D, osort_by=None, index=False):
         if osort_by is None:
             osort_by = opts.sort_by
-        for obj in sorted(objs.ls(checksum_type=T),
-                          key=lambda x: getattr(x, osort_by)):
+        T = _checksum_aliases.get(T, T)
+        # Need all types, to find the aliases
+        aobjs = list(objs.ls(index=index))
+        for gobjs in objs._alias_groups(aobjs):
+            naliases[(gobjs[0].st_dev, gobjs[0].st_ino)] = len(gobjs)
+        for obj in sorted(aobjs, key=lambda x: getattr(x, osort_by)):
+            if T is not None and obj.checksum_type != T:
+                continue
             if D is not None and not obj.checksum_data.startswith(D):
                 continue
             yield obj
+    def _naliases(obj):
+        return naliases.get((obj.st_dev, obj.st_ino), 1)
+    def _nlink(obj):
+        """ Number of links to the object, not counting its aliases. """
+        return obj.nlink - _naliases(obj) + 1
 
     # Actual start of main()
     objs = CAShe(opts.path)
@@ -885,6 +5279,17 @@ def _main_cmds(opts, cmds, cmd):
         print "        Age(%s):" % _dtxt(dage, age), _ui_age(age)
         print "       Time(%s):" % _dtxt(dtsort_by, tsort_by), tsort_by
         print "       Path(%s):" %_dtxt("/var/cache/CAShe", objs.path),objs.path
+        fanout = objs._get_config_fanout()
+        print "     Fanout(%s):" % _dtxt(_def_layout, fanout), "%u:%u" % fanout,
+        if objs._layouts != (fanout,):
+            print "(layout: %s)" % ", ".join(["%u:%u" % layout
+                                              for layout in objs._layouts]),
+        print
+        pack = objs._get_config_pack()
+        print "       Pack(%s):" % _dtxt(_def_pack, pack), _ui_num(pack),
+        if objs._packs is None:
+            print "(off)",
+        print
 
     if cmd == "summary":
         T = None
@@ -895,35 +5300,44 @@ def _main_cmds(opts, cmds, cmd):
             D = cmds[2]
 
         now = time.time()
-        summary_data = {'used-objs' : 0,
-                        'used-size' : 0,
-                        'free-objs': 0,
-                        'free-objs-old': 0,
-                        'free-size': 0,
-                        'free-size-old': 0,
-                        }
-        Ts = {"." : summary_data.copy()}
-        for obj in _get_objs(objs, opts, T, D, osort_by="filename"):
-            if obj.checksum_type not in Ts:
-                Ts[obj.checksum_type] = summary_data.copy()
-
-            if obj.nlink > 1:
-                Ts[obj.checksum_type]['used-objs'] += 1
-                Ts[obj.checksum_type]['used-size'] += obj.size
-                Ts['.']['used-objs'] += 1
-                Ts['.']['used-size'] += obj.size
-            elif not objs._is_new(obj, tsort_by, age, now):
-                Ts[obj.checksum_type]['free-objs-old'] += 1
-                Ts[obj.checksum_type]['free-size-old'] += obj.size
-                Ts['.']['free-objs-old'] += 1
-                Ts['.']['free-size-old'] += obj.size
+        T = _checksum_aliases.get(T, T)
+        ok = False
+        if not opts.exact:
+            ok, Ts = objs._daemon_call('summary', T, D)
+        if not ok and not opts.exact and not opts.verbose and D is None:
+            # Just the totals, from the journal (which doesn't know what is
+            # used/free/old, so -v needs the scan).
+            totals = None
+            if objs._usage is not None:
+                totals = objs._usage.read()
+            if totals is not None:
+                ok = True
+                Ts = {}
+                for uT, (num, size) in totals.iteritems():
+                    if T is not None and uT != T:
+                        continue
+                    if uT != '.' and not num:
+                        continue
+                    Ts[uT] = {'objs' : num, 'size' : size}
+                if T is not None and T in Ts:
+                    Ts['.'] = Ts[T]
+                if '.' not in Ts:
+                    Ts['.'] = {'objs' : 0, 'size' : 0}
+        if not ok:
+            # Need all types, to find the aliases
+            if opts.exact:
+                snap = objs.scan()
             else:
-                Ts[obj.checksum_type]['free-objs'] += 1
-                Ts[obj.checksum_type]['free-size'] += obj.size
-                Ts['.']['free-objs'] += 1
-                Ts['.']['free-size'] += obj.size
+                snap = objs.scan(index=True)
+            Ts = snap.summary(tsort_by, age, now, T, D)
+            if T is None and D is None:
+                objs._write_usage(snap, create=True)
 
         def _prnt_summary(data):
+            if 'objs' in data: # Just the totals, see above.
+                print "       Objs:", _ui_num(data['objs'])
+                print "       Size:", _ui_num(data['size'])
+                return
             if opts.verbose:
                 print "  Used Objs:", _ui_num(data['used-objs'])
                 print "  Used Size:", _ui_num(data['used-size'])
@@ -945,7 +5359,7 @@ def _main_cmds(opts, cmds, cmd):
         _prnt_summary(Ts['.'])
 
     def _prnt_list(obj):
-        if obj.nlink > 1:
+        if _nlink(obj) > 1:
             prefix = " "
         elif objs._is_new(obj, tsort_by, age, now):
             prefix = "*"
@@ -962,30 +5376,46 @@ def _main_cmds(opts, cmds, cmd):
         now = time.time()
         T, D = _get_T_D(cmds)
 
-        for obj in _get_objs(objs, opts, T, D):
+        for obj in _get_objs(objs, opts, T, D, index=True):
             _prnt_list(obj)
 
     if cmd == "check":
         now = time.time()
         T, D = _get_T_D(cmds)
 
-        for obj in _get_objs(objs, opts, T, D):
-            if obj.nlink > 1:
-                prefix = " "
+        cobjs = list(_get_objs(objs, opts, T, D))
+        prefixes = {}
+        size = 0
+        for obj in cobjs:
+            if _nlink(obj) > 1:
+                prefixes[str(obj)] = " "
             elif objs._is_new(obj, tsort_by, age, now):
-                prefix = "*"
+                prefixes[str(obj)] = "*"
             else:
-                prefix = "!"
-            print "%s%-6s %-64s %s" % (prefix, obj.checksum_type,
-                                       obj.checksum_data,
-                                       obj.checked_filename is not None)
+                prefixes[str(obj)] = "!"
+            size += obj.size
+
+        bad = 0
+        beg = time.time() # Not the listing, just the checks.
+        for obj, ok in objs.check(cobjs, jobs=opts.jobs, force=opts.force):
+            if not ok:
+                bad += 1
+            print "%s%-6s %-64s %s" % (prefixes[str(obj)], obj.checksum_type,
+                                       obj.checksum_data, ok)
+
+        secs = max(time.time() - beg, 0.001)
+        print "Checked %u object(s), %u bad, %s in %.2fs" % (len(cobjs), bad,
+                                                         _ui_num(size).strip(),
+                                                         secs)
+        print "  %s/s, %.1f objs/s" % (_ui_num(int(size / secs)).strip(),
+                                        len(cobjs) / secs)
 
     if cmd == "info":
         now = time.time()
         T, D = _get_T_D(cmds)
 
         done = False
-        for obj in _get_objs(objs, opts, T, D):
+        for obj in _get_objs(objs, opts, T, D, index=True):
             if done: print ''
             done = True
             print "Type:", obj.checksum_type
@@ -994,12 +5424,17 @@ def _main_cmds(opts, cmds, cmd):
             if not objs._is_new(obj, tsort_by, age, now):
                 suffix = "(old)"
             print "   Size:", _ui_num(obj.size), suffix
-            print "  Links:", _ui_num(obj.nlink - 1)
+            print "  Links:", _ui_num(_nlink(obj) - 1)
+            if _naliases(obj) > 1:
+                print "Aliases:", _ui_num(_naliases(obj) - 1)
             print " M-Time:", _ui_time(obj.mtime)
             print " A-Time:", _ui_time(obj.atime)
             if opts.verbose or tsort_by == "ctime":
                 print " C-Time:", _ui_time(obj.ctime)
-            if opts.verbose:
+            if opts.verbose and obj.packed:
+                print "   Pack:", objs._pack(obj.checksum_type).filename(
+                                                            obj.checksum_data)
+            elif opts.verbose:
                 print "   File:", obj.filename
             if xattr:
                 xd = _ui_origin_url(obj.filename)
@@ -1010,47 +5445,31 @@ def _main_cmds(opts, cmds, cmd):
         if len(cmds) != 4:
             print >>sys.stderr, prog, "load <type> <data> <filename>"
             sys.exit(1)
-        obj = objs.get(cmds[1], cmds[2])
-        obj.load(cmds[3])
+        _main_load(objs, cmds)
 
-    if cmd == "merge":
-        if opts.link is None:
-            cas_path_uid = os.stat(objs.path).st_uid
+    if cmd in ("merge", "save") and opts.hash_cache:
+        # Creating the file turns on the hash cache.
+        if not os.path.exists(objs._meta_path("hashes")):
+            if not os.path.exists(objs._meta_path("")):
+                os.makedirs(objs._meta_path(""))
+            open(objs._meta_path("hashes"), "a").close()
 
+    if cmd == "merge":
         if len(cmds) < 2:
             print >>sys.stderr, prog, "merge <type> <filename> [...]"
             sys.exit(1)
 
         counts = [0, 0]
-        def _merge_file(filename):
-            st   = os.stat(filename)
-            if stat.S_ISDIR(st.st_mode):
-                for fname in os.listdir(filename):
-                    _merge_file("%s/%s" % (filename, fname))
-                return
-
+        for filename, obj, how in objs.merge(cmds[2:], cmds[1], opts.link,
+                                             opts.jobs, not opts.exact,
+                                             opts.link_only,
+                                             opts.prefix_check * 1024):
             if opts.verbose:
                 print " File:", filename
-
-            data = _file2hexdigest(cmds[1], filename)
-            obj  = objs.get(cmds[1], data)
-
-            if obj.exists:
-                if obj.st_dev == st.st_dev and obj.st_ino == st.st_ino:
-                    return
-
-                # FIXME: Need link only...
-                if opts.link is not False and obj.load(filename):
-                    counts[1] += 1
-                return
-
-            if opts.link is None:
-                if st.st_uid != cas_path_uid:
-                    obj.link = False
-            if obj.save(filename, checksum=False):
+            if how == "save":
                 counts[0] += 1
-        for filename in cmds[2:]:
-            _merge_file(filename)
+            elif how == "load":
+                counts[1] += 1
         print "Merged %u object(s) into the CAShe, %u from it" % tuple(counts)
 
     if cmd == "save":
@@ -1058,7 +5477,20 @@ def _main_cmds(opts, cmds, cmd):
             cas_path_uid = os.stat(objs.path).st_uid
 
         count = 0
-        if len(cmds) == 3:
+        if opts.aliases and len(cmds) >= 3:
+            checksums = [_checksum_aliases.get(cmds[1], cmds[1])]
+            checksums += objs._get_config_aliases()
+            for filename in cmds[2:]:
+                if opts.verbose:
+                    print " File:", filename
+                link = None
+                if opts.link is None:
+                    if os.stat(filename).st_uid != cas_path_uid:
+                        link = False
+                if objs.save_aliases(filename, checksums, link=link):
+                    count += 1
+            data     = None
+        elif len(cmds) == 3:
             data     = _file2hexdigest(cmds[1], cmds[2])
             filename = cmds[2]
             checksum = False
@@ -1070,12 +5502,13 @@ def _main_cmds(opts, cmds, cmd):
             for filename in cmds[2:]:
                 if opts.verbose:
                     print " File:", filename
-                data = _file2hexdigest(cmds[1], filename)
+                data = objs.checksum_file(cmds[1], filename)
                 obj  = objs.get(cmds[1], data)
                 if opts.link is None:
                     if os.stat(filename).st_uid != cas_path_uid:
                         obj.link = False
                 if obj.save(filename, checksum=False):
+                    objs._hashed(filename, obj.checksum_type, data)
                     count += 1
             data     = None
         else:
@@ -1095,54 +5528,70 @@ def _main_cmds(opts, cmds, cmd):
         if len(cmds) != 4:
             print >>sys.stderr, prog, "save-fast <type> <data> <filename>"
             sys.exit(1)
-        obj = objs.get(cmds[1], cmds[2])
-        if opts.link is None:
-            if os.stat(cmds[3]).st_uid != os.stat(objs.path).st_uid:
-                obj.link = False
-        obj.save(cmds[3], checksum=False)
+        _main_save_fast(objs, cmds, opts.link)
 
     if cmd == "unlink":
         if len(cmds) != 3:
             print >>sys.stderr, prog, "unlink <type> <data>"
             sys.exit(1)
-        obj = objs.get(cmds[1], cmds[2])
-        obj.unlink()
+        _main_unlink(objs, cmds)
 
     if cmd == "cleanup":
         objs, size = objs.cleanup()
         print "--All--:"
         print "  Objs:", _ui_num(objs)
         print "  Size:", _ui_num(size)
-    if cmd in ("ls-extra", "rm-extra"):
-        def _y_extras():
-            for T in sorted(objs._objs):
-                subdirname = "%s/%s" % (objs.path, T)
-
-                for subfilename in _listdir(subdirname):
-                    path = "%s/%s" % (subdirname, subfilename)
-                    if len(subfilename) != 4:
-                        yield path
-                        continue
-                    if not _valid_checksum_data(subfilename):
-                        yield path
-                        continue
-                    for filename in _listdir(path):
-                        path = "%s/%s/%s" % (subdirname, subfilename, filename)
-                        if not filename.startswith(subfilename):
-                            yield path
-                            continue
-                        if len(filename) != _checksum_d_len[T]:
-                            yield path
-                            continue
-                        if not _valid_checksum_data(filename):
-                            yield path
-                            continue
+    if cmd == "reindex":
+        num = objs.reindex()
+        print "Indexed %u object(s) in the CAShe" % num
+    if cmd == "pack":
+        size = None
+        if len(cmds) >= 2:
+            size = _parse_size(cmds[1])
+            if size is None:
+                print >>sys.stderr, prog, "pack [<size>]"
+                sys.exit(1)
+        num = objs.pack(size)
+        print "Packed %u object(s) in the CAShe" % num
+    if cmd == "reshard":
+        layout = None
+        if len(cmds) >= 2:
+            layout = _parse_layout(cmds[1])
+            if layout is None:
+                print >>sys.stderr, prog, "reshard [<depth>:<width>]"
+                sys.exit(1)
+        num = objs.reshard(layout)
+        print "Moved %u object(s) in the CAShe" % num
+    if cmd == "stats":
+        # Creating the directory turns on saving the stats.
+        if not os.path.exists(objs._stats.dirname):
+            os.makedirs(objs._stats.dirname)
+        if len(cmds) >= 2 and cmds[1] == "reset":
+            objs._stats.reset()
+        counts = objs.stats()
+        for name in sorted(counts):
+            if name.endswith("-secs"):
+                print "%20s: %.2fs" % (name, counts[name])
+            elif name.endswith("-bytes"):
+                print "%20s: %s" % (name, _ui_num(counts[name]).strip())
+            else:
+                print "%20s: %u" % (name, counts[name])
+        loads = counts.get('load-hits', 0) + counts.get('load-misses', 0)
+        if loads:
+            print "%20s: %.1f%%" % ("Hit ratio",
+                                    counts.get('load-hits', 0) * 100.0 / loads)
+    if cmd == "serve":
+        daemon = CASheDaemon(objs)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
     if cmd == "ls-extra":
-        for f in _y_extras():
+        for f in objs.ls_extra():
             print f
     if cmd == "rm-extra":
         now = time.time()
-        for f in _y_extras():
+        for f in objs.ls_extra():
             try:
                 fmtime = os.stat(f).st_mtime
                 if fmtime > now:
@@ -1156,6 +5605,7 @@ def _main_cmds(opts, cmds, cmd):
                     continue
             except OSError, e:
                 if e.errno == errno.EISDIR:
+                    import shutil
                     shutil.rmtree(f, ignore_errors=True)
                     print "rm -r", f
             _try_rmdir(os.path.dirname(f))
@@ -1166,7 +5616,8 @@ def _main_cmds(opts, cmds, cmd):
         T, D = _get_T_D(cmds)
 
         for obj in _get_objs(objs, opts, T, D):
-            print obj.filename
+            if not obj.packed:
+                print obj.filename
     if cmd == "recent":
         if opts.sort_by not in ("atime", "ctime", "mtime"):
             opts.sort_by = "mtime"
@@ -1188,54 +5639,62 @@ def _main_cmds(opts, cmds, cmd):
         for obj in a1:
             _prnt_list(obj)
 
-    def _rsync_cmd(src, dst, src_local=False):
-        # --ignore-existing vs. --size-only ?
-        # "--ignore-missing-args" is what we want, but is fairly new
-        # rcmd = ["rsync", "--recursive", "--size-only", "--links"]
-        rcmd = ["rsync", "--recursive", "--ignore-existing", "--links"]
-        if opts.verbose:
-            rcmd.extend(["--verbose", "--progress"])
-        if opts.preserve:
-            rcmd.extend(["--preserve"])
-        done = False
-        for chk in _checksum_d_len:
-            chkdir = "%s/%s" % (src, chk)
-            if src_local and not os.path.exists(chkdir):
-                continue
-            done = True
-            rcmd.append(chkdir)
-        if not done:
-            if opts.verbose:
-                print "empty CAShe:", src
-            return 0
-        rcmd.append(dst)
-        if opts.verbose:
-            print " ".join(rcmd)
-        return os.spawnlp(os.P_WAIT, rcmd[0], *rcmd)
-
-    if cmd in ("rsync-to", "rsync2"):
+    def _sync_peer(spec):
+        """ A CASheRemote for host:path (like rsync, and just host: is the
+            same path as ours), or a CAShe for a local path. """
+        host, path = None, spec
+        if ':' in spec and '/' not in spec.split(':', 1)[0]:
+            host, path = spec.split(':', 1)
+        if not path:
+            path = objs.path
+        if host is None:
+            return CAShe(path)
+        return CASheRemote(opts.rsh.split() +
+                           [host, "cashe", "--path", path, "sync-server"])
+
+    if cmd in ("sync-to", "sync-from"):
         if len(cmds) != 2:
-            print >>sys.stderr, prog, cmd, "<destination>"
+            if cmd == "sync-to":
+                print >>sys.stderr, prog, cmd, "<destination>"
+            else:
+                print >>sys.stderr, prog, cmd, "<source>"
             sys.exit(1)
-
-        if cmds[1].endswith(":"):
-            cmds[1] = cmds[1] + objs.path
-
-        ret = _rsync_cmd(objs.path, cmds[1], src_local=True)
-        if ret:
-            sys.exit(ret)
-
-    if cmd == "rsync-from":
-        if len(cmds) != 2:
-            print >>sys.stderr, prog, cmd, "<source>"
+        hot = None
+        if opts.hot is not None:
+            hot = _parse_age(opts.hot)
+            if hot is None:
+                print >>sys.stderr, prog, cmd, "--hot <age>"
+                sys.exit(1)
+
+        peer = _sync_peer(cmds[1])
+        sync = objs.sync_to
+        if cmd == "sync-from":
+            sync = objs.sync_from
+        num, size, fails = 0, 0, 0
+        try:
+            for T, D, osize in sync(peer, hot, opts.jobs, not opts.exact,
+                                    opts.preserve):
+                if osize is None:
+                    fails += 1
+                    if opts.verbose:
+                        print " !! ", "%s:%s" % (T, D)
+                    continue
+                num += 1
+                size += osize
+                if opts.verbose:
+                    print "%s:%s" % (T, D), _ui_num(osize).strip()
+        finally:
+            if isinstance(peer, CASheRemote):
+                peer.close()
+        print "--All--:"
+        print "  Objs:", _ui_num(num)
+        print "  Size:", _ui_num(size)
+        if fails:
+            print "Failed to copy %u object(s)" % fails
             sys.exit(1)
 
-        if cmds[1].endswith(":"):
-            cmds[1] = cmds[1] + objs.path
-
-        ret = _rsync_cmd(cmds[1], objs.path)
-        if ret:
-            sys.exit(ret)
+    if cmd == "sync-server":
+        _sync_server(objs, sys.stdin, sys.stdout)
 
     if cmd == "checksum-file":
         if len(cmds) != 3:
@@ -1,5 +1,6 @@
 #! /usr/bin/python -t
 
+import contextlib
 import os
 import sys
 import tempfile
@@ -45,6 +46,20 @@ def fwrite(path, data):
     fo = open(path, "w")
     fo.write(data)
 
+@contextlib.contextmanager
+def checksummed():
+    """ Collect the filenames that cashe reads to checksum, in a list. """
+    sums = []
+    orig = cashe._file2hexdigest
+    def _file2hexdigest(checksum_type, filename, *args, **kwargs):
+        sums.append(filename)
+        return orig(checksum_type, filename, *args, **kwargs)
+    cashe._file2hexdigest = _file2hexdigest
+    try:
+        yield sums
+    finally:
+        cashe._file2hexdigest = orig
+
 class Cashe_tests(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         unittest.TestCase.__init__(self, *args, **kwargs)
@@ -310,6 +325,891 @@ class Cashe_tests(unittest.TestCase):
         x.cleanup()
         self.assertEqual(3, len(list(x.ls())))
 
+    def test4_index(self):
+        x = cashe.CAShe(self.tdir + "/test4")
+
+        datai = x.path + "/data4.1"
+        fwrite(datai, "a")
+        co = x.get('sha256', d2s['a'])
+        co.save(datai, link=False)
+        self.assertEqual(1, x.reindex())
+
+        datai = x.path + "/data4.2"
+        fwrite(datai, "aa")
+        co = x.get('sha256', d2s['aa'])
+        co.save(datai, link=False)
+
+        x = cashe.CAShe(self.tdir + "/test4")
+        objs = list(x.ls(index=True))
+        self.assertEqual(2, len(objs))
+        self.assertEqual([1, 2], sorted([obj.size for obj in objs]))
+
+        x.get('sha256', d2s['a']).unlink()
+        x = cashe.CAShe(self.tdir + "/test4")
+        self.assertEqual(1, len(list(x.ls(index=True))))
+
+        # Index entries are re-checked before removal, so stale ones are ok.
+        os.unlink(x.get('sha256', d2s['aa']).filename)
+        fwrite(x.path + "/config", "lo = 0 \n hi = 0\n")
+        self.assertEqual((0, 0), x.cleanup())
+
+        # Objects saved by link are used, until the file outside goes away.
+        datai = x.path + "/data4.3"
+        fwrite(datai, "aaa")
+        self.assertTrue(x.get('sha256', d2s['aaa']).save(datai))
+        self.assertEqual((0, 0), x.cleanup())
+        os.unlink(datai)
+        self.assertEqual((1, 3), cashe.CAShe(x.path).cleanup())
+        self.assertEqual({}, x._index.read())
+
+        # The log is compacted, when it's mostly old entries.
+        x._index.COMPACT = 4
+        obj = x.get('sha256', d2s['a'])
+        for num in range(3):
+            fwrite(datai, "a")
+            obj.save(datai, link=False)
+            obj.unlink()
+        self.assertTrue(len(open(x._index.filename).readlines()) > 6)
+        self.assertEqual({}, x._index.read())
+        self.assertEqual(0, len(open(x._index.filename).readlines()))
+
+    def test5_ls_extra(self):
+        x = cashe.CAShe(self.tdir + "/test5")
+
+        datai = x.path + "/data5.1"
+        fwrite(datai, "a")
+        co = x.get('sha256', d2s['a'])
+        co.save(datai)
+        fwrite(co.dirname + "/junk", "a")
+        os.makedirs(x.path + "/sha256/zzzz")
+        fwrite(co.dirname + "/" + d2s['a'].upper(), "a")
+
+        self.assertEqual(1, len(list(x.ls())))
+        self.assertEqual(sorted([co.dirname + "/junk",
+                                 co.dirname + "/" + d2s['a'].upper(),
+                                 x.path + "/sha256/zzzz"]),
+                         sorted(x.ls_extra()))
+
+        x.threads = 1
+        self.assertEqual(1, len(list(x.ls())))
+        self.assertEqual(3, len(list(x.ls_extra())))
+
+    def test3_3_evict(self):
+        items = [(5, 10, 0), (1, 10, -1), (3, 10, -2), (2, 10, -3), (4, 10, -4)]
+        ret = list(cashe._evict_select(items, 50, 25))
+        self.assertEqual([1, 2, 3], [item[0] for item in ret])
+        self.assertEqual(0, len(list(cashe._evict_select([], 50, 0))))
+
+    def test6_check(self):
+        x = cashe.CAShe(self.tdir + "/test6")
+
+        for d in ("a", "aa", "aaa", "b"):
+            datai = x.path + "/data6." + d
+            fwrite(datai, d)
+            co = x.get('sha256', d2s[d])
+            co.save(datai, link=False)
+        fwrite(x.get('sha256', d2s['b']).filename, "bad")
+
+        ret = dict([(str(obj), ok) for obj, ok in x.check(jobs=2)])
+        self.assertEqual(4, len(ret))
+        self.assertFalse(ret['sha256:' + d2s['b']])
+        self.assertTrue(ret['sha256:' + d2s['a']])
+        self.assertFalse(x.get('sha256', d2s['b']).exists)
+        self.assertEqual(3, len(list(x.ls())))
+
+    def test7_aliases(self):
+        x = cashe.CAShe(self.tdir + "/test7")
+
+        datai = x.path + "/data7.1"
+        fwrite(datai, "a")
+        ret = x.save_aliases(datai, ['sha256', 'sha1', 'md5'], link=False)
+        self.assertEqual(['md5', 'sha1', 'sha256'], sorted(ret))
+        self.assertEqual(d2s['a'], ret['sha256'].checksum_data)
+        self.assertEqual('0cc175b9c0f1b6a831c399e269772661',
+                         ret['md5'].checksum_data)
+        self.assertPathLinks(ret['md5'].filename, 3)
+        self.assertPathLinks(datai, 1)
+        self.assertEqual(3, len(list(x.ls())))
+
+        # Aliases are one object for cleanup.
+        fwrite(x.path + "/config", "lo = 0 \n hi = 0\n")
+        self.assertEqual((3, 1), x.cleanup())
+        self.assertEqual(0, len(list(x.ls())))
+
+        fwrite(x.path + "/config", "aliases = sha1, sha\n")
+        self.assertEqual(['sha1'], x._get_config_aliases())
+
+    def test8_save_stream(self):
+        from StringIO import StringIO
+
+        x = cashe.CAShe(self.tdir + "/test8")
+
+        co = x.get('sha256', d2s['aa'])
+        self.assertEqual(None, co.save_stream(StringIO("ab")))
+        self.assertFalse(co.exists)
+        self.assertEqual(0, len(list(x.ls())))
+        self.assertEqual([], os.listdir(co.dirname))
+
+        self.assertEqual(co.filename, co.save_stream(StringIO("aa"), chunk=1))
+        self.assertTrue(co.exists)
+        self.assertEqual(2, co.size)
+
+        co = x.get('sha256', d2s['bbb'])
+        self.assertEqual(co.filename, co.save_stream(iter(["b", "bb"])))
+        self.assertEqual(2, len(list(x.ls())))
+        self.assertEqual("bbb", open(co.filename).read())
+
+    def test9_copy(self):
+        x = cashe.CAShe(self.tdir + "/test9")
+        x.link = False
+
+        datai = x.path + "/data9.1"
+        datao = x.path + "/data9.1-out"
+        fo = open(datai, "w")
+        fo.seek(1024 * 1024)
+        fo.write("a")
+        fo.seek(3 * 1024 * 1024)
+        fo.write("a")
+        fo.truncate(4 * 1024 * 1024)
+        fo.close()
+        os.chmod(datai, 0640)
+
+        data = cashe._file2hexdigest('sha256', datai)
+        co = x.get('sha256', data)
+        co.save(datai)
+        self.assertTrue(co.exists)
+        self.assertPathLinks(co.filename, 1)
+        self.assertFileEqual(datai, co.filename)
+        self.assertEqual(0640, os.stat(co.filename).st_mode & 07777)
+        co.load(datao)
+        self.assertFileEqual(datai, datao)
+        self.assertPathLinks(datao, 1)
+
+        st = os.stat(datai)
+        if st.st_blocks * 512 < st.st_size: # Holes are kept
+            st = os.stat(datao)
+            self.assertTrue(st.st_blocks * 512 < st.st_size)
+
+        # Every method works, not just the first one that does.
+        for name, func in cashe._copy_methods:
+            datao = x.path + "/data9.1-" + name
+            sfd = os.open(datai, os.O_RDONLY)
+            dfd = os.open(datao, os.O_WRONLY | os.O_CREAT)
+            try:
+                func(sfd, dfd, [0], st.st_size, True)
+            except OSError, e: # Not on this kernel/filesystem.
+                if e.errno not in cashe._copy_nosup:
+                    raise
+                os.close(sfd)
+                os.close(dfd)
+                continue
+            os.ftruncate(dfd, st.st_size)
+            os.close(sfd)
+            os.close(dfd)
+            self.assertFileEqual(datai, datao)
+
+    def test10_many(self):
+        x = cashe.CAShe(self.tdir + "/test10")
+
+        ds = ("a", "aa", "b", "bb")
+        items = []
+        for d in ds:
+            datai = x.path + "/data10." + d
+            fwrite(datai, d)
+            items.append((x.get('sha256', d2s[d]), datai))
+        ret = x.save_many(items[:3])
+        self.assertEqual([obj.filename for obj, datai in items[:3]], ret)
+
+        objs = x.get_many([('sha256', d2s[d]) for d in ds])
+        self.assertEqual([True, True, True, False],
+                         [bool(obj.exists) for obj in objs])
+        self.assertEqual([1, 2, 1, 0], [obj.size for obj in objs])
+
+        items = [(obj, x.path + "/data10-out." + obj.checksum_data)
+                 for obj in objs]
+        ret = x.load_many(items)
+        self.assertEqual(None, ret[3])
+        for obj, datao in items[:3]:
+            self.assertFileEqual(obj.filename, datao)
+            self.assertPathLinks(datao, 3)
+        self.assertPathNotExists(items[3][1])
+
+        # Without a checksum they are linked by name in the bucket.
+        datai = x.path + "/data10." + ds[3]
+        ret = x.save_many([(objs[3], datai)], checksum=False)
+        self.assertEqual([objs[3].filename], ret)
+        self.assertPathLinks(datai, 2)
+        if cashe._at_calls() is not None:
+            dfd = os.open(objs[3].dirname, os.O_RDONLY)
+            try:
+                st = cashe._fstatat(dfd, objs[3].checksum_data)
+                self.assertEqual(os.stat(datai), st)
+                self.assertEqual(os.stat(datai).st_mtime, st.st_mtime)
+                self.assertEqual(None, cashe._fstatat(dfd, "none"))
+            finally:
+                os.close(dfd)
+
+        # Objects moved by a reshard, in another process, are still found.
+        fwrite(x.path + "/layout", "2:2\n")
+        y = cashe.CAShe(x.path)
+        for d in ds[:2]:
+            self.assertTrue(y._move('sha256', d2s[d], (2, 2), [(1, 4)]))
+        items = [(obj, x.path + "/data10-mv." + obj.checksum_data)
+                 for obj in objs]
+        ret = x.load_many(items)
+        self.assertEqual(4, len(filter(None, ret)))
+        self.assertEqual(((2, 2),), x._layouts)
+        for d, (obj, datao) in zip(ds, items):
+            self.assertFileEqual(x.path + "/data10." + d, datao)
+
+    def test11_objs(self):
+        x = cashe.CAShe(self.tdir + "/test11", max_objs=2)
+
+        for d in ("a", "aa", "aaa"):
+            datai = x.path + "/data11." + d
+            fwrite(datai, d)
+            x.get('sha256', d2s[d]).save(datai)
+        self.assertEqual(2, len(x._objs['sha256']))
+        co = x.get('sha256', d2s['aaa'])
+        self.assertTrue(co in x)
+        self.assertTrue(co is x.get('sha256', d2s['aaa'].upper()))
+        self.assertFalse(x._get('sha256', d2s['a'], cache=False) in x)
+
+        x = cashe.CAShe(self.tdir + "/test11")
+        self.assertEqual(3, len(list(x.ls())))
+        self.assertEqual(0, len(x._objs['sha256']))
+        x.cleanup()
+
+    def _test12_scan(self, np):
+        x = cashe.CAShe(self.tdir + "/test12")
+        onp = cashe._numpy_mod
+        if not np:
+            cashe._numpy_mod = None
+        elif cashe._numpy() is None:
+            return
+
+        try:
+            now = time.time()
+            for num, d in enumerate(("a", "aa", "aaa", "b")):
+                datai = x.path + "/data12." + d
+                fwrite(datai, d)
+                co = x.get('sha256', d2s[d])
+                co.save(datai, link=d == "b")
+                tm = now - (num * 100)
+                os.utime(co.filename, (tm, tm))
+            datai = x.path + "/data12.bb"
+            fwrite(datai, "bb")
+            x.save_aliases(datai, ['sha256', 'md5'], link=False)
+
+            snap = x.scan()
+            self.assertEqual(6, len(snap))
+            rows = dict([(snap.checksum(row), row) for row in range(6)])
+            self.assertTrue(('sha256', d2s['aaa']) in rows)
+            st = snap.stat(rows[('sha256', d2s['aa'])])
+            self.assertEqual(2, st.st_size)
+            self.assertEqual(int(now - 100), int(st.st_mtime))
+
+            Ts = snap.summary("mtime", 150, now)
+            self.assertEqual(['.', 'md5', 'sha256'], sorted(Ts))
+            self.assertEqual(1, Ts['.']['used-objs'])
+            self.assertEqual(3, Ts['.']['free-objs'])
+            self.assertEqual(5, Ts['.']['free-size'])
+            self.assertEqual(1, Ts['.']['free-objs-old'])
+            self.assertEqual(3, Ts['sha256']['free-objs'])
+            self.assertEqual(1, Ts['md5']['free-objs'])
+            Ts = snap.summary("mtime", 150, now, 'md5')
+            self.assertEqual(1, Ts['.']['free-objs'])
+
+            rows = [rows[('sha256', d2s[d])] for d in ("a", "aa", "aaa")]
+            self.assertEqual([rows[2], rows[1]],
+                             list(snap.select(rows, 6, 1, "mtime")))
+
+            fwrite(x.path + "/config", "lo = 3 \n hi = 3\n")
+            self.assertEqual((2, 5), x.cleanup())
+            self.assertEqual(4, len(list(x.ls())))
+        finally:
+            cashe._numpy_mod = onp
+
+    def test12_scan(self):
+        self._test12_scan(False)
+
+    def test12_scan_numpy(self):
+        self._test12_scan(True)
+
+    def test13_async(self):
+        try:
+            asyncio = cashe._asyncio()
+            import concurrent.futures
+        except ImportError:
+            return
+
+        loop = asyncio.new_event_loop()
+        # One thread, so the saves of the same object don't race each other.
+        x = cashe.AsyncCAShe(cashe.CAShe(self.tdir + "/test13"), workers=1,
+                             loop=loop)
+        try:
+            datai = x.cashe.path + "/data13.1"
+            datao = x.cashe.path + "/data13.1-out"
+            fwrite(datai, "a")
+
+            f1 = x.exists('sha256', d2s['a'])
+            f2 = x.exists('sha256', d2s['a'])
+            self.assertEqual([False, False],
+                             loop.run_until_complete(asyncio.gather(f1, f2,
+                                                                    loop=loop)))
+
+            # Merged calls are one call, unless that returns None.
+            calls = []
+            def _call(ret):
+                calls.append(ret)
+                return ret
+            fut = asyncio.gather(x._submit('t1', _call, 1),
+                                 x._submit('t1', _call, 2), loop=loop)
+            self.assertEqual([1, 1], loop.run_until_complete(fut))
+            self.assertEqual([1], calls)
+            calls = []
+            fut = asyncio.gather(x._submit('t2', _call, None),
+                                 x._submit('t2', _call, None), loop=loop)
+            self.assertEqual([None, None], loop.run_until_complete(fut))
+            self.assertEqual([None, None], calls)
+
+            # Saves of different files/data aren't merged (one might be bad).
+            fwrite(datai + "b1", "b")
+            fwrite(datai + "b2", "b")
+            fut = asyncio.gather(x.save('sha256', d2s['b'], datai + "b1"),
+                                 x.save('sha256', d2s['b'], datai + "b2"),
+                                 x.save('sha256', d2s['b'], datai + "b2",
+                                        link=False),
+                                 x.save_stream('sha256', d2s['b'], iter("b")),
+                                 x.save_stream('sha256', d2s['b'], iter("b")),
+                                 loop=loop)
+            self.assertEqual(5, len(x._pending))
+            self.assertTrue(all(loop.run_until_complete(fut)))
+            loop.run_until_complete(x.unlink('sha256', d2s['b']))
+
+            fut = x.save('sha256', d2s['a'], datai)
+            self.assertTrue(loop.run_until_complete(fut))
+            fut = x.save_stream('sha256', d2s['aa'], iter(["a", "a"]))
+            self.assertTrue(loop.run_until_complete(fut))
+            fut = asyncio.gather(x.exists('sha256', d2s['a']),
+                                 x.get('sha256', d2s['aa']),
+                                 x.ls(), loop=loop)
+            ret = loop.run_until_complete(fut)
+            self.assertTrue(ret[0])
+            self.assertEqual(2, ret[1].size)
+            self.assertEqual(2, len(ret[2]))
+
+            fut = x.load('sha256', d2s['a'], datao)
+            self.assertTrue(loop.run_until_complete(fut))
+            self.assertFileEqual(datai, datao)
+
+            loop.run_until_complete(x.unlink('sha256', d2s['a']))
+            self.assertFalse(loop.run_until_complete(x.exists('sha256',
+                                                              d2s['a'])))
+            self.assertEqual({}, x._pending)
+        finally:
+            x.close()
+            loop.close()
+
+    def test14_daemon(self):
+        import threading
+        path = self.tdir + "/test14"
+        datai = self.tdir + "/data14.1"
+        fwrite(datai, "a")
+        x = cashe.CAShe(path)
+        self.assertTrue(x.get('sha256', d2s['a']).save(datai))
+
+        d = cashe.CASheDaemon(cashe.CAShe(path), refresh=None)
+        thread = threading.Thread(target=d.serve_forever)
+        thread.start()
+        try:
+            for num in range(100):
+                if d._server is not None:
+                    break
+                time.sleep(0.05)
+
+            y = cashe.CAShe(path)
+            self.assertTrue(y._daemon is not None)
+            self.assertEqual(1, y.get('sha256', d2s['a']).size)
+            self.assertEqual(0, y.get('sha256', d2s['aa']).size)
+
+            # Saves and unlinks, from the client, update the daemon.
+            fwrite(datai, "aa")
+            os.utime(datai, (1000000000, 1000000000))
+            obj = y.get('sha256', d2s['aa'])
+            self.assertTrue(obj.save(datai))
+            self.assertEqual(1000000000, os.stat(datai).st_mtime)
+            self.assertEqual(2, obj.size)
+            self.assertEqual(2, d.lookup('sha256', d2s['aa']).st_size)
+            y.get('sha256', d2s['a']).unlink()
+            self.assertTrue(d.lookup('sha256', d2s['a']) is None)
+
+            Ts = y._daemon.summary()
+            self.assertEqual(1, Ts['.']['free-objs'] + Ts['.']['used-objs'])
+            self.assertEqual((0, 0), y.cleanup())
+            self.assertTrue(y._daemon is not None)
+
+            # Only the owner can change the CAShe, anyone can lookup.
+            os.chmod(path, 0755)
+            cred = (1, os.geteuid() + 1, os.getegid() + 1)
+            self.assertEqual((False, cashe._daemon_eperm),
+                             d._handle(['cleanup'], cred))
+            self.assertEqual((False, cashe._daemon_eperm),
+                             d._handle(['refresh'], None))
+            self.assertEqual(True, d._handle(['lookup', 'sha256', d2s['aa']],
+                                             cred)[0])
+            self.assertEqual((True, 1), d._handle(['refresh'], (1, 0, 0)))
+
+            # The daemon's counters are saved while it's running.
+            os.makedirs(path + "/meta/stats")
+            d.cashe._stats.add('test-daemon')
+            self.assertEqual((True, 1), d._handle(['refresh'], (1, 0, 0)))
+            self.assertEqual(1, cashe.CAShe(path).stats()['test-daemon'])
+            y._daemon.close()
+        finally:
+            d.shutdown()
+            thread.join()
+
+        # Falls back to the filesystem, when the daemon isn't running.
+        y = cashe.CAShe(path)
+        self.assertEqual(2, y.get('sha256', d2s['aa']).size)
+        self.assertTrue(y._daemon is None)
+
+    def test15_stats(self):
+        x = cashe.CAShe(self.tdir + "/test15")
+        datai = x.path + "/data15.1"
+        datao = x.path + "/data15.1-out"
+        fwrite(datai, "a")
+
+        self.assertFalse(x.get('sha256', d2s['a']).load(datao))
+        self.assertTrue(x.get('sha256', d2s['a']).save(datai, link=False))
+        self.assertTrue(x.get('sha256', d2s['a']).load(datao))
+        stats = x.stats()
+        self.assertEqual(1, stats['load-hits'])
+        self.assertEqual(1, stats['load-misses'])
+        self.assertEqual(1, stats['copy-objs'])
+        self.assertEqual(1, stats['link-bytes'])
+        self.assertEqual(1, stats['checksum-objs'])
+
+        # Counters are saved per process, and merged when read.
+        os.makedirs(x._stats.dirname)
+        self.assertTrue(x._stats.flush())
+        fwrite(x._stats.dirname + "/otherhost-1-1", '{"load-hits" : 4}')
+        y = cashe.CAShe(x.path)
+        self.assertEqual(5, y.stats()['load-hits'])
+        self.assertEqual(5, x.stats()['load-hits'])
+        x._stats.reset()
+        self.assertEqual({}, y.stats())
+
+    def test16_bloom(self):
+        x = cashe.CAShe(self.tdir + "/test16")
+        datai = x.path + "/data16.1"
+        fwrite(datai, "a")
+        self.assertTrue(x.get('sha256', d2s['a']).save(datai))
+        self.assertEqual(1, x.reindex())
+        self.assertPathExists(x.path + "/meta/bloom-sha256")
+        self.assertPathExists(x.path + "/meta/bloom-md5")
+
+        bloom = x._bloom('sha256')
+        self.assertTrue(d2s['a'] in bloom)
+        self.assertFalse(d2s['b'] in bloom)
+
+        # Saves add to the filter, in all processes.
+        y = cashe.CAShe(x.path)
+        fwrite(datai, "b")
+        self.assertTrue(y.get('sha256', d2s['b']).save(datai, link=False))
+        self.assertTrue(d2s['b'] in bloom)
+
+        # Misses are answered from the filter.
+        fwrite(datai, "aa")
+        os.makedirs(x.get('sha256', d2s['aa']).dirname)
+        shutil.copy(datai, x.get('sha256', d2s['aa']).filename)
+        self.assertFalse(cashe.CAShe(x.path).get('sha256', d2s['aa']).exists)
+
+        # ...until it's rebuilt from a scan.
+        self.assertEqual(3, len(x.scan()))
+        self.assertTrue(cashe.CAShe(x.path).get('sha256', d2s['aa']).exists)
+
+        # Saving a new object, by link, keeps the times of the file.
+        fwrite(datai, "aaa")
+        os.utime(datai, (1000000000, 1000000000))
+        obj = cashe.CAShe(x.path).get('sha256', d2s['aaa'])
+        self.assertTrue(obj.save(datai))
+        self.assertEqual(1000000000, os.stat(datai).st_mtime)
+        self.assertEqual(3, obj.size)
+        self.assertEqual(3, cashe.CAShe(x.path).get('sha256', d2s['aaa']).size)
+
+        # Saves while it's being rebuilt are kept, removed objects aren't.
+        before = bloom.bits()
+        fwrite(datai, "aaaa")
+        y = cashe.CAShe(x.path)
+        self.assertTrue(y.get('sha256', d2s['aaaa']).save(datai, link=False))
+        bloom.write([d2s['a']], 1, before)
+        self.assertTrue(d2s['a'] in bloom)
+        self.assertTrue(d2s['aaaa'] in bloom)
+        self.assertFalse(d2s['b'] in bloom)
+
+    def test17_import(self):
+        # Nothing slow should be imported/run, just by importing cashe.
+        import subprocess
+        cmd = ("import sys; sys.path.insert(0, '.'); import cashe; "
+               "print(' '.join(sorted(set(['tempfile', 'shutil', 'optparse', "
+               "'random', 'json']) & set(sys.modules)))); "
+               "print(cashe._probed_checksums)")
+        out = subprocess.Popen([sys.executable, "-c", cmd],
+                               stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(["", "False"], out.split("\n")[:2])
+
+    def test18_verified(self):
+        x = cashe.CAShe(self.tdir + "/test18")
+        for d in ("a", "b"):
+            datai = x.path + "/data18." + d
+            fwrite(datai, d)
+            self.assertTrue(x.get('sha256', d2s[d]).save(datai, link=False))
+        self.assertEqual(0, x.stats().get('checksum-skips', 0))
+        self.assertPathExists(x.path + "/meta/verified/sha256/" + d2s['a'][:4])
+
+        # Unchanged objects aren't checksummed again...
+        ret = dict([(str(obj), ok) for obj, ok in x.check()])
+        self.assertEqual(2, x.stats()['checksum-skips'])
+        self.assertTrue(x.get('sha256', d2s['a']).load(x.path + "/out18",
+                                                       checksum=True))
+        self.assertEqual(3, x.stats()['checksum-skips'])
+        self.assertPathLinks(x.path + "/out18", 2) # Changed its ctime
+        self.assertTrue(x.get('sha256', d2s['a']).load(x.path + "/out18.2",
+                                                       checksum=True))
+        self.assertEqual(4, x.stats()['checksum-skips'])
+
+        # ...unless they have changed, or it's forced.
+        fwrite(x.get('sha256', d2s['b']).filename, "bad")
+        ret = dict([(str(obj), ok) for obj, ok in x.check(force=True)])
+        self.assertEqual(4, x.stats()['checksum-skips'])
+        self.assertTrue(ret['sha256:' + d2s['a']])
+        self.assertFalse(ret['sha256:' + d2s['b']])
+
+        # Files of mostly old stamps are rewritten.
+        obj = x.get('sha256', d2s['a'])
+        for num in range(20):
+            self.assertTrue(x._verified.add(obj, obj._file_stat()))
+        fname = x.path + "/meta/verified/sha256/" + d2s['a'][:4]
+        self.assertTrue(len(open(fname).readlines()) <= 11)
+        self.assertTrue(x._verified.verified(obj, obj._file_stat()))
+
+    def test19_hashing(self):
+        import hashlib
+        fname = self.tdir + "/data19"
+        data = "".join([chr(num % 251) for num in xrange(3 * 1024 * 1024)])
+        fwrite(fname, data)
+        types = ['md5', 'sha1', 'sha256', 'sha512']
+        exp = dict([(T, hashlib.new(T, data).hexdigest()) for T in types])
+
+        old = cashe._hash_nogil
+        try:
+            for nogil in (False, True): # Sliced and threaded updates
+                cashe._hash_nogil = nogil
+                sums = cashe.Checksums(types)
+                self.assertEqual(len(data), sums.read_file(fname))
+                self.assertEqual(exp, sums.hexdigests())
+                sums = cashe.Checksums(types)
+                sums.update(data[:len(data) // 2])
+                queues = sums._queues
+                sums.update(data[len(data) // 2:])
+                self.assertEqual(exp, sums.hexdigests())
+                if nogil: # The same threads, for each update.
+                    self.assertEqual(3, len(queues))
+                    self.assertTrue(queues is sums._queues)
+        finally:
+            cashe._hash_nogil = old
+
+        self.assertEqual(exp['sha256'], cashe._file2hexdigest('sha256', fname,
+                                                              chunk=4096))
+        sums = cashe.Checksums(['sha256'])
+        self.assertEqual(2 * 1024 * 1024, sums.read_file(fname, 1024 * 1024 + 1))
+        self.assertEqual(None, cashe._file2hexdigest('sha256', fname + "-no"))
+
+    def test20_usage(self):
+        x = cashe.CAShe(self.tdir + "/test20")
+        datai = x.path + "/data20.1"
+        fwrite(datai, "a")
+        self.assertTrue(x.get('sha256', d2s['a']).save(datai, link=False))
+        self.assertTrue(x._usage is None)
+        self.assertEqual({'.' : (1, 1), 'sha256' : (1, 1)}, x.usage())
+        self.assertTrue(x._usage is not None)
+
+        # Saves/unlinks update the totals, from any process.
+        y = cashe.CAShe(x.path)
+        fwrite(datai, "bb")
+        self.assertTrue(y.save_aliases(datai, ['sha256', 'sha1']))
+        # Replaced, with the wrong data.
+        self.assertTrue(y.get('sha256', d2s['a']).save(datai, checksum=False,
+                                                       link=False))
+        self.assertEqual({'.' : (2, 4), 'sha256' : (2, 4), 'sha1' : (1, 2)},
+                         x.usage())
+        y.get('sha256', d2s['a']).unlink()
+        self.assertEqual({'.' : (1, 2), 'sha256' : (1, 2), 'sha1' : (1, 2)},
+                         x.usage())
+        self.assertEqual(x.usage(), x.usage(exact=True))
+
+        # The journal is compacted, when it gets big.
+        x._usage.COMPACT = 4
+        x._usage.add('sha1', 1, 1)
+        x._usage.add('sha1', -1, -1)
+        self.assertEqual(7, len(open(x._usage.filename).readlines()))
+        self.assertEqual(x.usage(), x.usage())
+        self.assertEqual(3, len(open(x._usage.filename).readlines()))
+
+        # Cleanup removes aliases together, as one object.
+        os.unlink(datai)
+        fwrite(x.path + "/config", "lo = 0 \n hi = 0\n")
+        self.assertEqual((2, 2), x.cleanup())
+        self.assertEqual({'.' : (0, 0), 'sha256' : (0, 0), 'sha1' : (0, 0)},
+                         x.usage())
+        self.assertEqual({'.' : (0, 0)}, x.usage(exact=True))
+
+    def test21_reshard(self):
+        x = cashe.CAShe(self.tdir + "/test21")
+        datai = x.path + "/data21.1"
+        for data in ('a', 'aa', 'aaa'):
+            fwrite(datai, data)
+            self.assertTrue(x.get('sha256', d2s[data]).save(datai, link=False))
+        self.assertEqual(x.path + "/sha256/ca97/" + d2s['a'],
+                         x.get('sha256', d2s['a']).filename)
+
+        # A reshard that hasn't finished, objects can be in either layout.
+        fwrite(x.path + "/layout", "2:2\n1:4\n")
+        y = cashe.CAShe(x.path)
+        fwrite(datai, "b")
+        self.assertTrue(y.get('sha256', d2s['b']).save(datai))
+        self.assertEqual(x.path + "/sha256/3e/23/" + d2s['b'],
+                         y.get('sha256', d2s['b']).filename)
+        self.assertEqual(4, len(list(y.ls())))
+        self.assertEqual([], list(y.ls_extra()))
+        self.assertTrue(y.get('sha256', d2s['a']).load(datai + ".a"))
+        self.assertTrue(x._move('sha256', d2s['aa'], (2, 2), [(1, 4)]))
+        obj = y.get('sha256', d2s['aa'])
+        self.assertEqual(2, obj.size)
+        self.assertTrue(obj.load(datai + ".aa"))
+
+        # Finish it, everything ends up in the configured layout.
+        fwrite(x.path + "/config", "fanout = 2:2\n")
+        self.assertEqual(2, y.reshard())
+        self.assertEqual(((2, 2),), cashe.CAShe(x.path)._layouts)
+        self.assertFalse(os.path.exists(x.path + "/sha256/ca97"))
+        self.assertEqual(4, len(list(y.ls())))
+        self.assertEqual([], list(y.ls_extra()))
+        self.assertTrue(y.get('sha256', d2s['a']).exists)
+        self.assertEqual(0, y.reshard())
+
+        y.get('sha256', d2s['a']).unlink()
+        self.assertFalse(os.path.exists(x.path + "/sha256/ca"))
+        self.assertEqual(3, y.reshard((1, 1)))
+        self.assertEqual(['3', '9'], sorted(os.listdir(x.path + "/sha256")))
+
+        # Processes that were running see it, when they miss an object.
+        self.assertEqual(((1, 4),), x._layouts)
+        self.assertTrue(x.get('sha256', d2s['b']).exists)
+        self.assertEqual(((1, 1),), x._layouts)
+
+    def test22_sync(self):
+        x = cashe.CAShe(self.tdir + "/test22")
+        y = cashe.CAShe(self.tdir + "/test22-y")
+        datai = x.path + "/data22.1"
+        for data in ('a', 'aa', 'aaa'):
+            fwrite(datai, data)
+            self.assertTrue(x.get('sha256', d2s[data]).save(datai, link=False))
+        fwrite(datai, "b")
+        self.assertTrue(y.get('sha256', d2s['b']).save(datai, link=False))
+        self.assertTrue(y.get('sha256', d2s['a']).save(datai, checksum=False,
+                                                       link=False))
+
+        # Only what's missing is copied, so the bad "a" stays bad.
+        res = sorted(x.sync_to(y, jobs=2))
+        self.assertEqual([('sha256', d2s['aa'], 2), ('sha256', d2s['aaa'], 3)],
+                         res)
+        self.assertEqual(4, len(list(y.ls())))
+        self.assertFileEqual(x.get('sha256', d2s['aa']).filename,
+                             y.get('sha256', d2s['aa']).filename)
+
+        # Only recently used objects.
+        old = time.time() - 60 * 60
+        os.utime(y.get('sha256', d2s['aa']).filename, (old, old))
+        res = sorted(cashe.CAShe(x.path + "/hot").sync_from(y, hot=60))
+        self.assertEqual(['a', 'aaa', 'b'],
+                         sorted([d for d in d2s if d2s[d] in
+                                 [D for T, D, size in res]]))
+
+        # To/from a cashe process, over a pipe.
+        cmd = [sys.executable, os.path.abspath("cashe.py"),
+               "--path", self.tdir + "/test22-z", "sync-server"]
+        z = cashe.CASheRemote(cmd)
+        try:
+            # The data is checked as it's copied, so the bad "a" isn't.
+            res = sorted(y.sync_to(z, jobs=2, preserve=True))
+            self.assertEqual([None, 1, 2, 3], sorted([r[2] for r in res]))
+            self.assertEqual(3, len(z.manifest()['sha256']))
+            self.assertEqual([('sha256', d2s['a'], None)], list(y.sync_to(z)))
+            w = cashe.CAShe(x.path + "/w")
+            res = sorted(w.sync_from(z, jobs=2, preserve=True))
+            self.assertEqual([1, 2, 3], sorted([r[2] for r in res]))
+            self.assertEqual(int(old), int(w.get('sha256', d2s['aa']).mtime))
+        finally:
+            z.close()
+
+    def test23_merge(self):
+        x = cashe.CAShe(self.tdir + "/test23")
+        tdir = self.tdir + "/test23-files"
+        os.makedirs(tdir + "/sub/dir")
+        fwrite(tdir + "/a", "a")
+        fwrite(tdir + "/b", "b")
+        fwrite(tdir + "/sub/b", "b")
+        os.link(tdir + "/a", tdir + "/sub/dir/a")
+        os.symlink("..", tdir + "/sub/loop")
+
+        with checksummed() as sums:
+            res = sorted(list(x.merge([tdir], 'sha256', jobs=2)))
+            # Each inode is checksummed once.
+            self.assertEqual(3, len(sums))
+            self.assertEqual([(tdir + "/a", 'save'), (tdir + "/b", 'save'),
+                              (tdir + "/sub/b", 'load'),
+                              (tdir + "/sub/dir/a", None)],
+                             [(fname, how) for fname, obj, how in res])
+            self.assertPathLinks(tdir + "/sub/b", 3)
+
+            # Files which are already objects aren't checksummed again.
+            del sums[:]
+            fwrite(tdir + "/c", "aa")
+            res = list(x.merge([tdir], 'sha256', jobs=1))
+            self.assertEqual([tdir + "/c"], sums)
+            self.assertEqual(1, len([r for r in res if r[2] == 'save']))
+            self.assertEqual(3, len(list(x.ls())))
+
+    def test24_hashes(self):
+        x = cashe.CAShe(self.tdir + "/test24")
+        datai = x.path + "/data24.1"
+        fwrite(datai, "a")
+        datao = x.path + "/data24.2"
+        fwrite(datao, "b")
+
+        with checksummed() as sums:
+            # Without meta/hashes, every call reads the file.
+            self.assertEqual(d2s['a'], x.checksum_file('sha256', datai))
+            self.assertEqual(d2s['a'], x.checksum_file('sha256', datai))
+            self.assertEqual(2, len(sums))
+
+            os.makedirs(x.path + "/meta")
+            fwrite(x.path + "/meta/hashes", "")
+            fwrite(x.path + "/config", "hashes = 1\n")
+            x = cashe.CAShe(x.path)
+            del sums[:]
+            self.assertEqual(d2s['a'], x.checksum_file('sha256', datai))
+            self.assertEqual(d2s['a'], x.checksum_file('sha256', datai))
+            self.assertEqual(d2s['b'], x.checksum_file('sha256', datao))
+            self.assertEqual([datai, datao], sums)
+            self.assertTrue(x._hashes.flush())
+
+            # Only the most recently used file is kept, and changes are seen.
+            y = cashe.CAShe(x.path)
+            self.assertEqual(d2s['b'], y.checksum_file('sha256', datao))
+            self.assertEqual(d2s['a'], y.checksum_file('sha256', datai))
+            self.assertEqual([datai, datao, datai], sums)
+            time.sleep(0.01)
+            fwrite(datao, "bb")
+            self.assertEqual(d2s['bb'], y.checksum_file('sha256', datao))
+            self.assertEqual([datai, datao, datai, datao], sums)
+
+    def test25_merge_link_only(self):
+        x = cashe.CAShe(self.tdir + "/test25")
+        tdir = self.tdir + "/test25-files"
+        os.makedirs(tdir)
+        fwrite(tdir + "/a", "abcd")
+        fwrite(tdir + "/d", "xyz")
+        list(x.merge([tdir], 'sha256', link=False))
+        fwrite(tdir + "/a", "abcd")
+        fwrite(tdir + "/b", "abce")
+        fwrite(tdir + "/c", "xy")
+        fwrite(tdir + "/d", "xyz")
+
+        with checksummed() as sums:
+            # Only files the same size as an object are checksummed, and
+            # nothing is saved.
+            res = sorted(list(x.merge([tdir], 'sha256', link_only=True)))
+            self.assertEqual([tdir + "/a", tdir + "/b", tdir + "/d"],
+                             sorted(sums))
+            self.assertEqual([(tdir + "/a", 'load'), (tdir + "/b", None),
+                              (tdir + "/c", None), (tdir + "/d", 'load')],
+                             [(fname, how) for fname, obj, how in res])
+            self.assertEqual(2, len(list(x.ls())))
+            self.assertPathLinks(tdir + "/a", 2)
+            self.assertPathLinks(tdir + "/b", 1)
+
+            # The prefix check skips files which start differently.
+            del sums[:]
+            fwrite(tdir + "/e", "zbcd")
+            fwrite(tdir + "/f", "xyz")
+            res = list(x.merge([tdir], 'sha256', link_only=True, prefix=2))
+            self.assertEqual([tdir + "/b", tdir + "/f"], sorted(sums))
+            self.assertPathLinks(tdir + "/f", 3)
+
+    def test26_packs(self):
+        x = cashe.CAShe(self.tdir + "/test26")
+        datai = x.path + "/data26.1"
+        fwrite(datai, "aa")
+        x.get('sha256', d2s['aa']).save(datai, link=False)
+        # Moves the existing small objects into the packs, and turns it on.
+        self.assertEqual(1, x.pack(4))
+        co = x.get('sha256', d2s['aa'])
+        self.assertTrue(co.packed)
+        self.assertEqual(2, co.size)
+        self.assertPathNotExists(co.filename)
+
+        fwrite(datai, "aaa")
+        co = x.get('sha256', d2s['aaa'])
+        self.assertTrue(co.save(datai))
+        self.assertTrue(co.packed)
+        self.assertPathNotExists(co.filename)
+        fwrite(datai, "aaaa")
+        co = x.get('sha256', d2s['aaaa'])
+        self.assertEqual(co.filename, co.save(datai))
+        self.assertFalse(co.packed)
+
+        # Another CAShe sees them, and loads them by copying.
+        y = cashe.CAShe(x.path)
+        self.assertEqual(sorted([(d2s['aa'], 2), (d2s['aaa'], 3),
+                                 (d2s['aaaa'], 4)]),
+                         sorted([(obj.checksum_data, obj.size)
+                                 for obj in y.ls()]))
+        self.assertEqual(3, len(y.scan()))
+        datao = x.path + "/data26.2"
+        co = y.get('sha256', d2s['aaa'])
+        self.assertEqual(datao, co.load(datao, checksum=True))
+        self.assertEqual("aaa", open(datao).read())
+        self.assertPathLinks(datao, 1)
+        self.assertEqual([True, True, True],
+                         [ok for obj, ok in y.check(jobs=1)])
+
+        # Removed objects are gone, and the space is reclaimed by cleanup.
+        y.rm(co)
+        co = cashe.CAShe(x.path).get('sha256', d2s['aaa'])
+        self.assertFalse(co.exists)
+        self.assertEqual(None, co.load(datao + ".2"))
+        fwrite(x.path + "/config", "pack = 4\nlo = 1g\n")
+        self.assertEqual((0, 0), y.cleanup())
+        pdir = x.path + "/packs/sha256"
+        self.assertEqual([2], [os.path.getsize(pdir + "/" + name)
+                               for name in os.listdir(pdir)
+                               if name.endswith(".pack")])
+        self.assertEqual(2, len(list(x.ls())))
+        self.assertEqual([d2s['aa']], [obj.checksum_data for obj in x.ls()
+                                       if obj.packed])
+
+        # Syncing copies the packed objects, into the packs if there are any.
+        z = cashe.CAShe(self.tdir + "/test26-2")
+        self.assertEqual([2, 4], sorted([size for T, D, size in
+                                         x.sync_to(z, jobs=1)]))
+        self.assertFalse(z.get('sha256', d2s['aa']).packed)
+        co = z.get('sha256', d2s['aa'])
+        self.assertEqual("aa", open(co.filename).read())
+
     def test_reg1(self):
         x = cashe.CAShe(self.tdir + "/test-reg1")
 